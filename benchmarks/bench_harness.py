@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+# coding=utf-8
+# pylint: disable=broad-except,unused-argument,line-too-long, unused-variable
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# End to end throughput benchmark of build.py and run.py without IBM Cloud.
+# For each test count a copy of the harness is set up in a temporary
+# workspace, tests are built for synthetic zones and images, and run.py runs
+# them against stubs/terraform and stubs/report_service.py. Reported for
+# each count: tests per second for build and run, the time to scan the
+# queue tree and read the queued cells from the job store, the peak RSS
+# of build.py and run.py, and report service HTTP calls per test.
+#
+#   python3 benchmarks/bench_harness.py --tests 1000 10000 50000 \
+#       [--concurrency 200] [--build-workers 4] [--apply-seconds 0] \
+#       [--completion-delay 0] [--apply-fail-rate 0] [--runner-config '{...}'] \
+#       [--output results.jsonl]
+#
+import os
+import sys
+import json
+import math
+import glob
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.dirname(SCRIPT_DIR)
+STUB_DIR = os.path.join(SCRIPT_DIR, 'stubs')
+sys.path.insert(0, REPO_DIR)
+
+import job_store  # noqa: E402
+
+IMAGES = ['bigip-14-1-2-6-0-0-2-all-1slot', 'bigip-15-1-0-4-0-0-6-ltm-1slot']
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def region_from_zone(zone):
+    parts = zone.split('-')
+    return "%s-%s" % (parts[0], parts[1])
+
+
+def template_count():
+    return len(glob.glob(os.path.join(REPO_DIR, 'templates', '*.tar.gz')))
+
+
+def setup_workspace(workspace, tests, args, report_url):
+    # a copy of the harness scripts and templates with synthetic resources
+    for script in glob.glob(os.path.join(REPO_DIR, '*.py')):
+        shutil.copy2(script, workspace)
+    shutil.copytree(os.path.join(REPO_DIR, 'templates'), os.path.join(workspace, 'templates'))
+    with open(os.path.join(REPO_DIR, 'sample-builder-config.json'), 'r') as cf:
+        builder_config = json.load(cf)
+    zones = builder_config['active_zones'][0:args.zones]
+    per_zone = int(math.ceil(float(tests) / (len(zones) * len(IMAGES) * template_count())))
+    job_store_file = os.path.join(workspace, 'test_jobs.db')
+    builder_config.update({
+        'active_zones': zones,
+        'license_type': 'utilitypool',
+        'utility_pool_tests_per_zone': per_zone,
+        'zone_license_hosts': dict((zone, {
+            'license_host': "10.0.0.%d" % (index % 4 + 1),
+            'license_username': 'admin',
+            'license_password': 'admin',
+            'license_pool': 'TESTELA',
+            'license_sku_keyword_1': 'BT',
+            'license_sku_keyword_2': '1G',
+            'license_unit_of_measure': 'hourly'
+        }) for (index, zone) in enumerate(zones)),
+        'api_key': 'benchmark-api-key',
+        'report_service_base_url': report_url,
+        'resolve_data_sources': False,
+        'job_store_file': job_store_file
+    })
+    with open(os.path.join(workspace, 'builder-config.json'), 'w') as cf:
+        json.dump(builder_config, cf, indent=4)
+    with open(os.path.join(workspace, 'zone-resources.json'), 'w') as zf:
+        json.dump(dict((zone, dict((resource, {'value': "%s-%s" % (resource, zone)})
+                                   for resource in ['ssh_key_name', 'f5_management_id', 'f5_cluster_id',
+                                                    'f5_internal_id', 'f5_external_id']))
+                       for zone in zones), zf)
+    catalog = {}
+    for zone in zones:
+        region = region_from_zone(zone)
+        catalog[region] = [{'image_name': "%s-%s" % (image, region)} for image in IMAGES]
+    with open(os.path.join(workspace, 'f5-image-catalog.json'), 'w') as imf:
+        json.dump(catalog, imf)
+    open(os.path.join(workspace, 'licenses.txt'), 'w').close()
+    with open(os.path.join(REPO_DIR, 'sample-runners-config.json'), 'r') as cf:
+        runner_config = json.load(cf)
+    runner_config.pop('scheduler', None)
+    runner_config.update({
+        'thread_pool_size': args.concurrency,
+        'phase_concurrency': dict((phase, args.concurrency)
+                                  for phase in ['init', 'apply', 'poll', 'destroy']),
+        'report_service_base_url': report_url,
+        'report_request_frequency': args.report_request_frequency,
+        'pipeline_stats_interval': 3600,
+        'test_timeout': args.test_timeout,
+        'job_store_file': job_store_file
+    })
+    if args.runner_config:
+        runner_config.update(json.loads(args.runner_config))
+    with open(os.path.join(workspace, 'runners-config.json'), 'w') as cf:
+        json.dump(runner_config, cf, indent=4)
+    return job_store_file
+
+
+def run_script(workspace, script, script_args, env, log_name):
+    # returns (seconds, peak RSS in MB, return code). On Linux the peak is
+    # the largest of the process and the children it waited for.
+    start = time.time()
+    with open(os.path.join(workspace, log_name), 'w') as log:
+        proc = subprocess.Popen([sys.executable, script] + script_args, cwd=workspace,
+                                env=env, stdout=log, stderr=subprocess.STDOUT)
+        (pid, status, rusage) = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else status >> 8
+    return (time.time() - start, rusage.ru_maxrss / 1024.0, proc.returncode)
+
+
+def scan_queue(workspace, job_store_file):
+    job_store.configure({'job_store_file': job_store_file})
+    start = time.time()
+    job_store.import_queue_tree(os.path.join(workspace, 'queued_tests'))
+    tree_seconds = time.time() - start
+    start = time.time()
+    cells = job_store.queued_cells()
+    cells_seconds = time.time() - start
+    return (tree_seconds, cells_seconds, job_store.counts().get(job_store.QUEUED, 0), len(cells))
+
+
+def report_counts(report_url):
+    with urllib.request.urlopen("%s/counts" % report_url, timeout=10) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def bench(tests, args, output):
+    workspace = tempfile.mkdtemp(prefix='bench_harness_')
+    port = free_port()
+    report_url = "http://127.0.0.1:%d" % port
+    report_service = subprocess.Popen([sys.executable, os.path.join(STUB_DIR, 'report_service.py'),
+                                       '--port', str(port), '--completion-delay', str(args.completion_delay)],
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        job_store_file = setup_workspace(workspace, tests, args, report_url)
+        env = dict(os.environ)
+        env['PATH'] = "%s%s%s" % (STUB_DIR, os.pathsep, env.get('PATH', ''))
+        for (name, value) in [('INIT_SECONDS', args.init_seconds), ('APPLY_SECONDS', args.apply_seconds),
+                              ('DESTROY_SECONDS', args.destroy_seconds),
+                              ('APPLY_FAIL_RATE', args.apply_fail_rate),
+                              ('DESTROY_FAIL_RATE', args.destroy_fail_rate),
+                              ('APPLY_ERROR', args.apply_error),
+                              ('INSTANCE_FAIL_RATE', args.instance_fail_rate)]:
+            env["BENCH_TF_%s" % name] = str(value)
+        (build_seconds, build_rss, build_rc) = run_script(
+            workspace, 'build.py', ['--workers', str(args.build_workers)], env, 'build.log')
+        (tree_seconds, cells_seconds, queued, cells) = scan_queue(workspace, job_store_file)
+        (run_seconds, run_rss, run_rc) = run_script(workspace, 'run.py', [], env, 'run.log')
+        job_store.configure({'job_store_file': job_store_file})
+        states = job_store.counts()
+        http_calls = report_counts(report_url)
+        total_calls = sum(http_calls.values())
+        result = {
+            'tests': queued,
+            'cells': cells,
+            'build_rc': build_rc,
+            'build_seconds': round(build_seconds, 3),
+            'build_tests_per_second': round(queued / max(build_seconds, 0.001), 1),
+            'build_peak_rss_mb': round(build_rss, 1),
+            'queue_tree_scan_seconds': round(tree_seconds, 3),
+            'queued_cells_seconds': round(cells_seconds, 4),
+            'run_rc': run_rc,
+            'run_seconds': round(run_seconds, 3),
+            'run_tests_per_second': round(queued / max(run_seconds, 0.001), 1),
+            'run_peak_rss_mb': round(run_rss, 1),
+            'states': states,
+            'http_calls': http_calls,
+            'http_calls_per_test': round(total_calls / float(max(queued, 1)), 2)
+        }
+        output.write("%s\n" % json.dumps(result, sort_keys=True))
+        output.flush()
+        return result
+    finally:
+        report_service.terminate()
+        report_service.wait()
+        if args.keep_workspace:
+            print("workspace kept in %s" % workspace)
+        else:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+
+def summarize(results):
+    print("%8s %10s %10s %10s %10s %10s %10s %10s %10s" %
+          ('tests', 'build t/s', 'build MB', 'tree scan', 'cells', 'run t/s', 'run MB',
+           'errored', 'http/test'))
+    for result in results:
+        print("%8d %10.1f %10.1f %9.3fs %9.4fs %10.1f %10.1f %10d %10.2f" %
+              (result['tests'], result['build_tests_per_second'], result['build_peak_rss_mb'],
+               result['queue_tree_scan_seconds'], result['queued_cells_seconds'],
+               result['run_tests_per_second'], result['run_peak_rss_mb'],
+               result['states'].get(job_store.ERRORED, 0), result['http_calls_per_test']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark build.py and run.py against stub terraform and report services')
+    parser.add_argument('--tests', type=int, nargs='+', default=[1000],
+                        help='test counts to benchmark, rounded up to fill every zone, image and template type')
+    parser.add_argument('--zones', type=int, default=12, help='zones from sample-builder-config.json to use')
+    parser.add_argument('--concurrency', type=int, default=200, help='runner thread_pool_size and phase_concurrency')
+    parser.add_argument('--build-workers', type=int, default=1, help='build.py --workers')
+    parser.add_argument('--init-seconds', type=float, default=0.0, help='stub terraform init time')
+    parser.add_argument('--apply-seconds', type=float, default=0.0, help='stub terraform apply time')
+    parser.add_argument('--destroy-seconds', type=float, default=0.0, help='stub terraform destroy time')
+    parser.add_argument('--apply-fail-rate', type=float, default=0.0, help='fraction of stub applies which fail')
+    parser.add_argument('--apply-error', default='stub apply failure',
+                        help='error message of failed stub applies, for example "429 Too Many Requests"')
+    parser.add_argument('--instance-fail-rate', type=float, default=0.0,
+                        help='fraction of stub applies whose instance is reported failed')
+    parser.add_argument('--destroy-fail-rate', type=float, default=0.0, help='fraction of stub destroys which fail')
+    parser.add_argument('--completion-delay', type=float, default=0.0,
+                        help='seconds after apply before the stub report service reports success')
+    parser.add_argument('--report-request-frequency', type=float, default=1.0, help='runner report poll interval')
+    parser.add_argument('--test-timeout', type=int, default=600, help='runner test_timeout')
+    parser.add_argument('--runner-config', help='JSON object of runners-config.json settings to override')
+    parser.add_argument('--keep-workspace', action='store_true', help='keep each workspace and its logs')
+    parser.add_argument('--output', default='-', help='file for the JSON lines results, default stdout')
+    args = parser.parse_args()
+    output = sys.stdout
+    if args.output != '-':
+        output = open(args.output, 'w')
+    try:
+        results = [bench(tests, args, output) for tests in args.tests]
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    summarize(results)
+
+
+if __name__ == "__main__":
+    main()
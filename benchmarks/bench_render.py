@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+# coding=utf-8
+# pylint: disable=broad-except,unused-argument,line-too-long, unused-variable
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Micro-benchmark of test variable rendering in build.py. Compares the
+# per-variable if cascade the builder used to run for every test against the
+# compiled per cell renderer. No files are written, only rendering is timed.
+#
+#   python3 benchmarks/bench_render.py [number_of_tests]
+#
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))
+
+import build  # noqa: E402
+
+ZONE = 'us-south-1'
+IMAGE = 'bigip-15-1-0-4-0-0-6-all-1slot-us-south-1'
+TEMP_TYPE = 'tmos_multi_nic'
+TEMPLATE = "%s/%s.tar.gz" % (build.TEMPLATE_DIR, TEMP_TYPE)
+PRE_RESOLVED_VARIABLES = ['tmos_image_id', 'ssh_key_id', 'instance_profile_id',
+                          'management_vpc_id', 'management_resource_group_id',
+                          'management_zone']
+
+ZONE_RESOURCES = {
+    ZONE: {
+        'ssh_key_name': {'value': 'test-key'},
+        'f5_management_id': {'value': '0717-management'},
+        'f5_cluster_id': {'value': '0717-cluster'},
+        'f5_internal_id': {'value': '0717-internal'},
+        'f5_external_id': {'value': '0717-external'}
+    }
+}
+
+CONFIG = {
+    'api_key': 'benchmark-api-key',
+    'report_service_base_url': 'http://127.0.0.1:8080',
+    'profile_selection': {
+        'all-1slot': 'cx2-4x8',
+        'ltm-1slot': 'cx2-2x4'
+    },
+    'zone_security_groups': {ZONE: 'r006-benchmark'},
+    'zone_license_hosts': {
+        ZONE: {
+            'license_host': '10.0.0.10',
+            'license_username': 'admin',
+            'license_password': 'admin',
+            'license_pool': 'TESTELA',
+            'license_sku_keyword_1': 'BT',
+            'license_sku_keyword_2': '1G',
+            'license_unit_of_measure': 'hourly'
+        }
+    }
+}
+
+
+def legacy_render(zone, image, temp_type, license_type, zone_resources, var_template, test_id, license):
+    # the per test if cascade build_utility() and build_byol() used to run
+    config = build.CONFIG
+    size = ''
+    for sstr in config['profile_selection']:
+        if image.find(sstr) > 0:
+            size = config['profile_selection'][sstr]
+    var_tf_content = "%s = \"%s\"\n" % ('test_type', temp_type)
+    var_to_write = {'test_type': temp_type}
+    var_to_write['zone'] = zone
+    var_to_write['template_type'] = temp_type
+    var_to_write['license_type'] = license_type
+    var_tf_content += "license_type = \"%s\"\n" % license_type
+    if license_type == 'utilitypool':
+        for lv in ['license_host', 'license_username', 'license_password',
+                   'license_pool', 'license_sku_keyword_1', 'license_unit_of_measure']:
+            var_to_write[lv] = config['zone_license_hosts'][zone][lv]
+            var_tf_content += "%s = \"%s\"\n" % (lv, config['zone_license_hosts'][zone][lv])
+        if config['zone_license_hosts'][zone]['license_sku_keyword_2']:
+            var_to_write['license_sku_keyword_2'] = config['zone_license_hosts'][zone]['license_sku_keyword_2']
+            var_tf_content += "license_sku_keyword_2 = \"%s\"\n" % config['zone_license_hosts'][zone]['license_sku_keyword_2']
+    for v in var_template:
+        if v['test_variable'] == 'api_key':
+            var_to_write[v['variable_name']] = config['api_key']
+            var_tf_content += "%s = \"%s\"\n" % (v['variable_name'], config['api_key'])
+        if v['test_variable'] == 'region':
+            var_to_write[v['variable_name']] = build.region_from_zone(zone)
+            var_tf_content += "%s = \"%s\"\n" % (v['variable_name'], build.region_from_zone(zone))
+        if v['test_variable'] == 'test_id':
+            var_to_write[v['variable_name']] = "t-%s" % test_id
+            var_tf_content += "%s = \"%s\"\n" % (v['variable_name'], "t-%s" % test_id)
+        if v['test_variable'] == 'image_name':
+            var_to_write[v['variable_name']] = image
+            var_tf_content += "%s = \"%s\"\n" % (v['variable_name'], image)
+        if v['test_variable'] == 'size':
+            var_to_write[v['variable_name']] = size
+            var_tf_content += "%s = \"%s\"\n" % (v['variable_name'], size)
+        if license_type == 'byol' and v['test_variable'] == 'byol_license_basekey':
+            var_to_write[v['variable_name']] = license
+            var_tf_content += "%s = \"%s\"\n" % (v['variable_name'], license)
+        if v['test_variable'] == 'admin_password':
+            var_to_write[v['variable_name']] = 'f5C0nfig'
+            var_tf_content += "%s = \"%s\"\n" % (v['variable_name'], 'f5C0nfig')
+        if v['test_variable'] == 'ssh_key_name':
+            var_to_write[v['variable_name']] = zone_resources[zone]['ssh_key_name']['value']
+            var_tf_content += "%s = \"%s\"\n" % (v['variable_name'], zone_resources[zone]['ssh_key_name']['value'])
+        if v['test_variable'] == 'f5_management_id':
+            var_to_write[v['variable_name']] = zone_resources[zone]['f5_management_id']['value']
+            var_tf_content += "%s = \"%s\"\n" % (v['variable_name'], zone_resources[zone]['f5_management_id']['value'])
+        if v['test_variable'] == 'f5_cluster_id':
+            var_to_write[v['variable_name']] = zone_resources[zone]['f5_cluster_id']['value']
+            var_tf_content += "%s = \"%s\"\n" % (v['variable_name'], zone_resources[zone]['f5_cluster_id']['value'])
+        if v['test_variable'] == 'f5_internal_id':
+            var_to_write[v['variable_name']] = zone_resources[zone]['f5_internal_id']['value']
+            var_tf_content += "%s = \"%s\"\n" % (v['variable_name'], zone_resources[zone]['f5_internal_id']['value'])
+        if v['test_variable'] == 'f5_external_id':
+            var_to_write[v['variable_name']] = zone_resources[zone]['f5_external_id']['value']
+            var_tf_content += "%s = \"%s\"\n" % (v['variable_name'], zone_resources[zone]['f5_external_id']['value'])
+        if v['test_variable'] == 'report_finish_url':
+            var_to_write[v['variable_name']] = "%s/stop/%s" % (config['report_service_base_url'], test_id)
+            var_tf_content += "%s = \"%s\"\n" % (v['variable_name'], "%s/stop/%s" % (config['report_service_base_url'], test_id))
+        if v['test_variable'] == 'f5_hardcoded_sg':
+            var_to_write[v['variable_name']] = config['zone_security_groups'][zone]
+            var_tf_content += "%s = \"%s\"\n" % (v['variable_name'], config['zone_security_groups'][zone])
+    return (var_to_write, var_tf_content)
+
+
+def bench(label, count, render_one):
+    start = time.perf_counter()
+    for _ in range(count):
+        (var_to_write, var_tf_content) = render_one()
+        json.dumps(var_to_write, sort_keys=True, indent=4, separators=(',', ': '))
+    duration = time.perf_counter() - start
+    print("%-28s %8d tests %8.3f s %12.0f tests/s" %
+          (label, count, duration, count / duration))
+    return count / duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark test variable rendering')
+    parser.add_argument('tests', type=int, nargs='?', default=20000, help='tests rendered for each renderer')
+    args = parser.parse_args()
+    count = args.tests
+    build.CONFIG = CONFIG
+    # the legacy cascade predates the ids pre-resolved by data_sources
+    var_template = [v for v in build.load_var_template(TEMPLATE)
+                    if v['test_variable'] not in PRE_RESOLVED_VARIABLES]
+    test_ids = [str(uuid.uuid4()) for _ in range(count)]
+    for license_type in ['utilitypool', 'byol']:
+        license = 'AAAAA-BBBBB-CCCCC-DDDDD-EEEEEEE' if license_type == 'byol' else ''
+        render = build.compile_renderer(
+            ZONE, IMAGE, TEMP_TYPE, license_type, ZONE_RESOURCES, var_template)
+        if legacy_render(ZONE, IMAGE, TEMP_TYPE, license_type, ZONE_RESOURCES, var_template, test_ids[0], license) != \
+                render(test_ids[0], license):
+            print('renderer output differs from legacy output for %s' % license_type)
+            sys.exit(1)
+        ids = iter(test_ids)
+        before = bench("%s legacy cascade" % license_type, count,
+                       lambda: legacy_render(ZONE, IMAGE, TEMP_TYPE, license_type,
+                                             ZONE_RESOURCES, var_template, next(ids), license))
+        ids = iter(test_ids)
+        after = bench("%s compiled renderer" % license_type, count,
+                      lambda: render(next(ids), license))
+        print("%-28s %.2fx" % ("%s speedup" % license_type, after / before))
+
+
+if __name__ == "__main__":
+    main()
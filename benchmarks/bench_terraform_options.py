@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+# coding=utf-8
+# pylint: disable=broad-except,unused-argument,line-too-long, unused-variable
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Times terraform init, apply and destroy of a built test for each set of
+# per phase terraform_options. Every run works on a copy of the test
+# directory with its own test_id, so concurrent runs do not create clashing
+# instances, and uses run.py's terraform calls, so the command lines are the
+# ones the runner would use. Against the real terraform this creates and
+# destroys cloud resources for every run.
+#
+#   python3 benchmarks/bench_terraform_options.py benchmarks/terraform_option_sets.json \
+#       [--test-dir queued_tests/<zone>/<image>/<type>/<test_id>] [--runs 3] \
+#       [--concurrency 1] [--output results.jsonl]
+#
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import asyncio
+import argparse
+import tempfile
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))
+
+import run  # noqa: E402
+import plugin_cache  # noqa: E402
+
+PHASES = ['init', 'apply', 'destroy']
+
+
+def find_test_dir():
+    for (root, dirs, files) in os.walk(run.QUEUE_DIR):
+        if 'test_vars.tfvars' in files:
+            return root
+    return None
+
+
+async def timed(command, test_dir):
+    start = time.time()
+    (rc, out, err) = await command(test_dir)
+    return (rc, time.time() - start, err)
+
+
+def copy_test_dir(test_dir, run_dir):
+    # each copy gets its own test_id, the instance is named after it and
+    # concurrent runs would otherwise create clashing cloud resources
+    shutil.copytree(test_dir, run_dir, ignore=shutil.ignore_patterns(
+        '.terraform', 'terraform.tfstate*'))
+    test_id = os.path.basename(os.path.normpath(test_dir))
+    run_test_id = str(uuid.uuid4())
+    for var_file in ['test_vars.tfvars', 'test_vars.json']:
+        var_path = os.path.join(run_dir, var_file)
+        if os.path.exists(var_path):
+            with open(var_path, 'r') as vf:
+                content = vf.read()
+            with open(var_path, 'w') as vf:
+                vf.write(content.replace(test_id, run_test_id))
+    return run_test_id
+
+
+async def run_once(option_set, test_dir, workspace, index):
+    run_dir = os.path.join(workspace, "%s-%d" % (option_set['name'], index))
+    run_test_id = copy_test_dir(test_dir, run_dir)
+    result = {'option_set': option_set['name'], 'run': index, 'test_id': run_test_id}
+    try:
+        for (phase, command) in [('init', run.tf_init), ('apply', run.tf_apply), ('destroy', run.tf_destroy)]:
+            (rc, duration, err) = await timed(command, run_dir)
+            result["%s_seconds" % phase] = duration
+            result["%s_rc" % phase] = rc
+            if rc > 0:
+                result['error'] = err.strip().splitlines()[-1] if err.strip() else ''
+                if phase == 'apply':
+                    # clean up whatever the failed apply created
+                    await run.tf_destroy(run_dir)
+                break
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+    return result
+
+
+async def bench_set(option_set, test_dir, workspace, runs, concurrency, output):
+    # run.py reads terraform_options from its CONFIG for every call
+    run.CONFIG['terraform_options'] = option_set['options']
+    limit = asyncio.Semaphore(concurrency)
+
+    async def limited(index):
+        async with limit:
+            return await run_once(option_set, test_dir, workspace, index)
+
+    results = await asyncio.gather(*[limited(index) for index in range(runs)])
+    for result in results:
+        output.write("%s\n" % json.dumps(result, sort_keys=True))
+    output.flush()
+    return results
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(option_set, results):
+    for phase in PHASES:
+        durations = [r["%s_seconds" % phase] for r in results
+                     if r.get("%s_rc" % phase) == 0]
+        failures = len([r for r in results if r.get("%s_rc" % phase, 0) > 0])
+        if not durations:
+            print("%-24s %-8s %4d ok %4d failed" % (option_set['name'], phase, 0, failures))
+            continue
+        print("%-24s %-8s %4d ok %4d failed %8.2f mean %8.2f p50 %8.2f p90 seconds" %
+              (option_set['name'], phase, len(durations), failures,
+               sum(durations) / len(durations), percentile(durations, 0.5),
+               percentile(durations, 0.9)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark terraform options per phase')
+    parser.add_argument('option_sets', help='JSON list of {"name": ..., "options": {"init": {}, "apply": {}, "destroy": {}}}')
+    parser.add_argument('--test-dir', help='built test directory to copy, default the first queued test')
+    parser.add_argument('--config', default=run.CONFIG_FILE, help='runners-config.json to read the plugin cache settings from')
+    parser.add_argument('--runs', type=int, default=3, help='runs for each option set')
+    parser.add_argument('--concurrency', type=int, default=1, help='runs at once')
+    parser.add_argument('--output', default='-', help='file for the JSON lines results, default stdout')
+    args = parser.parse_args()
+    with open(args.option_sets, 'r') as osf:
+        option_sets = json.load(osf)
+    test_dir = args.test_dir or find_test_dir()
+    if not test_dir:
+        print('no built test found, run build.py or pass --test-dir')
+        sys.exit(1)
+    if os.path.exists(args.config):
+        with open(args.config, 'r') as cf:
+            run.CONFIG = json.load(cf)
+        plugin_cache.configure(run.CONFIG)
+    output = sys.stdout
+    if args.output != '-':
+        output = open(args.output, 'w')
+    workspace = tempfile.mkdtemp(prefix='bench_terraform_options_')
+    try:
+        summaries = []
+        for option_set in option_sets:
+            results = asyncio.run(bench_set(option_set, test_dir, workspace,
+                                            args.runs, args.concurrency, output))
+            summaries.append((option_set, results))
+        for (option_set, results) in summaries:
+            summarize(option_set, results)
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+# coding=utf-8
+# pylint: disable=broad-except,unused-argument,line-too-long, unused-variable
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Local stand in for the report service used by the harness benchmarks.
+# It answers the calls report_client makes:
+#
+#   POST /start/<test_id>, PUT /report/<test_id>, POST /stop/<test_id>,
+#   GET /report/<test_id> and GET /report
+#
+# A test reports success --completion-delay seconds after its terraform
+# apply is recorded by PUT /report, as if the instance phoned home.
+# GET /counts returns the number of requests to each endpoint.
+#
+#   python3 benchmarks/stubs/report_service.py --port 8080 [--completion-delay 1]
+#
+import sys
+import json
+import time
+import threading
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPORTS = {}
+COUNTS = {}
+LOCK = threading.Lock()
+COMPLETION_DELAY = 0.0
+
+
+def complete_due(report, now):
+    if report['duration'] == 0 and 'complete_at' in report and now >= report['complete_at']:
+        report['duration'] = now - report['started_at']
+        report['results'] = {'status': 'SUCCESS'}
+
+
+def public(report):
+    return dict((key, value) for (key, value) in report.items() if key != 'complete_at')
+
+
+class ReportHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        return
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        try:
+            return json.loads(body.decode('utf-8') or '{}')
+        except ValueError:
+            return {}
+
+    def respond(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self):
+        parts = self.path.split('?')[0].strip('/').split('/')
+        with LOCK:
+            key = "%s /%s" % (self.command, parts[0])
+            if parts[0] != 'counts':
+                COUNTS[key] = COUNTS.get(key, 0) + 1
+        return (parts[0], parts[1] if len(parts) > 1 else None)
+
+    def do_POST(self):
+        (endpoint, test_id) = self.route()
+        data = self.read_body()
+        now = time.time()
+        with LOCK:
+            if endpoint == 'start' and test_id:
+                REPORTS[test_id] = {'test_id': test_id, 'started_at': now, 'duration': 0, 'results': {}}
+                REPORTS[test_id].update(data)
+            elif endpoint == 'stop' and test_id:
+                report = REPORTS.setdefault(test_id, {'test_id': test_id, 'started_at': now, 'duration': 0})
+                report['results'] = data
+                report['duration'] = max(now - report['started_at'], 0.001)
+            else:
+                return self.respond(404, {})
+        self.respond(200, {})
+
+    def do_PUT(self):
+        (endpoint, test_id) = self.route()
+        data = self.read_body()
+        if endpoint != 'report' or not test_id:
+            return self.respond(404, {})
+        with LOCK:
+            report = REPORTS.setdefault(test_id, {'test_id': test_id, 'started_at': time.time(), 'duration': 0, 'results': {}})
+            report.update(data)
+            if data.get('terraform_apply_result_code') == 0:
+                report['complete_at'] = time.time() + COMPLETION_DELAY
+        self.respond(200, {})
+
+    def do_GET(self):
+        (endpoint, test_id) = self.route()
+        now = time.time()
+        if endpoint == 'counts':
+            with LOCK:
+                return self.respond(200, dict(COUNTS))
+        if endpoint != 'report':
+            return self.respond(404, {})
+        with LOCK:
+            if test_id:
+                if test_id not in REPORTS:
+                    return self.respond(404, {})
+                complete_due(REPORTS[test_id], now)
+                return self.respond(200, public(REPORTS[test_id]))
+            reports = {}
+            for (report_id, report) in REPORTS.items():
+                complete_due(report, now)
+                reports[report_id] = public(report)
+        self.respond(200, reports)
+
+
+def main():
+    global COMPLETION_DELAY
+    parser = argparse.ArgumentParser(description='stub report service for benchmarks')
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--completion-delay', type=float, default=0.0,
+                        help='seconds after a successful apply before a test reports success')
+    args = parser.parse_args()
+    COMPLETION_DELAY = args.completion_delay
+    server = ThreadingHTTPServer((args.address, args.port), ReportHandler)
+    server.daemon_threads = True
+    sys.stdout.write("stub report service listening on %s:%d\n" % (args.address, args.port))
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
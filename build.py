@@ -20,6 +20,7 @@ import os
 import sys
 import shutil
 import math
+import re
 import glob
 import json
 import logging
@@ -27,6 +28,12 @@ import datetime
 import time
 import tarfile
 import uuid
+import threading
+import hashlib
+import argparse
+import concurrent.futures
+import job_store
+import data_sources
 
 LOG = logging.getLogger('ibmcloud_test_harness_build')
 LOG.setLevel(logging.DEBUG)
@@ -40,30 +47,100 @@ SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
 TEMPLATE_DIR = "%s/templates" % SCRIPT_DIR
 QUEUE_DIR = "%s/queued_tests" % SCRIPT_DIR
+TEMPLATE_CACHE_DIR = "%s/template_cache" % SCRIPT_DIR
 
 CONFIG_FILE = "%s/builder-config.json" % SCRIPT_DIR
 CONFIG = {}
+VAR_TEMPLATES = {}
+EXTRACTED_TEMPLATES = {}
+RENDERERS = {}
+ZONE_RESOURCES = {}
+IMAGES_CATALOG = {}
+LICENSE_INDEX = None
+
+# test directories are written under this suffix and renamed into
+# place once their licenses are journaled and they are in the job store
+PARTIAL_SUFFIX = '.partial'
+
+
+def license_journal():
+    return "%s.consumed" % CONFIG['license_file']
+
+
+def load_consumed_ranges():
+    # journal entries are the byte range "<start> <end>" of the keys used
+    # by one build unit. A single offset is the end of a range from 0.
+    ranges = []
+    if os.path.exists(license_journal()):
+        with open(license_journal(), 'r') as jf:
+            for line in jf:
+                fields = line.split()
+                # ignore a partial entry left by an interrupted append
+                if not line.endswith('\n') or not fields or not all(field.isdigit() for field in fields):
+                    continue
+                if len(fields) == 1:
+                    ranges.append((0, int(fields[0])))
+                else:
+                    ranges.append((int(fields[0]), int(fields[1])))
+    return sorted(ranges)
+
+
+def load_license_index():
+    # licenses.txt is indexed once. Consumed keys are not removed from it,
+    # instead the byte range of the keys each build unit used is appended
+    # to an fsync'ed journal once its tests are written, so a killed build
+    # neither burns nor reissues keys.
+    global LICENSE_INDEX
+    if LICENSE_INDEX is None:
+        ranges = load_consumed_ranges()
+        # skip the consumed prefix of the file without reading it
+        cursor = 0
+        for (start, end) in ranges:
+            if start > cursor:
+                break
+            cursor = max(cursor, end)
+        ranges = [(start, end) for (start, end) in ranges if end > cursor]
+        keys = []
+        offsets = []
+        if os.path.exists(CONFIG['license_file']):
+            with open(CONFIG['license_file'], 'rb') as lf:
+                lf.seek(cursor)
+                offset = cursor
+                for line in lf:
+                    start = offset
+                    offset = offset + len(line)
+                    if len(line) < 5 or not line.strip():
+                        continue
+                    if any(start >= rstart and start < rend for (rstart, rend) in ranges):
+                        continue
+                    keys.append(line.strip().decode('utf-8'))
+                    offsets.append((start, offset))
+        LICENSE_INDEX = {'keys': keys, 'offsets': offsets, 'next': 0}
+    return LICENSE_INDEX
 
 
 def licenses_available():
-    if os.path.exists(CONFIG['license_file']):
-        return sum(1 for line in open(CONFIG['license_file']))
-
-
-def get_license():
-    if os.path.exists(CONFIG['license_file']) and \
-       os.stat(CONFIG['license_file']).st_size > 0:
-        with open(CONFIG['license_file'], 'r+') as f:
-            firstLine = f.readline()
-            while len(firstLine) < 5:
-                firstLine = f.readline()
-            data = f.read()
-            f.seek(0)
-            f.write(data)
-            f.truncate()
-        return firstLine.strip()
-    else:
-        return ''
+    index = load_license_index()
+    return len(index['keys']) - index['next']
+
+
+def checkout_licenses(count):
+    # reserve the next count keys, returns them and the byte range to
+    # pass to journal_licenses() once the tests using them are written
+    index = load_license_index()
+    first = index['next']
+    licenses = index['keys'][first:first + count]
+    if not licenses:
+        return (licenses, None)
+    index['next'] = first + len(licenses)
+    return (licenses, (index['offsets'][first][0], index['offsets'][index['next'] - 1][1]))
+
+
+def journal_licenses(license_range):
+    with open(license_journal(), 'a') as jf:
+        jf.write("%d %d\n" % license_range)
+        jf.flush()
+        os.fsync(jf.fileno())
 
 
 def region_from_zone(zone):
@@ -80,323 +157,423 @@ def get_template_types():
     return templates
 
 
-def build_utility():
-    zone_resources = {}
-    with open(CONFIG['zone_resources_file'], 'r') as zrf:
-        zone_resources = json.load(zrf)
-    zones = os.listdir(QUEUE_DIR)
-    test_map = {}
-    for zone in zones:
-        if zone in CONFIG['active_zones']:
-            if not zone in test_map:
-                test_map[zone] = {'test_count': 0}
-    number_of_active_zones = len(test_map)
+def get_profile_size(image):
+    size = ''
+    for sstr in CONFIG['profile_selection']:
+        if image.find(sstr) > 0:
+            size = CONFIG['profile_selection'][sstr]
+    return size
+
+
+def global_ssh_key():
+    if 'global_ssh_key' in CONFIG and CONFIG['global_ssh_key']:
+        return CONFIG['global_ssh_key']
+    return None
+
+
+def extracted_template(template):
+    # unpack each template tarball once, keyed by its path, size and mtime,
+    # and populate test directories from the extracted copy
+    tstat = os.stat(template)
+    key = (os.path.realpath(template), tstat.st_size, tstat.st_mtime_ns)
+    if key not in EXTRACTED_TEMPLATES:
+        template_name = os.path.basename(template).split('.')[0]
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[0:12]
+        cache_dir = os.path.join(TEMPLATE_CACHE_DIR, "%s-%s" %
+                                 (template_name, digest))
+        if not os.path.exists(cache_dir):
+            os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+            # only earlier extracts of this template, never another template
+            # sharing its prefix or a builder's in progress <dir>.<pid>
+            stale_pattern = re.compile(r'^%s-[0-9a-f]{12}$' % re.escape(template_name))
+            for stale in os.listdir(TEMPLATE_CACHE_DIR):
+                if stale_pattern.match(stale):
+                    shutil.rmtree(os.path.join(TEMPLATE_CACHE_DIR, stale), ignore_errors=True)
+            extract_dir = "%s.%d" % (cache_dir, os.getpid())
+            LOG.info('extracting template %s to %s', template, cache_dir)
+            with tarfile.open(template) as test_archive:
+                test_archive.extractall(extract_dir)
+            try:
+                os.rename(extract_dir, cache_dir)
+            except OSError:
+                # another builder extracted the same template first
+                shutil.rmtree(extract_dir, ignore_errors=True)
+        EXTRACTED_TEMPLATES[key] = cache_dir
+    return EXTRACTED_TEMPLATES[key]
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def populate_test_dir(template, test_dir):
+    shutil.copytree(extracted_template(template), test_dir,
+                    copy_function=link_or_copy)
+
+
+def load_var_template(template):
+    if template not in VAR_TEMPLATES:
+        with open(os.path.join(extracted_template(template), 'variables.json'), 'r') as vj:
+            VAR_TEMPLATES[template] = json.load(vj)
+    return VAR_TEMPLATES[template]
+
+
+def cell_ssh_key_name(cell):
+    return global_ssh_key() or cell['zone_resources'][cell['zone']]['ssh_key_name']['value']
+
+
+def management_subnet_lookup(cell, kind):
+    # the subnet's VPC, resource group and zone are used together
+    subnet_id = cell['zone_resources'][cell['zone']]['f5_management_id']['value']
+    region = region_from_zone(cell['zone'])
+    for subnet_kind in ['subnet_vpc', 'subnet_resource_group', 'subnet_zone']:
+        if not data_sources.lookup(region, subnet_kind, subnet_id):
+            return ''
+    return data_sources.lookup(region, kind, subnet_id)
+
+
+# test_variable resolvers which only depend on the (zone, image, template type)
+# cell. These are evaluated once when the cell renderer is compiled.
+CELL_RESOLVERS = {
+    'api_key': lambda cell: CONFIG['api_key'],
+    'region': lambda cell: region_from_zone(cell['zone']),
+    'image_name': lambda cell: cell['image'],
+    'size': lambda cell: get_profile_size(cell['image']),
+    'admin_password': lambda cell: 'f5C0nfig',
+    'ssh_key_name': lambda cell: cell['zone_resources'][cell['zone']]['ssh_key_name']['value'],
+    'f5_management_id': lambda cell: cell['zone_resources'][cell['zone']]['f5_management_id']['value'],
+    'f5_cluster_id': lambda cell: cell['zone_resources'][cell['zone']]['f5_cluster_id']['value'],
+    'f5_internal_id': lambda cell: cell['zone_resources'][cell['zone']]['f5_internal_id']['value'],
+    'f5_external_id': lambda cell: cell['zone_resources'][cell['zone']]['f5_external_id']['value'],
+    'f5_hardcoded_sg': lambda cell: CONFIG['zone_security_groups'][cell['zone']],
+    # ids pre-resolved by data_sources, empty when the template should look them up
+    'tmos_image_id': lambda cell: data_sources.lookup(region_from_zone(cell['zone']), 'image', cell['image']),
+    'ssh_key_id': lambda cell: data_sources.lookup(region_from_zone(cell['zone']), 'ssh_key', cell_ssh_key_name(cell)),
+    'instance_profile_id': lambda cell: data_sources.lookup(region_from_zone(cell['zone']), 'instance_profile', get_profile_size(cell['image'])),
+    'management_vpc_id': lambda cell: management_subnet_lookup(cell, 'subnet_vpc'),
+    'management_resource_group_id': lambda cell: management_subnet_lookup(cell, 'subnet_resource_group'),
+    'management_zone': lambda cell: management_subnet_lookup(cell, 'subnet_zone')
+}
+
+
+def report_finish_url(test_id, license):
+    # instances phone home to the runner's relay when one is
+    # configured, it forwards the results to the report service
+    base_url = CONFIG['report_service_base_url']
+    if 'phone_home_relay_url' in CONFIG and CONFIG['phone_home_relay_url']:
+        base_url = CONFIG['phone_home_relay_url']
+    return "%s/stop/%s" % (base_url, test_id)
+
+
+# test_variable resolvers which change for every test in a cell.
+TEST_RESOLVERS = {
+    'test_id': lambda test_id, license: "t-%s" % test_id,
+    'report_finish_url': report_finish_url,
+    'byol_license_basekey': lambda test_id, license: license
+}
+
+
+def license_variables(zone, license_type):
+    license_vars = [('license_type', license_type)]
+    if license_type == 'utilitypool':
+        license_host = CONFIG['zone_license_hosts'][zone]
+        for lv in ['license_host', 'license_username', 'license_password',
+                   'license_pool', 'license_sku_keyword_1', 'license_unit_of_measure']:
+            license_vars.append((lv, license_host[lv]))
+        if license_host['license_sku_keyword_2']:
+            license_vars.append(
+                ('license_sku_keyword_2', license_host['license_sku_keyword_2']))
+    return license_vars
+
+
+def compile_renderer(zone, image, temp_type, license_type, zone_resources, var_template):
+    cell = {
+        'zone': zone,
+        'image': image,
+        'zone_resources': zone_resources
+    }
+    static_vars = {
+        'test_type': temp_type,
+        'zone': zone,
+        'template_type': temp_type
+    }
+    # tfvars segments are either a pre-rendered line or a
+    # (variable_name, resolver) pair filled in for each test
+    segments = ["%s = \"%s\"\n" % ('test_type', temp_type)]
+    header = license_variables(zone, license_type)
+    ssh_key = global_ssh_key()
+    if ssh_key:
+        header.append(('ssh_key_name', ssh_key))
+    for (name, value) in header:
+        static_vars[name] = value
+        segments.append("%s = \"%s\"\n" % (name, value))
+    for v in var_template:
+        tv = v['test_variable']
+        if tv == 'ssh_key_name' and ssh_key:
+            continue
+        if tv == 'byol_license_basekey' and license_type != 'byol':
+            continue
+        if tv in CELL_RESOLVERS:
+            value = CELL_RESOLVERS[tv](cell)
+            static_vars[v['variable_name']] = value
+            segments.append("%s = \"%s\"\n" % (v['variable_name'], value))
+        elif tv in TEST_RESOLVERS:
+            segments.append((v['variable_name'], TEST_RESOLVERS[tv]))
+
+    def render(test_id, license=''):
+        var_to_write = dict(static_vars)
+        var_tf_content = []
+        for segment in segments:
+            if isinstance(segment, str):
+                var_tf_content.append(segment)
+            else:
+                value = segment[1](test_id, license)
+                var_to_write[segment[0]] = value
+                var_tf_content.append("%s = \"%s\"\n" % (segment[0], value))
+        return (var_to_write, ''.join(var_tf_content))
+
+    return render
+
+
+def create_test(temp_dir, template, render, test_id, license='', dir_name=None):
+    test_dir = os.path.join(temp_dir, dir_name or test_id)
+    populate_test_dir(template, test_dir)
+    (var_to_write, var_tf_content) = render(test_id, license)
+    with open(os.path.join(test_dir, 'test_vars.json'), 'w') as vj:
+        vj.write(json.dumps(
+            var_to_write, sort_keys=True, indent=4, separators=(',', ': ')))
+    with open(os.path.join(test_dir, 'test_vars.tfvars'), 'w') as vtf:
+        vtf.write(var_tf_content)
+    return test_dir
+
+
+def get_renderer(zone, image, temp_type, license_type):
+    key = (zone, image, temp_type)
+    if key not in RENDERERS:
+        template = "%s/%s.tar.gz" % (TEMPLATE_DIR, temp_type)
+        RENDERERS[key] = compile_renderer(
+            zone, image, temp_type, license_type, ZONE_RESOURCES,
+            load_var_template(template))
+    return RENDERERS[key]
+
+
+def image_eligible(image):
+    for match in CONFIG['active_images']:
+        if image.find(match) > 0:
+            return True
+    return False
+
+
+def base_image(image, zone):
+    if image.endswith(zone):
+        return image[0:-(len(zone)+1)]
+    return image
+
+
+def build_unit(unit):
+    # a unit holds every test for one (zone, image). test_ids are derived
+    # from the unit namespace so each worker allocates them deterministically
+    zone = unit['zone']
+    image = unit['image']
+    namespace = uuid.UUID(unit['namespace'])
+    license_host = None
+    if unit['license_type'] == 'utilitypool':
+        license_host = CONFIG['zone_license_hosts'][zone]['license_host']
+    license_ranges = unit['license_ranges'] or [None] * len(unit['tests'])
+    created = []
+    for ((temp_type, licenses), license_range) in zip(unit['tests'], license_ranges):
+        temp_dir = os.path.join(QUEUE_DIR, zone, image, temp_type)
+        template = "%s/%s.tar.gz" % (TEMPLATE_DIR, temp_type)
+        render = get_renderer(zone, image, temp_type, unit['license_type'])
+        cell = []
+        for license in licenses:
+            test_id = str(uuid.uuid5(namespace, str(len(created) + len(cell))))
+            create_test(temp_dir, template, render, test_id, license, test_id + PARTIAL_SUFFIX)
+            cell.append((test_id, zone, image, temp_type, license_host))
+        # a build killed before this point leaves only partial directories
+        # and unjournaled keys, after it finish_partial_tests() completes the cell
+        if license_range:
+            journal_licenses(license_range)
+        job_store.add_tests(cell)
+        for test in cell:
+            test_dir = os.path.join(temp_dir, test[0])
+            os.rename(test_dir + PARTIAL_SUFFIX, test_dir)
+            LOG.debug('created test: %s', test_dir)
+        created.extend(cell)
+    return created
+
+
+def finish_partial_tests():
+    # an interrupted build leaves partial test directories. Those whose cell
+    # reached the job store are renamed into place, the others are removed and
+    # their licenses, never journaled, are handed out again.
+    finished = 0
+    removed = 0
+    for partial_dir in glob.glob(os.path.join(QUEUE_DIR, '*', '*', '*', '*' + PARTIAL_SUFFIX)):
+        test_dir = partial_dir[0:-len(PARTIAL_SUFFIX)]
+        if job_store.get_test(os.path.basename(test_dir)):
+            os.rename(partial_dir, test_dir)
+            finished = finished + 1
+        else:
+            shutil.rmtree(partial_dir)
+            removed = removed + 1
+    if finished or removed:
+        LOG.info('finished %d and removed %d partially built tests', finished, removed)
+    return (finished, removed)
+
+
+def new_unit(zone, image, license_type):
+    return {
+        'zone': zone,
+        'image': image,
+        'license_type': license_type,
+        'namespace': str(uuid.uuid4()),
+        'tests': [],
+        'license_ranges': []
+    }
+
+
+def plan_utility():
+    units = []
     number_per_zone = CONFIG['utility_pool_tests_per_zone']
-    total_tests = 0
-    total_zones = 0
-    indexed_images = {}
-    test_per_zone = {}
-    for zone in zones:
+    for zone in os.listdir(QUEUE_DIR):
         if zone in CONFIG['active_zones']:
-            LOG.info('creating tests in zone: %s' % zone)
-            test_per_zone[zone] = {}
-            test_map[zone]['test_to_create'] = number_per_zone
             zone_dir = os.path.join(QUEUE_DIR, zone)
-            images = os.listdir(zone_dir)
-            total_zones = total_zones + 1
+            images = [image for image in os.listdir(zone_dir) if image_eligible(image)]
+            test_per_image = {}
+            test_per_base_image = {}
             adding_test = True
             while adding_test:
                 adding_test = False
                 for image in images:
-                    if image.endswith(zone):
-                        base_image_name = image[0:-(len(zone)+1)]
-                    else:
-                        base_image_name = image
-                    image_eligible = False
-                    for match in CONFIG['active_images']:
-                        if image.find(match) > 0:
-                            image_eligible = True
-                    if image_eligible:
-                        if base_image_name not in indexed_images:
-                            indexed_images[image[0:-(len(zone)+1)]] = True
-                        if base_image_name not in test_per_zone[zone]:
-                            test_per_zone[zone][base_image_name] = 0
-                        if test_per_zone[zone][base_image_name] < number_per_zone:
-                            test_per_zone[zone][base_image_name] = test_per_zone[zone][base_image_name] + 1
-                            adding_test = True
-                            LOG.debug('setting up test for image: %s in %s (%d)', image, zone, test_per_zone[zone][base_image_name])
-                            image_dir = os.path.join(zone_dir, image)
-                            size = ''
-                            for sstr in CONFIG['profile_selection']:
-                                if image.find(sstr) > 0:
-                                    size = CONFIG['profile_selection'][sstr]                     
-                            temp_types = os.listdir(image_dir)
-                            for temp_type in temp_types:
-                                temp_dir = os.path.join(image_dir, temp_type)
-                                template = "%s/%s.tar.gz" % (TEMPLATE_DIR,
-                                                            os.path.basename(temp_type))
-                                # LOG.debug('creating a test: %s - %s - %s', zone, image, temp_type)
-                                test_id = str(uuid.uuid4())
-                                test_dir = os.path.join(temp_dir, test_id)
-                                # LOG.info('creating test: %s' % test_dir)
-                                os.mkdir(test_dir)
-                                test_archive = tarfile.open(template)
-                                test_archive.extractall(test_dir)
-                                test_archive.close()
-                                var_template = {}
-                                with open(os.path.join(test_dir, 'variables.json'), 'r') as vj:
-                                    var_template = json.load(vj)
-                                var_json_file = os.path.join(
-                                    test_dir, 'test_vars.json')
-                                var_tf_file = os.path.join(
-                                    test_dir, 'test_vars.tfvars')
-                                var_tf_content = "%s = \"%s\"\n" % (
-                                    'test_type', temp_type)
-                                var_to_write = {'test_type': temp_type}
-                                var_to_write['zone'] = zone
-                                var_to_write['template_type'] = temp_type
-                                var_to_write['license_type'] = "utilitypool"
-                                var_tf_content += "license_type = \"utilitypool\"\n"
-                                var_to_write['license_host'] = CONFIG['zone_license_hosts'][zone]['license_host']
-                                var_tf_content += "license_host = \"%s\"\n" % CONFIG['zone_license_hosts'][zone]['license_host']
-                                var_to_write['license_username'] = CONFIG['zone_license_hosts'][zone]['license_username']
-                                var_tf_content += "license_username = \"%s\"\n" % CONFIG['zone_license_hosts'][zone]['license_username']
-                                var_to_write['license_password'] = CONFIG['zone_license_hosts'][zone]['license_password']
-                                var_tf_content += "license_password = \"%s\"\n" % CONFIG['zone_license_hosts'][zone]['license_password']
-                                var_to_write['license_pool'] = CONFIG['zone_license_hosts'][zone]['license_pool']
-                                var_tf_content += "license_pool = \"%s\"\n" % CONFIG['zone_license_hosts'][zone]['license_pool']
-                                var_to_write['license_sku_keyword_1'] = CONFIG['zone_license_hosts'][zone]['license_sku_keyword_1']
-                                var_tf_content += "license_sku_keyword_1 = \"%s\"\n" % CONFIG['zone_license_hosts'][zone]['license_sku_keyword_1']
-                                var_to_write['license_unit_of_measure'] = CONFIG['zone_license_hosts'][zone]['license_unit_of_measure']
-                                var_tf_content += "license_unit_of_measure = \"%s\"\n" % CONFIG['zone_license_hosts'][zone]['license_unit_of_measure']
-                                if CONFIG['zone_license_hosts'][zone]['license_sku_keyword_2']:
-                                    var_to_write['license_sku_keyword_2'] = CONFIG['zone_license_hosts'][zone]['license_sku_keyword_2']
-                                    var_tf_content += "license_sku_keyword_2 = \"%s\"\n" % CONFIG['zone_license_hosts'][zone]['license_sku_keyword_2']
-                                if 'global_ssh_key' in CONFIG and CONFIG['global_ssh_key']:
-                                    var_to_write['ssh_key_name'] = CONFIG['global_ssh_key']
-                                    var_tf_content += "ssh_key_name = \"%s\"\n" % CONFIG['global_ssh_key']
-                                    
-                                for v in var_template:
-                                    if v['test_variable'] == 'api_key':
-                                        var_to_write[v['variable_name']
-                                                    ] = CONFIG['api_key']
-                                        var_tf_content += "%s = \"%s\"\n" % (
-                                            v['variable_name'], CONFIG['api_key'])
-                                    if v['test_variable'] == 'region':
-                                        var_to_write[v['variable_name']
-                                                    ] = region_from_zone(zone)
-                                        var_tf_content += "%s = \"%s\"\n" % (
-                                            v['variable_name'], region_from_zone(zone))
-                                    if v['test_variable'] == 'test_id':
-                                        var_to_write[v['variable_name']
-                                                    ] = "t-%s" % test_id
-                                        var_tf_content += "%s = \"%s\"\n" % (
-                                            v['variable_name'], "t-%s" % test_id)
-                                    if v['test_variable'] == 'image_name':
-                                        var_to_write[v['variable_name']] = image
-                                        var_tf_content += "%s = \"%s\"\n" % (
-                                            v['variable_name'], image)
-                                    if v['test_variable'] == 'size':
-                                        var_to_write[v['variable_name']] = size
-                                        var_tf_content += "%s = \"%s\"\n" % (
-                                            v['variable_name'], size)
-                                    if v['test_variable'] == 'admin_password':
-                                        var_to_write[v['variable_name']
-                                                    ] = 'f5C0nfig'
-                                        var_tf_content += "%s = \"%s\"\n" % (
-                                            v['variable_name'], 'f5C0nfig')
-                                    if 'global_ssh_key' not in CONFIG or not CONFIG['global_ssh_key']:
-                                        if v['test_variable'] == 'ssh_key_name':
-                                            var_to_write[v['variable_name']
-                                                        ] = zone_resources[zone]['ssh_key_name']['value']
-                                            var_tf_content += "%s = \"%s\"\n" % (
-                                                v['variable_name'], zone_resources[zone]['ssh_key_name']['value'])
-                                    if v['test_variable'] == 'f5_management_id':
-                                        var_to_write[v['variable_name']
-                                                    ] = zone_resources[zone]['f5_management_id']['value']
-                                        var_tf_content += "%s = \"%s\"\n" % (
-                                            v['variable_name'], zone_resources[zone]['f5_management_id']['value'])
-                                    if v['test_variable'] == 'f5_cluster_id':
-                                        var_to_write[v['variable_name']
-                                                    ] = zone_resources[zone]['f5_cluster_id']['value']
-                                        var_tf_content += "%s = \"%s\"\n" % (
-                                            v['variable_name'], zone_resources[zone]['f5_cluster_id']['value'])
-                                    if v['test_variable'] == 'f5_internal_id':
-                                        var_to_write[v['variable_name']
-                                                    ] = zone_resources[zone]['f5_internal_id']['value']
-                                        var_tf_content += "%s = \"%s\"\n" % (
-                                            v['variable_name'], zone_resources[zone]['f5_internal_id']['value'])
-                                    if v['test_variable'] == 'f5_external_id':
-                                        var_to_write[v['variable_name']
-                                                    ] = zone_resources[zone]['f5_external_id']['value']
-                                        var_tf_content += "%s = \"%s\"\n" % (
-                                            v['variable_name'], zone_resources[zone]['f5_external_id']['value'])
-                                    if v['test_variable'] == 'report_finish_url':
-                                        var_to_write[v['variable_name']] = "%s/stop/%s" % (
-                                            CONFIG['report_service_base_url'], test_id)
-                                        var_tf_content += "%s = \"%s\"\n" % (v['variable_name'], "%s/stop/%s" % (
-                                            CONFIG['report_service_base_url'], test_id))
-                                    if v['test_variable'] == 'f5_hardcoded_sg':
-                                        var_to_write[v['variable_name']] = CONFIG['zone_security_groups'][zone]
-                                        var_tf_content += "%s = \"%s\"\n" % (v['variable_name'], CONFIG['zone_security_groups'][zone])
-                                with open(var_json_file, 'w') as vj:
-                                    vj.write(json.dumps(
-                                        var_to_write, sort_keys=True, indent=4, separators=(',', ': ')))
-                                with open(var_tf_file, 'w') as vtf:
-                                    vtf.write(var_tf_content)
-                                total_tests = total_tests + 1
-    LOG.info("%d total tests created in %d zones for %d images", total_tests, total_zones, len(indexed_images.keys()))
-
-def build_byol():
-    zone_resources = {}
-    with open(CONFIG['zone_resources_file'], 'r') as zrf:
-        zone_resources = json.load(zrf)
-    zones = os.listdir(QUEUE_DIR)
-    num_licenses = licenses_available()
-    test_map = {}
-    for zone in zones:
-        if zone in CONFIG['active_zones']:
-            if not zone in test_map:
-                test_map[zone] = {'test_count': 0}
-    number_of_active_zones = len(test_map)
-    number_per_zone = num_licenses / number_of_active_zones
-    number_license_left = num_licenses % number_of_active_zones
-    for zone in zones:
+                    base_image_name = base_image(image, zone)
+                    if test_per_base_image.get(base_image_name, 0) < number_per_zone:
+                        test_per_base_image[base_image_name] = test_per_base_image.get(base_image_name, 0) + 1
+                        test_per_image[image] = test_per_image.get(image, 0) + 1
+                        adding_test = True
+            for image in images:
+                if image in test_per_image:
+                    LOG.debug('setting up %d tests for image: %s in %s', test_per_image[image], image, zone)
+                    unit = new_unit(zone, image, 'utilitypool')
+                    for temp_type in os.listdir(os.path.join(zone_dir, image)):
+                        unit['tests'].append((temp_type, [''] * test_per_image[image]))
+                    units.append(unit)
+    return units
+
+
+def plan_byol():
+    units = []
+    zone_units = {}
+    for zone in os.listdir(QUEUE_DIR):
         if zone in CONFIG['active_zones']:
-            test_map[zone]['test_to_create'] = number_per_zone
             zone_dir = os.path.join(QUEUE_DIR, zone)
-            images = os.listdir(zone_dir)
-            while test_map[zone]['test_to_create'] > 0:
-                for image in images:
-                    image_eligible = False
-                    for match in CONFIG['active_images']:
-                        if image.find(match) > 0:
-                            image_eligible = True
-                    if image_eligible:
-                        image_dir = os.path.join(zone_dir, image)
-                        size = ''
-                        for sstr in CONFIG['profile_selection']:
-                            if image.find(sstr) > 0:
-                                size = CONFIG['profile_selection'][sstr]                     
-                        temp_types = os.listdir(image_dir)
-                        for temp_type in temp_types:
-                            temp_dir = os.path.join(image_dir, temp_type)
-                            template = "%s/%s.tar.gz" % (TEMPLATE_DIR,
-                                                            os.path.basename(temp_type))
-                            LOG.debug('creating a test: %s - %s - %s', zone, image, temp_type)
-                            license = get_license()
-                            if len(license) > 0:
-                                test_id = str(uuid.uuid4())
-                                test_dir = os.path.join(temp_dir, test_id)
-                                LOG.info('creating test: %s' % test_dir)
-                                os.mkdir(test_dir)
-                                test_archive = tarfile.open(template)
-                                test_archive.extractall(test_dir)
-                                test_archive.close()
-                                var_template = {}
-                                with open(os.path.join(test_dir, 'variables.json'), 'r') as vj:
-                                    var_template = json.load(vj)
-                                var_json_file = os.path.join(
-                                    test_dir, 'test_vars.json')
-                                var_tf_file = os.path.join(
-                                    test_dir, 'test_vars.tfvars')
-                                var_tf_content = "%s = \"%s\"\n" % (
-                                    'test_type', temp_type)
-                                var_to_write = {'test_type': temp_type}
-                                var_to_write['license_type'] = 'byol'
-                                var_tf_content += "license_type = \"byol\"\n"
-                                if 'global_ssh_key' in CONFIG and CONFIG['global_ssh_key']:
-                                    var_to_write['ssh_key_name'] = CONFIG['global_ssh_key']
-                                    var_tf_content += "ssh_key_name = \"%s\"\n" % CONFIG['global_ssh_key']
-                                for v in var_template:
-                                    if v['test_variable'] == 'api_key':
-                                        var_to_write[v['variable_name']
-                                                    ] = CONFIG['api_key']
-                                        var_tf_content += "%s = \"%s\"\n" % (
-                                            v['variable_name'], CONFIG['api_key'])
-                                    if v['test_variable'] == 'region':
-                                        var_to_write[v['variable_name']
-                                                    ] = region_from_zone(zone)
-                                        var_tf_content += "%s = \"%s\"\n" % (
-                                            v['variable_name'], region_from_zone(zone))
-                                    if v['test_variable'] == 'test_id':
-                                        var_to_write[v['variable_name']
-                                                    ] = "t-%s" % test_id
-                                        var_tf_content += "%s = \"%s\"\n" % (
-                                            v['variable_name'], "t-%s" % test_id)
-                                    if v['test_variable'] == 'image_name':
-                                        var_to_write[v['variable_name']] = image
-                                        var_tf_content += "%s = \"%s\"\n" % (
-                                            v['variable_name'], image)
-                                    if v['test_variable'] == 'size':
-                                        var_to_write[v['variable_name']] = size
-                                        var_tf_content += "%s = \"%s\"\n" % (
-                                            v['variable_name'], size)
-                                    if v['test_variable'] == 'byol_license_basekey':
-                                        var_to_write[v['variable_name']
-                                                    ] = license
-                                        var_tf_content += "%s = \"%s\"\n" % (
-                                            v['variable_name'], license)
-                                    if v['test_variable'] == 'admin_password':
-                                        var_to_write[v['variable_name']
-                                                    ] = 'f5C0nfig'
-                                        var_tf_content += "%s = \"%s\"\n" % (
-                                            v['variable_name'], 'f5C0nfig')
-                                    if 'global_ssh_key' not in CONFIG or not CONFIG['global_ssh_key']:
-                                        if v['test_variable'] == 'ssh_key_name':
-                                            var_to_write[v['variable_name']
-                                                        ] = zone_resources[zone]['ssh_key_name']['value']
-                                            var_tf_content += "%s = \"%s\"\n" % (
-                                                v['variable_name'], zone_resources[zone]['ssh_key_name']['value'])
-                                    if v['test_variable'] == 'f5_management_id':
-                                        var_to_write[v['variable_name']
-                                                    ] = zone_resources[zone]['f5_management_id']['value']
-                                        var_tf_content += "%s = \"%s\"\n" % (
-                                            v['variable_name'], zone_resources[zone]['f5_management_id']['value'])
-                                    if v['test_variable'] == 'f5_cluster_id':
-                                        var_to_write[v['variable_name']
-                                                    ] = zone_resources[zone]['f5_cluster_id']['value']
-                                        var_tf_content += "%s = \"%s\"\n" % (
-                                            v['variable_name'], zone_resources[zone]['f5_cluster_id']['value'])
-                                    if v['test_variable'] == 'f5_internal_id':
-                                        var_to_write[v['variable_name']
-                                                    ] = zone_resources[zone]['f5_internal_id']['value']
-                                        var_tf_content += "%s = \"%s\"\n" % (
-                                            v['variable_name'], zone_resources[zone]['f5_internal_id']['value'])
-                                    if v['test_variable'] == 'f5_external_id':
-                                        var_to_write[v['variable_name']
-                                                    ] = zone_resources[zone]['f5_external_id']['value']
-                                        var_tf_content += "%s = \"%s\"\n" % (
-                                            v['variable_name'], zone_resources[zone]['f5_external_id']['value'])
-                                    if v['test_variable'] == 'report_finish_url':
-                                        var_to_write[v['variable_name']] = "%s/stop/%s" % (
-                                            CONFIG['report_service_base_url'], test_id)
-                                        var_tf_content += "%s = \"%s\"\n" % (v['variable_name'], "%s/stop/%s" % (
-                                            CONFIG['report_service_base_url'], test_id))
-                                    if v['test_variable'] == 'f5_hardcoded_sg':
-                                        var_to_write[v['variable_name']] = CONFIG['zone_security_groups'][zone]
-                                        var_tf_content += "%s = \"%s\"\n" % (v['variable_name'], CONFIG['zone_security_groups'][zone])
-                                with open(var_json_file, 'w') as vj:
-                                    vj.write(json.dumps(
-                                        var_to_write, sort_keys=True, indent=4, separators=(',', ': ')))
-                                with open(var_tf_file, 'w') as vtf:
-                                    vtf.write(var_tf_content)
-                                test_map[zone]['test_to_create'] = test_map[zone]['test_to_create'] - 1
-
-
-def build_tests():
+            for image in os.listdir(zone_dir):
+                if image_eligible(image):
+                    unit = new_unit(zone, image, 'byol')
+                    for temp_type in os.listdir(os.path.join(zone_dir, image)):
+                        unit['tests'].append((temp_type, []))
+                    if unit['tests']:
+                        zone_units.setdefault(zone, []).append(unit)
+    if not zone_units:
+        return units
+    (number_per_zone, number_license_left) = divmod(
+        licenses_available(), len(zone_units))
+    for (zone_index, zone) in enumerate(zone_units):
+        number_in_zone = number_per_zone
+        if zone_index < number_license_left:
+            number_in_zone = number_in_zone + 1
+        # spread the zone's licenses round robin over its cells, each
+        # cell checks out one contiguous batch so it journals one range
+        cells = [licenses for unit in zone_units[zone] for (temp_type, licenses) in unit['tests']]
+        cell_counts = [0] * len(cells)
+        for license_index in range(number_in_zone):
+            cell_counts[license_index % len(cells)] = cell_counts[license_index % len(cells)] + 1
+        cell_index = 0
+        for unit in zone_units[zone]:
+            for (temp_type, cell_licenses) in unit['tests']:
+                (licenses, license_range) = checkout_licenses(cell_counts[cell_index])
+                cell_licenses.extend(licenses)
+                unit['license_ranges'].append(license_range)
+                cell_index = cell_index + 1
+        LOG.debug('%d BYOL licenses assigned to zone %s', number_in_zone, zone)
+        units.extend(zone_units[zone])
+    return units
+
+
+def init_worker(config, zone_resources):
+    global CONFIG, ZONE_RESOURCES
+    CONFIG = config
+    ZONE_RESOURCES = zone_resources
+    data_sources.configure(config)
+    # workers register their own cells, never on the parent's connection
+    job_store.CONNECTIONS = threading.local()
+    job_store.store_file(config)
+
+
+def build_units(units, workers):
+    for temp_type in get_template_types():
+        extracted_template("%s/%s.tar.gz" % (TEMPLATE_DIR, temp_type))
+    totals = {'tests': 0, 'zones': {}, 'images': {}}
+
+    def record(unit, tests):
+        if tests:
+            totals['tests'] = totals['tests'] + len(tests)
+            totals['zones'][unit['zone']] = True
+            totals['images'][unit['image'][0:-(len(unit['zone'])+1)]] = True
+
+    if workers > 1:
+        LOG.info('building %d work units with %d workers', len(units), workers)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                    initializer=init_worker,
+                                                    initargs=(CONFIG, ZONE_RESOURCES)) as executor:
+            for (unit, tests) in zip(units, executor.map(build_unit, units)):
+                record(unit, tests)
+    else:
+        for unit in units:
+            record(unit, build_unit(unit))
+    total_tests = totals['tests']
+    zones = totals['zones']
+    images = totals['images']
+    LOG.info("%d total tests created in %d zones for %d images", total_tests, len(zones), len(images))
+    return total_tests
+
+
+def resolve_data_sources():
+    # look up the ids the template's data sources would read once per
+    # region, so every test built for the region skips those lookups
+    regions = {}
+    for zone in CONFIG['active_zones']:
+        region = region_from_zone(zone)
+        wanted = regions.setdefault(region, {
+            'ssh_keys': set(), 'profiles': set(), 'subnets': set(), 'images': []})
+        wanted['ssh_keys'].add(global_ssh_key() or ZONE_RESOURCES[zone]['ssh_key_name']['value'])
+        wanted['subnets'].add(ZONE_RESOURCES[zone]['f5_management_id']['value'])
+        if not wanted['images']:
+            for image in IMAGES_CATALOG.get(region, []):
+                if image_eligible(image['image_name']):
+                    wanted['images'].append(image)
+                    if get_profile_size(image['image_name']):
+                        wanted['profiles'].add(get_profile_size(image['image_name']))
+    data_sources.resolve(regions)
+
+
+def build_tests(workers=1):
+    global ZONE_RESOURCES
+    with open(CONFIG['zone_resources_file'], 'r') as zrf:
+        ZONE_RESOURCES = json.load(zrf)
+    resolve_data_sources()
     if CONFIG['license_type'] == 'byol':
-        num_licenses = licenses_available()
-        LOG.info('%d BYOL licenses available for test queuing', num_licenses)
-        while num_licenses > 0:
-            build_byol()
-            num_licenses = licenses_available()
+        LOG.info('%d BYOL licenses available for test queuing', licenses_available())
+        build_units(plan_byol(), workers)
     if CONFIG['license_type'] == 'utilitypool':
-        build_utility()
+        build_units(plan_utility(), workers)
 
 
 def initialize():
-    global CONFIG
+    global CONFIG, IMAGES_CATALOG
     os.makedirs(QUEUE_DIR, exist_ok=True)
     config_json = ''
     with open(CONFIG_FILE, 'r') as cf:
@@ -427,16 +604,25 @@ def initialize():
                     template_queue = "%s/%s" % (image_queue, template_type)
                     os.makedirs(template_queue, exist_ok=True)
     CONFIG = config
+    IMAGES_CATALOG = images
+    data_sources.configure(CONFIG)
+    if job_store.configure(CONFIG):
+        job_store.import_queue_tree(QUEUE_DIR, "%s/running_tests" % SCRIPT_DIR)
+    finish_partial_tests()
 
 
 if __name__ == "__main__":
     START_TIME = time.time()
     LOG.debug('process start time: %s', datetime.datetime.fromtimestamp(
         START_TIME).strftime("%A, %B %d, %Y %I:%M:%S"))
+    PARSER = argparse.ArgumentParser(description='build queued tests')
+    PARSER.add_argument('--workers', type=int, default=1,
+                        help='number of processes building test directories')
+    ARGS = PARSER.parse_args()
     initialize()
     ERROR_MESSAGE = ''
     ERROR = False
-    build_tests()
+    build_tests(workers=ARGS.workers)
     STOP_TIME = time.time()
     DURATION = STOP_TIME - START_TIME
     LOG.debug(
@@ -22,9 +22,9 @@ import json
 import logging
 import datetime
 import time
-import requests
-import shutil
-import python_terraform as pt
+import report_client
+import plugin_cache
+import destroy_engine
 
 LOG = logging.getLogger('ibmcloud_test_process_running')
 LOG.setLevel(logging.DEBUG)
@@ -47,18 +47,16 @@ def clean():
         left_over_tests = []
         for test_id in test_dirs:
             left_over_tests.append(test_id)
-        report_url = "%s/report" % CONFIG['report_service_base_url']
-        resp = requests.get(report_url)
-        reports = resp.json()
-        output = {}
+        reports = report_client.get_all()
+        if reports is None:
+            LOG.error('could not retrieve reports from %s', CONFIG['report_service_base_url'])
+            return
+        test_pool = []
         for test_id in reports:
             test_dir = os.path.join(RUNNING_DIR, test_id)
             if os.path.exists(test_dir):
-                LOG.debug("Destorying %s", test_dir)
-                tf = pt.Terraform(working_dir=test_dir, var_file='test_vars.tfvars')
-                tf.init()
-                tf.destroy()
-                shutil.rmtree(test_dir)
+                test_pool.append(test_dir)
+        output = destroy_engine.destroy_all(test_pool)
         print(json.dumps(output, sort_keys=True,
               indent=4, separators=(',', ': ')))
 
@@ -69,6 +67,9 @@ def initialize():
     with open(CONFIG_FILE, 'r') as cf:
         config_json = cf.read()
     CONFIG = json.loads(config_json)
+    report_client.configure(CONFIG)
+    plugin_cache.configure(CONFIG)
+    destroy_engine.configure(CONFIG)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,217 @@
+# coding=utf-8
+# pylint: disable=broad-except,unused-argument,line-too-long, unused-variable
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import sys
+import json
+import logging
+import time
+import requests
+
+LOG = logging.getLogger('ibmcloud_test_harness_data_sources')
+LOG.setLevel(logging.DEBUG)
+FORMATTER = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+LOGSTREAM = logging.StreamHandler(sys.stdout)
+LOGSTREAM.setFormatter(FORMATTER)
+LOG.addHandler(LOGSTREAM)
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+SETTINGS = {
+    'enabled': False,
+    'cache_file': "%s/data_source_cache.json" % SCRIPT_DIR,
+    'cache_ttl': 86400,
+    'timeout': 10,
+    'iam_endpoint': 'https://iam.cloud.ibm.com/identity/token',
+    'vpc_endpoint': 'https://%s.iaas.cloud.ibm.com',
+    'vpc_api_version': '2020-08-01'
+}
+
+API_KEY = None
+TOKEN = {'access_token': None, 'expires': 0}
+CACHE = {}
+CACHE_LOADED = False
+
+
+def configure(config):
+    # builder config keys resolve_data_sources, data_source_cache_file,
+    # data_source_cache_ttl, ibm_iam_endpoint and ibm_vpc_endpoint
+    global API_KEY, CACHE_LOADED
+    API_KEY = config['api_key']
+    if 'resolve_data_sources' in config:
+        SETTINGS['enabled'] = config['resolve_data_sources']
+    for setting in ['cache_file', 'cache_ttl', 'timeout']:
+        key = "data_source_%s" % setting
+        if key in config:
+            SETTINGS[setting] = config[key]
+    for setting in ['iam_endpoint', 'vpc_endpoint']:
+        key = "ibm_%s" % setting
+        if key in config:
+            SETTINGS[setting] = config[key]
+    if not SETTINGS['cache_file'].startswith('/'):
+        SETTINGS['cache_file'] = "%s/%s" % (SCRIPT_DIR, SETTINGS['cache_file'])
+    CACHE_LOADED = False
+    return SETTINGS['enabled']
+
+
+def load_cache():
+    global CACHE, CACHE_LOADED
+    if not CACHE_LOADED:
+        CACHE = {}
+        if os.path.exists(SETTINGS['cache_file']):
+            try:
+                with open(SETTINGS['cache_file'], 'r') as dcf:
+                    CACHE = json.load(dcf)
+            except ValueError:
+                LOG.error('ignoring unreadable data source cache %s', SETTINGS['cache_file'])
+        CACHE_LOADED = True
+    return CACHE
+
+
+def save_cache():
+    tmp_file = "%s.%d" % (SETTINGS['cache_file'], os.getpid())
+    with open(tmp_file, 'w') as dcf:
+        dcf.write(json.dumps(CACHE, sort_keys=True, indent=4, separators=(',', ': ')))
+    os.replace(tmp_file, SETTINGS['cache_file'])
+
+
+def cache_key(region, kind, name):
+    return "%s|%s|%s" % (region, kind, name)
+
+
+def cached(region, kind, name):
+    entry = load_cache().get(cache_key(region, kind, name))
+    if entry and time.time() - entry['resolved_at'] < SETTINGS['cache_ttl']:
+        return entry
+    return None
+
+
+def lookup(region, kind, name):
+    # the cached id, or an empty string so the template looks it up itself
+    if not SETTINGS['enabled']:
+        return ''
+    entry = cached(region, kind, name)
+    if entry:
+        return entry['value']
+    return ''
+
+
+def store(region, kind, name, value):
+    load_cache()[cache_key(region, kind, name)] = {
+        'value': value,
+        'resolved_at': time.time()
+    }
+
+
+def iam_token():
+    if TOKEN['access_token'] and time.time() < TOKEN['expires'] - 60:
+        return TOKEN['access_token']
+    response = requests.post(SETTINGS['iam_endpoint'],
+                             data={'grant_type': 'urn:ibm:params:oauth:grant-type:apikey',
+                                   'apikey': API_KEY},
+                             headers={'Accept': 'application/json'},
+                             timeout=SETTINGS['timeout'])
+    response.raise_for_status()
+    response_json = response.json()
+    TOKEN['access_token'] = response_json['access_token']
+    TOKEN['expires'] = time.time() + int(response_json.get('expires_in', 3600))
+    return TOKEN['access_token']
+
+
+def vpc_get(region, path, params=None):
+    url = path
+    if not path.startswith('http'):
+        endpoint = SETTINGS['vpc_endpoint']
+        if '%s' in endpoint:
+            endpoint = endpoint % region
+        url = "%s/v1/%s" % (endpoint, path)
+    query = {'version': SETTINGS['vpc_api_version'], 'generation': 2}
+    if params:
+        query.update(params)
+    response = requests.get(url, params=query, timeout=SETTINGS['timeout'],
+                            headers={'Authorization': "Bearer %s" % iam_token(),
+                                     'Accept': 'application/json'})
+    response.raise_for_status()
+    return response.json()
+
+
+def vpc_list(region, collection, params=None, path=None):
+    items = []
+    page = vpc_get(region, path or collection, dict(params or {}, limit=100))
+    while True:
+        items.extend(page[collection])
+        if 'next' not in page:
+            return items
+        page = vpc_get(region, page['next']['href'])
+
+
+def resolve_region(region, wanted):
+    # one listing per collection, shared by every zone and image in the region
+    ssh_keys = dict((key['name'], key['id']) for key in vpc_list(region, 'keys'))
+    for name in wanted['ssh_keys']:
+        store(region, 'ssh_key', name, ssh_keys.get(name, ''))
+    profiles = dict((profile['name'], profile['name'])
+                    for profile in vpc_list(region, 'profiles', path='instance/profiles'))
+    for name in wanted['profiles']:
+        store(region, 'instance_profile', name, profiles.get(name, ''))
+    for subnet_id in wanted['subnets']:
+        subnet = vpc_get(region, "subnets/%s" % subnet_id)
+        store(region, 'subnet_vpc', subnet_id, subnet['vpc']['id'])
+        store(region, 'subnet_resource_group', subnet_id, subnet['resource_group']['id'])
+        store(region, 'subnet_zone', subnet_id, subnet['zone']['name'])
+    for image in wanted['images']:
+        if 'image_id' in image and image['image_id']:
+            store(region, 'image', image['image_name'], image['image_id'])
+            continue
+        found = vpc_list(region, 'images', {'name': image['image_name']})
+        store(region, 'image', image['image_name'], found[0]['id'] if found else '')
+
+
+def resolved(region, wanted):
+    # names which were not found are cached as empty ids until the TTL
+    # expires so they are not listed again on every build
+    names = [('ssh_key', name) for name in wanted['ssh_keys']] + \
+        [('instance_profile', name) for name in wanted['profiles']] + \
+        [(kind, name) for kind in ['subnet_vpc', 'subnet_resource_group', 'subnet_zone']
+         for name in wanted['subnets']] + \
+        [('image', image['image_name']) for image in wanted['images']]
+    for (kind, name) in names:
+        if not cached(region, kind, name):
+            return False
+    return True
+
+
+def resolve(regions):
+    # regions maps each region to the ssh_keys, profiles and subnets names
+    # and the catalog images its tests use. A region which can not be
+    # resolved keeps its cached entries, anything missing is looked up by
+    # the template's own data sources.
+    if not SETTINGS['enabled']:
+        return
+    load_cache()
+    for region in sorted(regions):
+        if resolved(region, regions[region]):
+            continue
+        start = time.time()
+        try:
+            resolve_region(region, regions[region])
+            LOG.info('resolved data sources for region %s in %.1f seconds',
+                     region, time.time() - start)
+        except Exception as ex:
+            LOG.error('could not resolve data sources for region %s, tests will look them up: %s',
+                      region, ex)
+    save_cache()
@@ -0,0 +1,184 @@
+# coding=utf-8
+# pylint: disable=broad-except,unused-argument,line-too-long, unused-variable
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import sys
+import json
+import logging
+import shutil
+import threading
+import time
+import concurrent.futures
+import python_terraform as pt
+
+import terraform_errors
+import jitter
+
+LOG = logging.getLogger('ibmcloud_test_harness_destroy_engine')
+LOG.setLevel(logging.DEBUG)
+FORMATTER = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+LOGSTREAM = logging.StreamHandler(sys.stdout)
+LOGSTREAM.setFormatter(FORMATTER)
+LOG.addHandler(LOGSTREAM)
+
+DESTROYED = 'destroyed'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+SETTINGS = {
+    'workers': 10,
+    'zone_concurrency': None,
+    'retries': 3,
+    'backoff': 10,
+    'max_backoff': 300,
+    'terraform_options': {}
+}
+
+ZONE_LIMITS = {}
+ZONE_LIMITS_LOCK = threading.Lock()
+
+
+def configure(config):
+    # config is the script's CONFIG dictionary. destroy_workers defaults to
+    # thread_pool_size. destroy_zone_concurrency is a number for every zone
+    # or a map of zones to numbers with an optional "default".
+    global ZONE_LIMITS
+    if 'thread_pool_size' in config:
+        SETTINGS['workers'] = config['thread_pool_size']
+    for setting in ['workers', 'zone_concurrency', 'retries', 'backoff', 'max_backoff']:
+        key = "destroy_%s" % setting
+        if key in config:
+            SETTINGS[setting] = config[key]
+    if 'terraform_options' in config:
+        SETTINGS['terraform_options'] = config['terraform_options']
+    with ZONE_LIMITS_LOCK:
+        ZONE_LIMITS = {}
+
+
+def test_zone(test_dir):
+    try:
+        with open(os.path.join(test_dir, 'test_vars.json'), 'r') as vf:
+            return json.load(vf)['zone']
+    except Exception:
+        return None
+
+
+def zone_limit(zone):
+    # a semaphore per zone, None when the zone is not limited
+    setting = SETTINGS['zone_concurrency']
+    limit = setting
+    if isinstance(setting, dict):
+        limit = setting.get(zone, setting.get('default'))
+    if not limit:
+        return None
+    with ZONE_LIMITS_LOCK:
+        if zone not in ZONE_LIMITS:
+            ZONE_LIMITS[zone] = threading.BoundedSemaphore(int(limit))
+        return ZONE_LIMITS[zone]
+
+
+def run_terraform(test_id, test_dir, command):
+    attempts = int(SETTINGS['retries']) + 1
+    for attempt in range(attempts):
+        tf = pt.Terraform(working_dir=test_dir, var_file='test_vars.tfvars')
+        options = dict(SETTINGS['terraform_options'].get(command, {}))
+        if command == 'init':
+            (rc, out, err) = tf.init(**options)
+        else:
+            (rc, out, err) = tf.destroy(**options)
+        if rc == 0:
+            return (rc, err)
+        if not terraform_errors.is_transient(err) or attempt + 1 == attempts:
+            return (rc, err)
+        wait = jitter.full_jitter(attempt, SETTINGS['backoff'], SETTINGS['max_backoff'])
+        LOG.warning('terraform %s for test %s failed with a transient error, retrying in %.1f seconds (attempt %d of %d)',
+                    command, test_id, wait, attempt + 1, attempts)
+        time.sleep(wait)
+    return (rc, err)
+
+
+def destroy_test(test_dir, remove=True):
+    # returns (test_id, result, error)
+    test_id = os.path.basename(test_dir)
+    if not os.path.exists(os.path.join(test_dir, 'test_vars.tfvars')):
+        LOG.warning('skipping %s, it is not a test directory', test_dir)
+        return (test_id, SKIPPED, 'no test_vars.tfvars')
+    limit = zone_limit(test_zone(test_dir))
+    if limit:
+        limit.acquire()
+    try:
+        if not os.path.exists(os.path.join(test_dir, '.terraform')):
+            (rc, err) = run_terraform(test_id, test_dir, 'init')
+            if rc > 0:
+                LOG.error('could not initialize test: %s: %s', test_id, err)
+                return (test_id, FAILED, "init failure: %s" % err)
+        LOG.info('destroying cloud resources for test %s', test_id)
+        (rc, err) = run_terraform(test_id, test_dir, 'destroy')
+    finally:
+        if limit:
+            limit.release()
+    if rc > 0:
+        LOG.error('could not destroy test: %s: %s', test_id, err)
+        return (test_id, FAILED, err)
+    if remove:
+        shutil.rmtree(test_dir)
+    return (test_id, DESTROYED, None)
+
+
+def interleave_zones(test_dirs):
+    # alternate zones so a limited zone does not hold every worker
+    by_zone = {}
+    for test_dir in test_dirs:
+        by_zone.setdefault(test_zone(test_dir), []).append(test_dir)
+    ordered = []
+    zones = list(by_zone.values())
+    while zones:
+        for zone_dirs in list(zones):
+            ordered.append(zone_dirs.pop(0))
+            if not zone_dirs:
+                zones.remove(zone_dirs)
+    return ordered
+
+
+def destroy_all(test_dirs, workers=None, remove=True):
+    # destroy every test directory on a bounded pool, returns a summary
+    # of the destroyed, failed and skipped test ids
+    start = time.time()
+    summary = {DESTROYED: [], FAILED: {}, SKIPPED: []}
+    if not test_dirs:
+        return summary
+    if not workers:
+        workers = SETTINGS['workers']
+    with concurrent.futures.ThreadPoolExecutor(max_workers=int(workers)) as executor:
+        destroys = dict((executor.submit(destroy_test, test_dir, remove), test_dir)
+                        for test_dir in interleave_zones(test_dirs))
+        for destroy in concurrent.futures.as_completed(destroys):
+            try:
+                (test_id, result, error) = destroy.result()
+            except Exception as ex:
+                LOG.exception('destroy failed in the engine: %s', ex)
+                (test_id, result, error) = (os.path.basename(destroys[destroy]), FAILED, str(ex))
+            if result == FAILED:
+                summary[FAILED][test_id] = terraform_errors.summary(error)
+            else:
+                summary[result].append(test_id)
+    LOG.info('destroyed %d tests, %d failed, %d skipped in %.1f seconds',
+             len(summary[DESTROYED]), len(summary[FAILED]), len(summary[SKIPPED]),
+             time.time() - start)
+    for test_id in sorted(summary[FAILED]):
+        LOG.error('destroy of test %s failed: %s', test_id, summary[FAILED][test_id])
+    return summary
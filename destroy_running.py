@@ -22,12 +22,9 @@ import json
 import logging
 import datetime
 import time
-import requests
-import concurrent.futures
-import threading
-import shutil
-import python_terraform as pt
 import random
+import plugin_cache
+import destroy_engine
 
 LOG = logging.getLogger('ibmcloud_test_harness_destroy_running')
 LOG.setLevel(logging.DEBUG)
@@ -60,32 +57,6 @@ def check_pid(pid):
         return True
 
 
-def stop_report(test_id, results):
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    requests.post("%s/stop/%s" % (CONFIG['report_service_base_url'], test_id),
-                  headers=headers, data=json.dumps(results))
-
-
-def destroy_test(test_path):
-    LOG.info("destroying %s", test_path)
-    test_id = os.path.basename(test_path)
-    results = {"test_aborted": "forced destroyed"}
-    # stop_report(test_id, results)
-    tf = pt.Terraform(working_dir=test_path, var_file='test_vars.tfvars')
-    if not os.path.exists(os.path.join(test_path, '.terraform')):
-        (rc, out, err) = tf.init()
-    results = {'terraform_failed': "init failure: %s" % err}
-    LOG.info('destroying cloud resources for test %s', test_id)
-    (rc, out, err) = tf.destroy()
-    if rc > 0:
-        LOG.error(
-            'could not destroy test: %s: %s. Manually fix.', test_id, err)
-    else:
-        shutil.rmtree(test_path)
-
-
 def build_pool():
     pool = []
     for rt in os.listdir(RUNNING_DIR):
@@ -101,9 +72,7 @@ def build_pool():
 def runner():
     test_pool = build_pool()
     random.shuffle(test_pool)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=CONFIG['thread_pool_size']) as executor:
-        for test_path in test_pool:
-            executor.submit(destroy_test, test_path=test_path)
+    return destroy_engine.destroy_all(test_pool)
 
 
 def initialize():
@@ -112,7 +81,7 @@ def initialize():
     os.makedirs(QUEUE_DIR, exist_ok=True)
     os.makedirs(RUNNING_DIR, exist_ok=True)
     os.makedirs(COMPLETE_DIR, exist_ok=True)
-    filter_ids = os.getenv(RUNNING_TEST_IDS, "")
+    filter_ids = os.getenv('RUNNING_TEST_IDS', "")
     if filter_ids:
         RUNNING_TEST_IDS = filter_ids.split(',')
     config_json = ''
@@ -121,6 +90,8 @@ def initialize():
     config = json.loads(config_json)
     # intialize missing config defaults
     CONFIG = config
+    plugin_cache.configure(CONFIG)
+    destroy_engine.configure(CONFIG)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,27 @@
+# coding=utf-8
+# pylint: disable=broad-except,unused-argument,line-too-long, unused-variable
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import random
+
+
+def full_jitter(attempt, base, cap=None):
+    # full jitter exponential backoff, seconds to wait before retry number
+    # attempt, counted from 0: anywhere up to base doubled for each earlier
+    # retry, never more than cap
+    ceiling = float(base) * (2 ** attempt)
+    if cap is not None:
+        ceiling = min(float(cap), ceiling)
+    return random.uniform(0, ceiling)
@@ -0,0 +1,281 @@
+# coding=utf-8
+# pylint: disable=broad-except,unused-argument,line-too-long, unused-variable
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import sys
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+import urllib.request
+
+LOG = logging.getLogger('ibmcloud_test_harness_job_store')
+LOG.setLevel(logging.DEBUG)
+FORMATTER = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+LOGSTREAM = logging.StreamHandler(sys.stdout)
+LOGSTREAM.setFormatter(FORMATTER)
+LOG.addHandler(LOGSTREAM)
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+JOB_STORE_FILE = "%s/test_jobs.db" % SCRIPT_DIR
+
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+ERRORED = 'errored'
+ABORTED = 'aborted'
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS tests (
+        test_id TEXT PRIMARY KEY,
+        state TEXT NOT NULL,
+        zone TEXT NOT NULL,
+        image TEXT NOT NULL,
+        template_type TEXT NOT NULL,
+        priority REAL NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        started_at REAL,
+        finished_at REAL
+    )''',
+    'CREATE INDEX IF NOT EXISTS tests_state_priority ON tests (state, priority)',
+    'CREATE INDEX IF NOT EXISTS tests_state_cell ON tests (state, zone, image, template_type)'
+]
+
+# columns added after the first release of the store, created on open
+COLUMNS = [
+    ('license_host', 'TEXT'),
+    ('not_before', 'REAL'),
+    ('last_error', 'TEXT')
+]
+
+CONNECTIONS = threading.local()
+READ_ONLY = False
+
+
+def store_file(config):
+    global JOB_STORE_FILE
+    if 'job_store_file' in config and config['job_store_file']:
+        JOB_STORE_FILE = config['job_store_file']
+        if not JOB_STORE_FILE.startswith('/'):
+            JOB_STORE_FILE = "%s/%s" % (SCRIPT_DIR, JOB_STORE_FILE)
+    return JOB_STORE_FILE
+
+
+def configure(config):
+    # creates or upgrades the store, returns True when it holds no tests
+    # yet and the queued_tests and running_tests trees should be imported
+    store_file(config)
+    db = connection()
+    for statement in SCHEMA:
+        db.execute(statement)
+    existing = [row['name'] for row in db.execute('PRAGMA table_info(tests)')]
+    for (column, column_type) in COLUMNS:
+        if column not in existing:
+            db.execute('ALTER TABLE tests ADD COLUMN %s %s' % (column, column_type))
+    return db.execute('SELECT test_id FROM tests LIMIT 1').fetchone() is None
+
+
+def open_read_only(config):
+    # for scripts which only read test state, the store is never
+    # created or upgraded. Returns True when the store exists.
+    global READ_ONLY
+    store_file(config)
+    READ_ONLY = True
+    return exists()
+
+
+def exists():
+    return os.path.exists(JOB_STORE_FILE)
+
+
+def connection():
+    # one connection per thread, run.py calls the store from executor threads
+    db = getattr(CONNECTIONS, 'db', None)
+    if db is None or getattr(CONNECTIONS, 'path', None) != JOB_STORE_FILE:
+        if READ_ONLY:
+            db = sqlite3.connect("file:%s?mode=ro" % urllib.request.pathname2url(JOB_STORE_FILE),
+                                 timeout=60, isolation_level=None, uri=True)
+            db.row_factory = sqlite3.Row
+        else:
+            db = sqlite3.connect(JOB_STORE_FILE, timeout=60, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+        CONNECTIONS.db = db
+        CONNECTIONS.path = JOB_STORE_FILE
+    return db
+
+
+def add_tests(tests, state=QUEUED):
+    # tests are (test_id, zone, image, template_type, license_host) tuples,
+    # license_host is None for tests which do not license from a BIG-IQ
+    now = time.time()
+    db = connection()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        db.executemany(
+            'INSERT OR IGNORE INTO tests (test_id, state, zone, image, template_type, license_host, priority, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(test_id, state, zone, image, template_type, license_host, random.random(), now, now)
+             for (test_id, zone, image, template_type, license_host) in tests])
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+
+
+def claim(zone=None, image=None, template_type=None):
+    # atomically move the next queued test, optionally from
+    # one (zone, image, template type) cell, to running. Tests
+    # waiting to be retried are skipped until their not_before.
+    now = time.time()
+    query = 'SELECT * FROM tests WHERE state = ? AND (not_before IS NULL OR not_before <= ?)'
+    params = [QUEUED, now]
+    for (column, value) in [('zone', zone), ('image', image), ('template_type', template_type)]:
+        if value is not None:
+            query = "%s AND %s = ?" % (query, column)
+            params.append(value)
+    db = connection()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        row = db.execute("%s ORDER BY priority LIMIT 1" % query, params).fetchone()
+        if row:
+            db.execute(
+                'UPDATE tests SET state = ?, attempts = attempts + 1, started_at = ?, updated_at = ? WHERE test_id = ?',
+                (RUNNING, now, now, row['test_id']))
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+    if row:
+        return dict(row)
+    return None
+
+
+def set_state(test_id, state):
+    now = time.time()
+    finished_at = None
+    if state in [COMPLETED, ERRORED, ABORTED]:
+        finished_at = now
+    connection().execute(
+        'UPDATE tests SET state = ?, updated_at = ?, finished_at = ? WHERE test_id = ?',
+        (state, now, finished_at, test_id))
+
+
+def retry_later(test_id, not_before, error):
+    # return a running test to the queue, claimable after not_before
+    now = time.time()
+    connection().execute(
+        'UPDATE tests SET state = ?, not_before = ?, last_error = ?, started_at = NULL, updated_at = ? WHERE test_id = ?',
+        (QUEUED, not_before, error, now, test_id))
+
+
+def next_retry_at():
+    # when the first test waiting to be retried can be claimed, or None
+    row = connection().execute(
+        'SELECT MIN(not_before) AS not_before FROM tests WHERE state = ? AND not_before > ?',
+        (QUEUED, time.time())).fetchone()
+    return row['not_before']
+
+
+def get_test(test_id):
+    row = connection().execute(
+        'SELECT * FROM tests WHERE test_id = ?', (test_id,)).fetchone()
+    if row:
+        return dict(row)
+    return None
+
+
+def tests_in_state(state):
+    return [dict(row) for row in connection().execute(
+        'SELECT * FROM tests WHERE state = ?', (state,))]
+
+
+def requeue_running():
+    # return every running test to the queue, the caller moves the directories
+    now = time.time()
+    db = connection()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        rows = [dict(row) for row in db.execute(
+            'SELECT * FROM tests WHERE state = ?', (RUNNING,))]
+        db.execute('UPDATE tests SET state = ?, updated_at = ?, started_at = NULL WHERE state = ?',
+                   (QUEUED, now, RUNNING))
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+    return rows
+
+
+def queued_cells():
+    # cells with tests which can be claimed now
+    return [dict(row) for row in connection().execute(
+        'SELECT zone, image, template_type, license_host, COUNT(*) AS tests FROM tests WHERE state = ? AND (not_before IS NULL OR not_before <= ?) GROUP BY zone, image, template_type, license_host',
+        (QUEUED, time.time()))]
+
+
+def counts():
+    state_counts = {}
+    for row in connection().execute('SELECT state, COUNT(*) AS tests FROM tests GROUP BY state'):
+        state_counts[row['state']] = row['tests']
+    return state_counts
+
+
+def read_test_vars(test_dir):
+    varfile_path = os.path.join(test_dir, 'test_vars.json')
+    if not os.path.exists(varfile_path):
+        return None
+    try:
+        with open(varfile_path, 'r') as varfile:
+            return json.load(varfile)
+    except ValueError as ex:
+        LOG.error('could not read %s: %s', varfile_path, ex)
+        return None
+
+
+def import_queue_tree(queue_dir, running_dir=None):
+    # register tests already on disk, queued_tests/<zone>/<image>/<type>/<test_id>
+    # and running_tests/<test_id>, existing entries are left untouched. Queued
+    # tests keep the zone of their queue path, run.py moves them from there.
+    tests = []
+    if os.path.exists(queue_dir):
+        for zone in os.listdir(queue_dir):
+            for image in os.listdir(os.path.join(queue_dir, zone)):
+                for template_type in os.listdir(os.path.join(queue_dir, zone, image)):
+                    for test_id in os.listdir(os.path.join(queue_dir, zone, image, template_type)):
+                        # build.py finishes or removes its partial test directories
+                        if test_id.endswith('.partial'):
+                            continue
+                        qvars = read_test_vars(os.path.join(queue_dir, zone, image, template_type, test_id)) or {}
+                        tests.append((test_id, zone, image, template_type, qvars.get('license_host')))
+    add_tests(tests)
+    running = []
+    if running_dir and os.path.exists(running_dir):
+        for test_id in os.listdir(running_dir):
+            rvars = read_test_vars(os.path.join(running_dir, test_id))
+            if rvars:
+                running.append((test_id, rvars['zone'], rvars['tmos_image_name'],
+                                rvars['template_type'], rvars.get('license_host')))
+    add_tests(running, state=RUNNING)
+    LOG.info('imported %d queued and %d running tests into %s',
+             len(tests), len(running), JOB_STORE_FILE)
+    return len(tests) + len(running)
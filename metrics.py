@@ -0,0 +1,233 @@
+# coding=utf-8
+# pylint: disable=broad-except,unused-argument,line-too-long, unused-variable
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import sys
+import asyncio
+import bisect
+import logging
+
+LOG = logging.getLogger('ibmcloud_test_harness_metrics')
+LOG.setLevel(logging.DEBUG)
+FORMATTER = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+LOGSTREAM = logging.StreamHandler(sys.stdout)
+LOGSTREAM.setFormatter(FORMATTER)
+LOG.addHandler(LOGSTREAM)
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+PREFIX = 'ibmcloud_test_harness'
+
+SETTINGS = {
+    'buckets': [1, 5, 10, 30, 60, 120, 300, 600, 900, 1200, 1800, 3600],
+    'listen_address': '0.0.0.0',
+    'listen_port': None,
+    'file': None,
+    'write_interval': 30,
+    'read_timeout': 10
+}
+
+HELP = {
+    'phase_seconds': ('histogram', 'seconds a test spent in a runner phase'),
+    'phase_wait_seconds': ('histogram', 'seconds a test waited for a runner phase slot'),
+    'phase_active': ('gauge', 'tests holding a runner phase slot'),
+    'destroy_queue_depth': ('gauge', 'finished tests waiting for a destroy worker'),
+    'zone_concurrency_limit': ('gauge', 'adaptive limit of tests in flight per zone'),
+    'fast_failed_tests': ('counter', 'tests given up right after apply instead of polled until test_timeout'),
+    'slot_seconds_reclaimed': ('counter', 'test slot seconds freed by fast failed tests')
+}
+
+# name -> {label tuple: {'buckets': [], 'sum': seconds, 'count': n}}
+HISTOGRAMS = {}
+# name -> {label tuple: value}
+GAUGES = {}
+# name -> {label tuple: total}
+COUNTERS = {}
+
+
+def configure(config):
+    # config is the runner's CONFIG dictionary, metrics are served when
+    # metrics_listen_port is set and written when metrics_file is set
+    global HISTOGRAMS, GAUGES, COUNTERS
+    for setting in ['buckets', 'listen_address', 'listen_port', 'file',
+                    'write_interval', 'read_timeout']:
+        key = "metrics_%s" % setting
+        if key in config:
+            SETTINGS[setting] = config[key]
+    if SETTINGS['file'] and not SETTINGS['file'].startswith('/'):
+        SETTINGS['file'] = "%s/%s" % (SCRIPT_DIR, SETTINGS['file'])
+    SETTINGS['buckets'] = sorted(float(bucket) for bucket in SETTINGS['buckets'])
+    HISTOGRAMS = {}
+    GAUGES = {}
+    COUNTERS = {}
+    return SETTINGS['listen_port'] is not None or bool(SETTINGS['file'])
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def observe(name, labels, seconds):
+    series = HISTOGRAMS.setdefault(name, {})
+    key = label_key(labels)
+    if key not in series:
+        series[key] = {'buckets': [0] * len(SETTINGS['buckets']), 'sum': 0.0, 'count': 0}
+    histogram = series[key]
+    # counts are kept per bucket and made cumulative when rendered
+    index = bisect.bisect_left(SETTINGS['buckets'], seconds)
+    if index < len(histogram['buckets']):
+        histogram['buckets'][index] = histogram['buckets'][index] + 1
+    histogram['sum'] = histogram['sum'] + seconds
+    histogram['count'] = histogram['count'] + 1
+
+
+def set_gauge(name, labels, value):
+    GAUGES.setdefault(name, {})[label_key(labels)] = value
+
+
+def increment(name, labels, value=1):
+    series = COUNTERS.setdefault(name, {})
+    key = label_key(labels)
+    series[key] = round(series.get(key, 0) + value, 3)
+
+
+def format_labels(key, extra=None):
+    pairs = list(key)
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return "{%s}" % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for (name, value) in pairs)
+
+
+def format_bound(bound):
+    if bound == int(bound):
+        return str(int(bound))
+    return repr(bound)
+
+
+def render():
+    # Prometheus text exposition format
+    lines = []
+    for name in sorted(HISTOGRAMS):
+        metric = "%s_%s" % (PREFIX, name)
+        lines.append("# HELP %s %s" % (metric, HELP[name][1]))
+        lines.append("# TYPE %s histogram" % metric)
+        for key in sorted(HISTOGRAMS[name]):
+            histogram = HISTOGRAMS[name][key]
+            cumulative = 0
+            for (bound, count) in zip(SETTINGS['buckets'], histogram['buckets']):
+                cumulative = cumulative + count
+                lines.append("%s_bucket%s %d" % (metric, format_labels(key, ('le', format_bound(bound))), cumulative))
+            lines.append("%s_bucket%s %d" % (metric, format_labels(key, ('le', '+Inf')), histogram['count']))
+            lines.append("%s_sum%s %.3f" % (metric, format_labels(key), histogram['sum']))
+            lines.append("%s_count%s %d" % (metric, format_labels(key), histogram['count']))
+    for series in [GAUGES, COUNTERS]:
+        for name in sorted(series):
+            metric = "%s_%s" % (PREFIX, name)
+            lines.append("# HELP %s %s" % (metric, HELP[name][1]))
+            lines.append("# TYPE %s %s" % (metric, HELP[name][0]))
+            for key in sorted(series[name]):
+                lines.append("%s%s %s" % (metric, format_labels(key), series[name][key]))
+    return "%s\n" % '\n'.join(lines)
+
+
+def write_file(content):
+    tmp_file = "%s.%d" % (SETTINGS['file'], os.getpid())
+    with open(tmp_file, 'w') as mf:
+        mf.write(content)
+    os.replace(tmp_file, SETTINGS['file'])
+
+
+async def file_writer():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(SETTINGS['write_interval'])
+        try:
+            await loop.run_in_executor(None, write_file, render())
+        except Exception as ex:
+            LOG.error('could not write metrics file %s: %s', SETTINGS['file'], ex)
+
+
+async def handle_connection(reader, writer):
+    status = '404 Not Found'
+    body = b''
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=SETTINGS['read_timeout'])
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout=SETTINGS['read_timeout'])
+            if line in [b'\r\n', b'\n', b'']:
+                break
+        (method, path, version) = request_line.decode('latin-1').split()
+        if path.split('?')[0] == '/metrics':
+            if method == 'GET':
+                status = '200 OK'
+                body = render().encode('utf-8')
+            else:
+                status = '405 Method Not Allowed'
+    except Exception as ex:
+        status = '400 Bad Request'
+        LOG.error('invalid metrics request: %s', ex)
+    try:
+        writer.write(("HTTP/1.1 %s\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                      "Content-Length: %d\r\nConnection: close\r\n\r\n" %
+                      (status, len(body))).encode('latin-1') + body)
+        await writer.drain()
+        writer.close()
+    except Exception as ex:
+        LOG.error('could not respond to metrics request: %s', ex)
+
+
+async def start():
+    # returns the server and file writer to pass to stop()
+    server = None
+    writer = None
+    if SETTINGS['listen_port'] is not None:
+        server = await asyncio.start_server(
+            handle_connection, SETTINGS['listen_address'], int(SETTINGS['listen_port']))
+        LOG.info('serving metrics on http://%s:%s/metrics',
+                 SETTINGS['listen_address'], SETTINGS['listen_port'])
+    if SETTINGS['file']:
+        writer = asyncio.ensure_future(file_writer())
+        LOG.info('writing metrics to %s every %s seconds',
+                 SETTINGS['file'], SETTINGS['write_interval'])
+    return (server, writer)
+
+
+async def stop(handles):
+    (server, writer) = handles
+    if server:
+        server.close()
+    if writer:
+        writer.cancel()
+        await asyncio.get_running_loop().run_in_executor(None, write_file, render())
+
+
+def log_slowest(log, name='phase_seconds', label='zone', count=3):
+    # the slowest values of label by mean seconds for each phase
+    by_phase = {}
+    for (key, histogram) in HISTOGRAMS.get(name, {}).items():
+        labels = dict(key)
+        totals = by_phase.setdefault(labels['phase'], {}).setdefault(labels.get(label), [0.0, 0])
+        totals[0] = totals[0] + histogram['sum']
+        totals[1] = totals[1] + histogram['count']
+    for phase in sorted(by_phase):
+        means = sorted(((total / max(n, 1), value) for (value, (total, n)) in by_phase[phase].items()),
+                       reverse=True)
+        log.info('slowest %s %s: %s', phase, label,
+                 ', '.join("%s %.1f avg seconds" % (value, mean) for (mean, value) in means[0:count]))
@@ -0,0 +1,148 @@
+# coding=utf-8
+# pylint: disable=broad-except,unused-argument,line-too-long, unused-variable
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import sys
+import json
+import asyncio
+import functools
+import logging
+import re
+
+import report_client
+import event_loop
+
+LOG = logging.getLogger('ibmcloud_test_harness_phone_home')
+LOG.setLevel(logging.DEBUG)
+FORMATTER = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+LOGSTREAM = logging.StreamHandler(sys.stdout)
+LOGSTREAM.setFormatter(FORMATTER)
+LOG.addHandler(LOGSTREAM)
+
+SETTINGS = {
+    'listen_address': '0.0.0.0',
+    'listen_port': None,
+    'read_timeout': 30,
+    'max_body_size': 1048576
+}
+
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    502: 'Bad Gateway'
+}
+
+# POST /stop/<test_id> is an instance phone home, relayed to the report
+# service. POST /notify/<test_id> is a push from the report service.
+PATH_PATTERN = re.compile(r'^/(stop|notify)/([0-9A-Za-z-]+)/?$')
+
+COUNTS = {
+    'stop': 0,
+    'notify': 0,
+    'rejected': 0
+}
+
+
+def configure(config):
+    # config is the runner's CONFIG dictionary, the listener
+    # is only started when phone_home_listen_port is set
+    for setting in ['listen_address', 'listen_port', 'read_timeout', 'max_body_size']:
+        key = "phone_home_%s" % setting
+        if key in config:
+            SETTINGS[setting] = config[key]
+    return SETTINGS['listen_port'] is not None
+
+
+async def read_request(reader):
+    request_line = await reader.readline()
+    (method, path, version) = request_line.decode('latin-1').split()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in [b'\r\n', b'\n', b'']:
+            break
+        (name, value) = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    body = b''
+    length = int(headers.get('content-length', 0))
+    if length > int(SETTINGS['max_body_size']):
+        return (method, path, None)
+    if length > 0:
+        body = await reader.readexactly(length)
+    return (method, path, body)
+
+
+async def handle_request(method, path, body, on_phone_home):
+    match = PATH_PATTERN.match(path.split('?')[0])
+    if not match:
+        return 404
+    if method != 'POST':
+        return 405
+    if body is None:
+        return 413
+    (action, test_id) = match.groups()
+    status = 200
+    if action == 'stop':
+        try:
+            results = json.loads(body.decode('utf-8') or '{}')
+        except ValueError:
+            return 400
+        response = await event_loop.run_blocking(report_client.stop, test_id, results)
+        if response is None:
+            return 502
+        status = response.status_code
+    COUNTS[action] = COUNTS[action] + 1
+    LOG.debug('phone home %s received for test %s', action, test_id)
+    on_phone_home(test_id)
+    return status
+
+
+async def handle_connection(on_phone_home, reader, writer):
+    status = 400
+    try:
+        (method, path, body) = await asyncio.wait_for(
+            read_request(reader), timeout=SETTINGS['read_timeout'])
+        status = await handle_request(method, path, body, on_phone_home)
+    except Exception as ex:
+        LOG.error('invalid phone home request: %s', ex)
+    if status >= 400:
+        COUNTS['rejected'] = COUNTS['rejected'] + 1
+    try:
+        writer.write(("HTTP/1.1 %d %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n" %
+                      (status, REASONS.get(status, ''))).encode('latin-1'))
+        await writer.drain()
+        writer.close()
+    except Exception as ex:
+        LOG.error('could not respond to phone home request: %s', ex)
+
+
+async def start(on_phone_home):
+    # on_phone_home(test_id) is called on the event loop for
+    # every accepted phone home or report service push
+    server = await asyncio.start_server(
+        functools.partial(handle_connection, on_phone_home),
+        SETTINGS['listen_address'], int(SETTINGS['listen_port']))
+    LOG.info('listening for phone home requests on %s:%s',
+             SETTINGS['listen_address'], SETTINGS['listen_port'])
+    return server
+
+
+def log_counts(log):
+    log.info('phone home listener: %d relayed, %d report service pushes, %d rejected',
+             COUNTS['stop'], COUNTS['notify'], COUNTS['rejected'])
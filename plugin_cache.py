@@ -0,0 +1,156 @@
+# coding=utf-8
+# pylint: disable=broad-except,unused-argument,line-too-long, unused-variable
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import sys
+import glob
+import json
+import logging
+import shutil
+import subprocess
+import tarfile
+import threading
+import time
+
+LOG = logging.getLogger('ibmcloud_test_harness_plugin_cache')
+LOG.setLevel(logging.DEBUG)
+FORMATTER = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+LOGSTREAM = logging.StreamHandler(sys.stdout)
+LOGSTREAM.setFormatter(FORMATTER)
+LOG.addHandler(LOGSTREAM)
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+TEMPLATE_DIR = "%s/templates" % SCRIPT_DIR
+PLUGIN_CACHE_DIR = "%s/terraform_plugin_cache" % SCRIPT_DIR
+PREWARM_DIR_NAME = '.prewarm'
+COLD_INIT_FILE_NAME = '.cold_init.json'
+
+SAVINGS = {
+    'tests': 0,
+    'init_seconds_saved': 0.0,
+    'disk_bytes_saved': 0
+}
+SAVINGS_LOCK = threading.Lock()
+COLD_INIT = {}
+
+
+def configure(config):
+    # every terraform process started after this inherits
+    # TF_PLUGIN_CACHE_DIR, python_terraform copies os.environ
+    global PLUGIN_CACHE_DIR
+    if 'terraform_plugin_cache_dir' in config and config['terraform_plugin_cache_dir']:
+        PLUGIN_CACHE_DIR = config['terraform_plugin_cache_dir']
+        if not PLUGIN_CACHE_DIR.startswith('/'):
+            PLUGIN_CACHE_DIR = "%s/%s" % (SCRIPT_DIR, PLUGIN_CACHE_DIR)
+    os.makedirs(PLUGIN_CACHE_DIR, exist_ok=True)
+    os.environ['TF_PLUGIN_CACHE_DIR'] = PLUGIN_CACHE_DIR
+    return PLUGIN_CACHE_DIR
+
+
+def disk_usage(path):
+    # symlinks into the plugin cache are counted at their own size
+    total = 0
+    for (root, dirs, files) in os.walk(path):
+        for name in files:
+            try:
+                total = total + os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def cached_plugins_size():
+    total = 0
+    for entry in os.listdir(PLUGIN_CACHE_DIR):
+        entry_path = os.path.join(PLUGIN_CACHE_DIR, entry)
+        if entry.startswith('.'):
+            continue
+        if os.path.isdir(entry_path):
+            total = total + disk_usage(entry_path)
+        else:
+            total = total + os.lstat(entry_path).st_size
+    return total
+
+
+def terraform_init(working_dir, env):
+    start = time.time()
+    completed = subprocess.run(['terraform', 'init', '-backend=false', '-input=false', '-no-color'],
+                               cwd=working_dir, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if completed.returncode > 0:
+        LOG.error('terraform init failed in %s: %s',
+                  working_dir, completed.stderr.decode('utf-8'))
+    return (completed.returncode, time.time() - start)
+
+
+def prewarm():
+    # initialize every template once so the providers are in the cache
+    # before the first test runs. The first, uncached, init duration is
+    # kept as the baseline each test init is compared against.
+    global COLD_INIT
+    cold_init_file = os.path.join(PLUGIN_CACHE_DIR, COLD_INIT_FILE_NAME)
+    if os.path.exists(cold_init_file):
+        with open(cold_init_file, 'r') as cif:
+            COLD_INIT = json.load(cif)
+    prewarm_dir = os.path.join(PLUGIN_CACHE_DIR, PREWARM_DIR_NAME)
+    for template in glob.glob("%s/*.tar.gz" % TEMPLATE_DIR):
+        template_name = os.path.basename(template).split('.')[0]
+        template_dir = os.path.join(prewarm_dir, template_name)
+        shutil.rmtree(template_dir, ignore_errors=True)
+        os.makedirs(template_dir)
+        with tarfile.open(template) as template_archive:
+            template_archive.extractall(template_dir)
+        if template_name not in COLD_INIT:
+            # measure one init without the cache as the per test baseline
+            uncached_env = dict(os.environ)
+            uncached_env.pop('TF_PLUGIN_CACHE_DIR', None)
+            (returncode, duration) = terraform_init(template_dir, uncached_env)
+            if returncode == 0:
+                COLD_INIT[template_name] = {
+                    'init_seconds': duration,
+                    'disk_bytes': disk_usage(os.path.join(template_dir, '.terraform'))
+                }
+            shutil.rmtree(os.path.join(template_dir, '.terraform'), ignore_errors=True)
+        LOG.info('pre-warming terraform plugin cache for %s', template_name)
+        (returncode, duration) = terraform_init(template_dir, dict(os.environ))
+    with open(cold_init_file, 'w') as cif:
+        json.dump(COLD_INIT, cif)
+    shutil.rmtree(prewarm_dir, ignore_errors=True)
+    LOG.info('terraform plugin cache %s holds %d bytes of providers',
+             PLUGIN_CACHE_DIR, cached_plugins_size())
+
+
+def record_init(test_id, template_name, test_dir, init_seconds):
+    if template_name not in COLD_INIT:
+        return
+    init_saved = COLD_INIT[template_name]['init_seconds'] - init_seconds
+    disk_saved = COLD_INIT[template_name]['disk_bytes'] - \
+        disk_usage(os.path.join(test_dir, '.terraform'))
+    with SAVINGS_LOCK:
+        SAVINGS['tests'] = SAVINGS['tests'] + 1
+        SAVINGS['init_seconds_saved'] = SAVINGS['init_seconds_saved'] + init_saved
+        SAVINGS['disk_bytes_saved'] = SAVINGS['disk_bytes_saved'] + disk_saved
+    LOG.debug('test %s init took %.1f seconds, plugin cache saved %.1f seconds and %d bytes',
+              test_id, init_seconds, init_saved, disk_saved)
+
+
+def log_savings(log):
+    with SAVINGS_LOCK:
+        if SAVINGS['tests'] > 0:
+            log.info('terraform plugin cache saved %.1f init seconds and %d bytes of disk over %d tests',
+                     SAVINGS['init_seconds_saved'], SAVINGS['disk_bytes_saved'], SAVINGS['tests'])
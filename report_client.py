@@ -0,0 +1,189 @@
+# coding=utf-8
+# pylint: disable=broad-except,unused-argument,line-too-long, unused-variable
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import sys
+import json
+import logging
+import threading
+import time
+import requests
+import requests.adapters
+import urllib3
+
+import jitter
+
+LOG = logging.getLogger('ibmcloud_test_harness_report_client')
+LOG.setLevel(logging.DEBUG)
+FORMATTER = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+LOGSTREAM = logging.StreamHandler(sys.stdout)
+LOGSTREAM.setFormatter(FORMATTER)
+LOG.addHandler(LOGSTREAM)
+
+SETTINGS = {
+    'base_url': None,
+    'timeout': 10,
+    'retries': 3,
+    'backoff': 0.5,
+    'pool_size': 10
+}
+
+SESSION = None
+SESSION_LOCK = threading.Lock()
+
+LATENCY = {}
+LATENCY_LOCK = threading.Lock()
+
+RETRY_STATUS_CODES = [429, 502, 503, 504]
+# start and stop are POSTs the service records every time, a timeout or
+# 5xx response may follow a recorded request so they are not retried
+NON_IDEMPOTENT_RETRY_STATUS_CODES = [429]
+
+
+def configure(config):
+    # config is the script's CONFIG dictionary, optional
+    # report_service_* keys override the client defaults
+    global SESSION
+    SETTINGS['base_url'] = config['report_service_base_url'].rstrip('/')
+    for setting in ['timeout', 'retries', 'backoff', 'pool_size']:
+        key = "report_service_%s" % setting
+        if key in config:
+            SETTINGS[setting] = config[key]
+    with SESSION_LOCK:
+        if SESSION:
+            SESSION.close()
+        SESSION = None
+
+
+def get_session():
+    global SESSION
+    with SESSION_LOCK:
+        if not SESSION:
+            # one keep-alive pool to the report service, callers
+            # block for a free connection instead of opening more
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=int(SETTINGS['pool_size']),
+                pool_block=True)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update({'Content-Type': 'application/json'})
+            SESSION = session
+        return SESSION
+
+
+def record_latency(endpoint, duration, failed):
+    with LATENCY_LOCK:
+        if endpoint not in LATENCY:
+            LATENCY[endpoint] = {
+                'requests': 0,
+                'errors': 0,
+                'total_seconds': 0.0,
+                'max_seconds': 0.0
+            }
+        stats = LATENCY[endpoint]
+        stats['requests'] = stats['requests'] + 1
+        stats['total_seconds'] = stats['total_seconds'] + duration
+        stats['max_seconds'] = max(stats['max_seconds'], duration)
+        if failed:
+            stats['errors'] = stats['errors'] + 1
+
+
+def latency_metrics():
+    metrics = {}
+    with LATENCY_LOCK:
+        for endpoint in LATENCY:
+            stats = dict(LATENCY[endpoint])
+            stats['average_seconds'] = stats['total_seconds'] / stats['requests']
+            metrics[endpoint] = stats
+    return metrics
+
+
+def log_latency_metrics(log):
+    metrics = latency_metrics()
+    for endpoint in sorted(metrics):
+        stats = metrics[endpoint]
+        log.info('report service %s: %d requests, %d errors, %.3f avg seconds, %.3f max seconds',
+                 endpoint, stats['requests'], stats['errors'],
+                 stats['average_seconds'], stats['max_seconds'])
+
+
+def connection_refused(ex):
+    # the request never reached the report service
+    if isinstance(ex, requests.exceptions.ConnectTimeout):
+        return True
+    reason = ex.args[0] if ex.args else None
+    return isinstance(getattr(reason, 'reason', reason), urllib3.exceptions.NewConnectionError)
+
+
+def request(method, endpoint, path, data=None, idempotent=True):
+    url = "%s/%s" % (SETTINGS['base_url'], path)
+    retry_status_codes = RETRY_STATUS_CODES
+    if not idempotent:
+        retry_status_codes = NON_IDEMPOTENT_RETRY_STATUS_CODES
+    body = None
+    if data is not None:
+        body = json.dumps(data)
+    attempts = int(SETTINGS['retries']) + 1
+    for attempt in range(attempts):
+        start = time.time()
+        try:
+            response = get_session().request(
+                method, url, data=body, timeout=SETTINGS['timeout'])
+            failed = response.status_code in RETRY_STATUS_CODES
+            record_latency(endpoint, time.time() - start, failed)
+            if response.status_code not in retry_status_codes:
+                return response
+            LOG.warning('report service %s %s returned %d (attempt %d of %d)',
+                        method, url, response.status_code, attempt + 1, attempts)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as ex:
+            record_latency(endpoint, time.time() - start, True)
+            LOG.warning('report service %s %s failed: %s (attempt %d of %d)',
+                        method, url, ex, attempt + 1, attempts)
+            if not idempotent and not connection_refused(ex):
+                LOG.error('report service %s %s may have been received, not retrying', method, url)
+                return None
+        if attempt + 1 < attempts:
+            time.sleep(jitter.full_jitter(attempt, SETTINGS['backoff']))
+    LOG.error('report service %s %s failed after %d attempts', method, url, attempts)
+    return None
+
+
+def start(test_id, start_data):
+    return request('POST', 'start', "start/%s" % test_id, start_data, idempotent=False)
+
+
+def update(test_id, update_data):
+    return request('PUT', 'update', "report/%s" % test_id, update_data)
+
+
+def stop(test_id, results):
+    return request('POST', 'stop', "stop/%s" % test_id, results, idempotent=False)
+
+
+def get(test_id):
+    response = request('GET', 'report', "report/%s" % test_id)
+    if response is not None and response.status_code < 400:
+        return response.json()
+    return None
+
+
+def get_all():
+    response = request('GET', 'reports', 'report')
+    if response is not None and response.status_code < 400:
+        return response.json()
+    return None
@@ -22,9 +22,12 @@ import json
 import logging
 import datetime
 import time
-import requests
-import shutil
-import python_terraform as pt
+import re
+import argparse
+import concurrent.futures
+import report_client
+import plugin_cache
+import destroy_engine
 
 LOG = logging.getLogger('ibmcloud_test_process_running')
 LOG.setLevel(logging.DEBUG)
@@ -40,39 +43,111 @@ RUNNING_DIR = "%s/running_tests" % SCRIPT_DIR
 CONFIG_FILE = "%s/builder-config.json" % SCRIPT_DIR
 CONFIG = {}
 
+RESOURCES_KEY = '"resources"'
+RESOURCES_PATTERN = re.compile(r'%s\s*:\s*\[' % RESOURCES_KEY)
+SEPARATOR_PATTERN = re.compile(r'[\s,]*')
 
-def clean():
+
+def instance_resources(state_file, chunk_size=65536):
+    # stream the state's resources array one resource at a time, only
+    # ibm_is_instance resources are kept, the rest are dropped as read
+    decoder = json.JSONDecoder()
+    with open(state_file, 'r') as sf:
+        buffer = ''
+        while True:
+            chunk = sf.read(chunk_size)
+            if not chunk:
+                return
+            buffer = buffer + chunk
+            match = RESOURCES_PATTERN.search(buffer)
+            if match:
+                buffer = buffer[match.end():]
+                break
+            # keep a key the next chunk may complete, whole or cut short
+            key_at = buffer.rfind(RESOURCES_KEY)
+            if key_at < 0:
+                key_at = len(buffer) - len(RESOURCES_KEY)
+            buffer = buffer[max(key_at, 0):]
+        position = 0
+        while True:
+            position = SEPARATOR_PATTERN.match(buffer, position).end()
+            if buffer.startswith(']', position):
+                return
+            try:
+                (resource, position) = decoder.raw_decode(buffer, position)
+            except ValueError:
+                chunk = sf.read(chunk_size)
+                if not chunk:
+                    return
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            if isinstance(resource, dict) and resource.get('type') == 'ibm_is_instance':
+                yield resource
+
+
+def scan_test(test_id):
+    instance = None
+    state_file = os.path.join(RUNNING_DIR, test_id, 'terraform.tfstate')
+    if not os.path.exists(state_file):
+        return (test_id, None)
+    for r in instance_resources(state_file):
+        instance = {
+            'instance_id': r['instances'][0]['attributes']['id'],
+            'image_id': r['instances'][0]['attributes']['image'],
+            'status': r['instances'][0]['attributes']['status']
+        }
+    return (test_id, instance)
+
+
+def log_to_stderr():
+    # keep stdout for the JSON lines report
+    for module in [sys.modules[__name__], report_client, plugin_cache, destroy_engine]:
+        module.LOGSTREAM.setStream(sys.stderr)
+
+
+def clean(scan_workers, destroy_workers, output):
+    # returns False when the reports could not be read or
+    # a left over test could not be destroyed
     if os.path.exists(RUNNING_DIR):
-        test_dirs = os.listdir(RUNNING_DIR)
-        left_over_tests = []
-        for test_id in test_dirs:
-            left_over_tests.append(test_id)
-        report_url = "%s/report" % CONFIG['report_service_base_url']
-        resp = requests.get(report_url)
-        reports = resp.json()
-        output = {}
+        left_over_tests = set(os.listdir(RUNNING_DIR))
+        reports = report_client.get_all()
+        if reports is None:
+            LOG.error('could not retrieve reports from %s', CONFIG['report_service_base_url'])
+            return False
+        timed_out = []
+        test_pool = []
         for test_id in reports:
             if 'test timedout' in reports[test_id]['results'] and \
                     test_id in left_over_tests:
-                state = {}
-                with open(os.path.join(RUNNING_DIR, test_id, 'terraform.tfstate'), 'r') as sf:
-                    state = json.load(sf)
-                for r in state['resources']:
-                    if r['type'] == 'ibm_is_instance':
-                        output[test_id] = {
-                            'instance_id': r['instances'][0]['attributes']['id'],
-                            'image_id': r['instances'][0]['attributes']['image'],
-                            'status': r['instances'][0]['attributes']['status']
-                        }
+                timed_out.append(test_id)
             else:
                 test_dir = os.path.join(RUNNING_DIR, test_id)
                 if os.path.exists(test_dir):
-                    tf = pt.Terraform(working_dir=test_dir, var_file='test_vars.tfvars')
-                    tf.init()
-                    tf.destroy()
-                    shutil.rmtree(test_dir)
-        print(json.dumps(output, sort_keys=True,
-              indent=4, separators=(',', ': ')))
+                    test_pool.append(test_dir)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as destroyer:
+            destroys = destroyer.submit(destroy_engine.destroy_all, test_pool, destroy_workers)
+            # one JSON line per timed out instance, written as each scan finishes
+            with concurrent.futures.ThreadPoolExecutor(max_workers=scan_workers) as scanner:
+                scans = [scanner.submit(scan_test, test_id) for test_id in timed_out]
+                for scan in concurrent.futures.as_completed(scans):
+                    try:
+                        (test_id, instance) = scan.result()
+                    except Exception as ex:
+                        LOG.error('could not read terraform state: %s', ex)
+                        continue
+                    if instance:
+                        instance['test_id'] = test_id
+                        output.write("%s\n" % json.dumps(instance, sort_keys=True))
+                        output.flush()
+            LOG.info('%d timed out tests scanned, waiting for destroys to finish', len(timed_out))
+            try:
+                summary = destroys.result()
+            except Exception as ex:
+                LOG.exception('destroy of left over tests failed: %s', ex)
+                return False
+            return not summary[destroy_engine.FAILED]
+    return True
 
 
 def initialize():
@@ -81,17 +156,35 @@ def initialize():
     with open(CONFIG_FILE, 'r') as cf:
         config_json = cf.read()
     CONFIG = json.loads(config_json)
+    report_client.configure(CONFIG)
+    plugin_cache.configure(CONFIG)
+    destroy_engine.configure(CONFIG)
 
 
 if __name__ == "__main__":
     START_TIME = time.time()
+    PARSER = argparse.ArgumentParser(
+        description='report timed out instances and destroy other left over running tests')
+    PARSER.add_argument('--scan-workers', type=int, default=os.cpu_count(),
+                        help='terraform state files read at once')
+    PARSER.add_argument('--destroy-workers', type=int, default=None,
+                        help='left over tests destroyed at once, default destroy_workers or 10')
+    PARSER.add_argument('--output', default='-',
+                        help='file for the JSON lines report, default stdout with logging on stderr')
+    ARGS = PARSER.parse_args()
+    if ARGS.output == '-':
+        log_to_stderr()
     LOG.debug('process start time: %s', datetime.datetime.fromtimestamp(
         START_TIME).strftime("%A, %B %d, %Y %I:%M:%S"))
     initialize()
     ERROR_MESSAGE = ''
     ERROR = False
 
-    clean()
+    if ARGS.output == '-':
+        CLEANED = clean(ARGS.scan_workers, ARGS.destroy_workers, sys.stdout)
+    else:
+        with open(ARGS.output, 'w') as OUTPUT:
+            CLEANED = clean(ARGS.scan_workers, ARGS.destroy_workers, OUTPUT)
 
     STOP_TIME = time.time()
     DURATION = STOP_TIME - START_TIME
@@ -101,4 +194,6 @@ if __name__ == "__main__":
             STOP_TIME).strftime("%A, %B %d, %Y %I:%M:%S"),
         DURATION
     )
+    if not CLEANED:
+        sys.exit(1)
 
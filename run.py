@@ -22,12 +22,22 @@ import json
 import logging
 import datetime
 import time
-import requests
-import concurrent.futures
-import threading
+import asyncio
+import functools
+import contextlib
 import shutil
 import python_terraform as pt
-import random
+import argparse
+import signal
+import report_client
+import plugin_cache
+import job_store
+import scheduler
+import phone_home
+import metrics
+import terraform_errors
+import jitter
+import event_loop
 
 LOG = logging.getLogger('ibmcloud_test_harness_run')
 LOG.setLevel(logging.DEBUG)
@@ -47,6 +57,22 @@ ERRORED_DIR = "%s/errored_tests" % SCRIPT_DIR
 CONFIG_FILE = "%s/runners-config.json" % SCRIPT_DIR
 CONFIG = {}
 
+PHASES = ['init', 'apply', 'poll', 'destroy']
+# ibm_is_instance states which never phone home
+DEAD_INSTANCE_STATES = ['failed']
+PHASE_LIMITS = {}
+STAGE_STATS = {}
+DESTROY_QUEUE = None
+REPORT_WAITERS = {}
+COMPLETED_BY = {'phone_home': 0, 'poll': 0}
+PHONED_HOME = set()
+RUNNING_TESTS = set()
+DRAINING = None
+RETRIED = {}
+FAST_FAILED = {}
+RECLAIMED = {'slot_seconds': 0.0}
+METRICS_ENABLED = False
+
 MY_PID = None
 
 
@@ -59,75 +85,363 @@ def check_pid(pid):
         return True
 
 
-def start_report(test_id, start_data):
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    requests.post("%s/start/%s" % (CONFIG['report_service_base_url'], test_id),
-                  headers=headers, data=json.dumps(start_data))
+async def fetch_waiting_reports(test_ids):
+    # one bulk request for every waiting test, falling back
+    # to a request per test if the collection can not be read
+    try:
+        reports = await event_loop.run_blocking(report_client.get_all)
+        if reports is not None:
+            return reports
+    except Exception as ex:
+        LOG.error('could not retrieve report collection: %s', ex)
+    reports = {}
+    for test_id in test_ids:
+        try:
+            data = await event_loop.run_blocking(report_client.get, test_id)
+            if data:
+                reports[test_id] = data
+        except Exception as ex:
+            LOG.error('could not retrieve report for test_id: %s - %s', test_id, ex)
+    return reports
 
 
-def update_report(test_id, update_data):
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    requests.put("%s/report/%s" % (CONFIG['report_service_base_url'], test_id),
-                 headers=headers, data=json.dumps(update_data))
+async def report_poller():
+    while True:
+        await asyncio.sleep(CONFIG['report_request_frequency'])
+        if not REPORT_WAITERS:
+            continue
+        reports = await fetch_waiting_reports(list(REPORT_WAITERS.keys()))
+        for (test_id, waiter) in list(REPORT_WAITERS.items()):
+            data = reports.get(test_id)
+            if data and data['duration'] > 0 and not waiter.done():
+                LOG.info('test run %s completed', test_id)
+                COMPLETED_BY['poll'] = COMPLETED_BY['poll'] + 1
+                waiter.set_result(data)
+        LOG.debug('%d tests waiting on reports', len(REPORT_WAITERS))
 
 
-def stop_report(test_id, results):
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    requests.post("%s/stop/%s" % (CONFIG['report_service_base_url'], test_id),
-                  headers=headers, data=json.dumps(results))
+async def wake_test(test_id):
+    try:
+        data = await event_loop.run_blocking(report_client.get, test_id)
+    except Exception as ex:
+        LOG.error('could not retrieve report for test_id: %s - %s', test_id, ex)
+        return
+    waiter = REPORT_WAITERS.get(test_id)
+    if data and data['duration'] > 0 and waiter and not waiter.done():
+        LOG.info('test run %s completed, phoned home', test_id)
+        COMPLETED_BY['phone_home'] = COMPLETED_BY['phone_home'] + 1
+        waiter.set_result(data)
+
+
+def phone_home_received(test_id):
+    # the report poller remains the fallback if the report
+    # is not complete yet or a phone home never arrives. A
+    # phone home can beat the end of apply, the test checks
+    # for it once it starts waiting. Phone homes for tests
+    # this runner is not running are not kept.
+    if test_id in REPORT_WAITERS:
+        asyncio.ensure_future(wake_test(test_id))
+    elif test_id in RUNNING_TESTS:
+        PHONED_HOME.add(test_id)
+
+
+async def poll_report(test_id):
+    waiter = asyncio.get_running_loop().create_future()
+    REPORT_WAITERS[test_id] = waiter
+    if test_id in PHONED_HOME:
+        PHONED_HOME.discard(test_id)
+        asyncio.ensure_future(wake_test(test_id))
+    try:
+        return await asyncio.wait_for(waiter, timeout=int(CONFIG['test_timeout']))
+    except asyncio.TimeoutError:
+        return None
+    finally:
+        REPORT_WAITERS.pop(test_id, None)
+
+
+async def terraform(test_dir, command, *args, **options):
+    # python_terraform builds the command line, the command itself runs as
+    # an asyncio subprocess so waiting on terraform does not hold a thread
+    tf = pt.Terraform(working_dir=test_dir, var_file='test_vars.tfvars')
+    cmds = tf.generate_cmd_string(command, *args, **options)
+    proc = await asyncio.create_subprocess_exec(*cmds, cwd=test_dir,
+                                                stdout=asyncio.subprocess.PIPE,
+                                                stderr=asyncio.subprocess.PIPE)
+    (out, err) = await proc.communicate()
+    return (proc.returncode, out.decode('utf-8'), err.decode('utf-8'))
+
+
+def phase_options(phase, options):
+    # runners-config.json terraform_options for the phase, such as
+    # parallelism, refresh or lock_timeout, override the defaults
+    if 'terraform_options' in CONFIG and phase in CONFIG['terraform_options']:
+        options.update(CONFIG['terraform_options'][phase])
+    return options
+
+
+async def tf_init(test_dir):
+    return await terraform(test_dir, 'init', **phase_options('init', {
+        'reconfigure': pt.IsFlagged, 'backend': True, 'var_file': 'test_vars.tfvars',
+        'input': False, 'no_color': pt.IsFlagged}))
+
+
+async def tf_apply(test_dir):
+    return await terraform(test_dir, 'apply', **phase_options('apply', {
+        'auto_approve': True, 'var_file': 'test_vars.tfvars',
+        'input': False, 'no_color': pt.IsFlagged}))
+
+
+async def tf_output(test_dir):
+    (rc, out, err) = await terraform(test_dir, 'output', json=pt.IsFlagged)
+    if rc > 0:
+        return None
+    return json.loads(out.lstrip())
+
+
+async def tf_destroy(test_dir):
+    return await terraform(test_dir, 'destroy', **phase_options('destroy', {
+        'force': pt.IsFlagged, 'var_file': 'test_vars.tfvars',
+        'input': False, 'no_color': pt.IsFlagged}))
+
+
+def test_labels(zone, image, ttype):
+    return {'zone': zone, 'image': image, 'template_type': ttype}
+
+
+@contextlib.asynccontextmanager
+async def stage(phase, labels):
+    # hold one of the phase's slots and count the time spent in it,
+    # labels are the test's zone, image and template type
+    labels = dict(labels, phase=phase)
+    wait_start = time.time()
+    async with PHASE_LIMITS[phase]:
+        stats = STAGE_STATS[phase]
+        stats['active'] = stats['active'] + 1
+        metrics.set_gauge('phase_active', {'phase': phase}, stats['active'])
+        start = time.time()
+        metrics.observe('phase_wait_seconds', labels, start - wait_start)
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            stats['active'] = stats['active'] - 1
+            stats['completed'] = stats['completed'] + 1
+            stats['seconds'] = stats['seconds'] + seconds
+            metrics.set_gauge('phase_active', {'phase': phase}, stats['active'])
+            metrics.observe('phase_seconds', labels, seconds)
+
+
+async def destroy_test(test_id, test_dir, message, labels):
+    LOG.info(message, test_id)
+    async with stage('destroy', labels):
+        (rc, out, err) = await tf_destroy(test_dir)
+    if rc > 0:
+        LOG.error('could not destroy test: %s: %s. Manually fix.', test_id, err)
+    return rc
+
+
+async def queue_destroy(test_id, test_dir, message, labels, dest=None):
+    # hand the test to the destroy workers, the test's slot is free
+    # as soon as this returns. dest keeps the test directory after
+    # the destroy, otherwise it is removed.
+    await DESTROY_QUEUE.put((test_id, test_dir, message, labels, dest))
+    metrics.set_gauge('destroy_queue_depth', {}, DESTROY_QUEUE.qsize())
+
+
+async def destroy_worker():
+    while True:
+        (test_id, test_dir, message, labels, dest) = await DESTROY_QUEUE.get()
+        metrics.set_gauge('destroy_queue_depth', {}, DESTROY_QUEUE.qsize())
+        try:
+            await destroy_test(test_id, test_dir, message, labels)
+            if dest:
+                await event_loop.run_blocking(shutil.move, test_dir, dest)
+            else:
+                await event_loop.run_blocking(shutil.rmtree, test_dir)
+        except Exception as ex:
+            LOG.exception('destroy of test %s failed in the runner: %s', test_id, ex)
+        finally:
+            DESTROY_QUEUE.task_done()
+
+
+async def queue_pending_destroys():
+    # tests which finished but were not destroyed before the last
+    # runner exited are left in running_tests in a finished state
+    for test_id in await event_loop.run_blocking(os.listdir, RUNNING_DIR):
+        test = await event_loop.run_blocking(job_store.get_test, test_id)
+        if test and test['state'] in [job_store.COMPLETED, job_store.ERRORED]:
+            dest = None
+            if test['state'] == job_store.COMPLETED and \
+               'keep_completed_state' in CONFIG and CONFIG['keep_completed_state']:
+                dest = os.path.join(COMPLETE_DIR, test_id)
+            await queue_destroy(test_id, os.path.join(RUNNING_DIR, test_id),
+                                'destroying cloud resources for interrupted test %s',
+                                test_labels(test['zone'], test['image'], test['template_type']), dest)
 
 
-def poll_report(test_id):
-    end_time = time.time() + int(CONFIG['test_timeout'])
-    while (end_time - time.time()) > 0:
-        base_url = CONFIG['report_service_base_url']
-        headers = {
-            'Content-Type': 'application/json'
+def log_pipeline_stats(elapsed):
+    for phase in PHASES:
+        stats = STAGE_STATS[phase]
+        average = 0.0
+        if stats['completed'] > 0:
+            average = stats['seconds'] / stats['completed']
+        LOG.info('%s stage: %d active, %d completed, %.1f avg seconds, %.2f tests per minute',
+                 phase, stats['active'], stats['completed'], average,
+                 stats['completed'] * 60.0 / max(elapsed, 1))
+    LOG.info('destroy queue depth: %d', DESTROY_QUEUE.qsize())
+    if scheduler.ADAPTIVE:
+        LOG.info('adaptive zone concurrency limits: %s', scheduler.adaptive_limits())
+
+
+async def pipeline_monitor(start, interval):
+    while True:
+        await asyncio.sleep(interval)
+        log_pipeline_stats(time.time() - start)
+
+
+def retry_setting(setting, default):
+    key = "retry_%s" % setting
+    if key in CONFIG and CONFIG[key] is not None:
+        return CONFIG[key]
+    return default
+
+
+def retry_delay(attempt):
+    # attempt is the attempt which failed, counted from 1
+    return jitter.full_jitter(attempt - 1, retry_setting('backoff', 60), retry_setting('max_backoff', 900))
+
+
+def requeue_test_dir(test, test_dir):
+    queue_path = os.path.join(
+        QUEUE_DIR, test['zone'], test['image'], test['template_type'])
+    os.makedirs(queue_path, exist_ok=True)
+    shutil.move(test_dir, os.path.join(queue_path, test['test_id']))
+
+
+async def retry_test(test, test_dir, labels, phase, err):
+    # put a test whose init or apply failed with a transient error back
+    # on the queue after a backoff, destroying whatever the failed apply
+    # created first. Returns False when the test should fail instead.
+    test_id = test['test_id']
+    error_class = terraform_errors.classify(err)
+    if error_class == terraform_errors.PERMANENT:
+        return False
+    attempt = test['attempts'] + 1
+    attempts = int(retry_setting('attempts', 3))
+    if attempt >= attempts:
+        LOG.error('test %s failed %s with a %s error on attempt %d of %d, not retrying',
+                  test_id, phase, error_class, attempt, attempts)
+        return False
+    if phase == 'apply':
+        rc = await destroy_test(test_id, test_dir,
+                                'destroying partial cloud resources for test %s before a retry', labels)
+        if rc > 0:
+            return False
+    delay = retry_delay(attempt)
+    LOG.warning('test %s failed %s with a %s error, retrying in %.0f seconds (attempt %d of %d)',
+                test_id, phase, error_class, delay, attempt, attempts)
+    await event_loop.run_blocking(report_client.update, test_id, {
+        'terraform_retry': {
+            'phase': phase,
+            'error_class': error_class,
+            'error': terraform_errors.summary(err),
+            'attempt': attempt
         }
-        response = requests.get("%s/report/%s" %
-                                (base_url, test_id), headers=headers)
-        if response.status_code < 400:
-            data = response.json()
-            if data['duration'] > 0:
-                LOG.info('test run %s completed', test_id)
-                return data
-        seconds_left = int(end_time - time.time())
-        LOG.debug('test_id: %s with %s seconds left',
-                  test_id, str(seconds_left))
-        time.sleep(CONFIG['report_request_frequency'])
+    })
+    await event_loop.run_blocking(requeue_test_dir, test, test_dir)
+    await event_loop.run_blocking(job_store.retry_later, test_id, time.time() + delay,
+                       "%s %s: %s" % (phase, error_class, terraform_errors.summary(err)))
+    RETRIED[error_class] = RETRIED.get(error_class, 0) + 1
+    return True
+
+
+def output_value(out, name):
+    if out and name in out and isinstance(out[name], dict):
+        return out[name].get('value')
     return None
 
 
-def run_test(test_path):
-    (zone, image, ttype, test_dir) = initialize_test_dir(test_path)
+def dead_test(rc, err, out):
+    # (kind, reason) for a test which can never report back after
+    # its apply, otherwise None
+    if rc > 0:
+        return ('apply_failed', "apply failure: %s" % err)
+    instance_id = output_value(out, 'instance_id')
+    if not instance_id:
+        return ('missing_outputs', 'apply failure: no instance_id in terraform outputs')
+    status = output_value(out, 'resource_status')
+    if status in DEAD_INSTANCE_STATES:
+        return ('instance_failed', "apply failure: instance %s is %s" % (instance_id, status))
+    return None
+
+
+async def errored_test(test_id, test_dir, labels):
+    await event_loop.run_blocking(job_store.set_state, test_id, job_store.ERRORED)
+    if 'preserve_errored_instances' in CONFIG and CONFIG['preserve_errored_instances']:
+        LOG.error('preserving errored instance for test: %s for debug', test_id)
+        os.makedirs(ERRORED_DIR, exist_ok=True)
+        await event_loop.run_blocking(shutil.move, test_dir, os.path.join(ERRORED_DIR, test_id))
+    else:
+        await queue_destroy(test_id, test_dir, 'destroying cloud resources for errored test %s', labels)
+
+
+async def fast_fail(test_id, test_dir, labels, kind, reason, applied_at):
+    # stop the report and hand the test to destroy without polling,
+    # the slot would otherwise be held until test_timeout after apply
+    reclaimed = max(int(CONFIG['test_timeout']) - (time.time() - applied_at), 0)
+    LOG.error('test %s can not complete, %s', test_id, terraform_errors.summary(reason))
+    await event_loop.run_blocking(report_client.stop, test_id, {'terraform_failed': reason})
+    await errored_test(test_id, test_dir, labels)
+    FAST_FAILED[kind] = FAST_FAILED.get(kind, 0) + 1
+    RECLAIMED['slot_seconds'] = RECLAIMED['slot_seconds'] + reclaimed
+    metrics.increment('fast_failed_tests', dict(labels, reason=kind))
+    metrics.increment('slot_seconds_reclaimed', {'zone': labels['zone']}, reclaimed)
+
+
+async def run_test(test):
+    (zone, image, ttype, test_dir) = await event_loop.run_blocking(initialize_test_dir, test)
     test_id = os.path.basename(test_dir)
+    labels = test_labels(zone, image, ttype)
     LOG.info('running test %s' % test_id)
     start_data = {
         'zone': zone,
         'image_name': image,
         'type': ttype
     }
-    tf = pt.Terraform(working_dir=test_dir, var_file='test_vars.tfvars')
     LOG.info('initializing provider resources for %s', test_id)
-    (rc, out, err) = tf.init()
-    start_report(test_id, start_data)
+    async with stage('init', labels):
+        init_start = time.time()
+        (rc, out, err) = await tf_init(test_dir)
+        init_seconds = time.time() - init_start
+    if rc == 0:
+        await event_loop.run_blocking(plugin_cache.record_init, test_id, ttype, test_dir, init_seconds)
+    # start is not idempotent, a retried test was started on its first
+    # attempt. claim() returns the attempts before it counted this one.
+    if test['attempts'] == 0:
+        await event_loop.run_blocking(report_client.start, test_id, start_data)
     if rc > 0:
+        if await retry_test(test, test_dir, labels, 'init', err):
+            return
         results = {'terraform_failed': "init failure: %s" % err}
-        stop_report(test_id, results)
+        await event_loop.run_blocking(report_client.stop, test_id, results)
+        await event_loop.run_blocking(job_store.set_state, test_id, job_store.ERRORED)
         return
     LOG.info('creating cloud resources for test %s', test_id)
-    (rc, out, err) = tf.apply(dir_or_plan=False, skip_plan=True)
-    if rc > 0:
-        LOG.error('terraform failed for test: %s - %s', test_id, err)
-        results = {'terraform_failed': "apply failure: %s" % err}
-        stop_report(test_id, results)
-    out = tf.output(json=True)
+    async with stage('apply', labels):
+        apply_start = time.time()
+        (rc, out, err) = await tf_apply(test_dir)
+        applied_at = time.time()
+        scheduler.record_apply(zone, applied_at - apply_start, rc, err)
+        if rc > 0:
+            LOG.error('terraform failed for test: %s - %s', test_id, err)
+        out = await tf_output(test_dir)
+    if rc > 0 and await retry_test(test, test_dir, labels, 'apply', err):
+        return
+    dead = dead_test(rc, err, out)
+    if dead:
+        (kind, reason) = dead
+        await fast_fail(test_id, test_dir, labels, kind, reason, applied_at)
+        return
     now = datetime.datetime.utcnow()
     update_data = {
         'terraform_apply_result_code': rc,
@@ -135,102 +449,181 @@ def run_test(test_path):
         'terraform_apply_completed_at': now.timestamp(),
         'terraform_apply_completed_at_readable': now.strftime('%Y-%m-%d %H:%M:%S UTC')
     }
-    update_report(test_id, update_data)
-    results = poll_report(test_id)
+    await event_loop.run_blocking(report_client.update, test_id, update_data)
+    async with stage('poll', labels):
+        results = await poll_report(test_id)
     if not results:
         results = {"test timedout": "(%d seconds)" %
                    int(CONFIG['test_timeout'])}
-        stop_report(test_id, results)
+        await event_loop.run_blocking(report_client.stop, test_id, results)
+        await event_loop.run_blocking(job_store.set_state, test_id, job_store.ERRORED)
         if 'preserve_timed_out_instances' in CONFIG and CONFIG['preserve_timed_out_instances']:
             LOG.error('preserving timedout instance for test: %s for debug', test_id)
             os.makedirs(ERRORED_DIR, exist_ok=True)
-            shutil.move(test_dir, os.path.join(ERRORED_DIR, test_id))        
+            await event_loop.run_blocking(shutil.move, test_dir, os.path.join(ERRORED_DIR, test_id))
         else:
-            LOG.info('destroying cloud resources for test %s', test_id)
-            (rc, out, err) = tf.destroy()
-            if rc > 0:
-                LOG.error('could not destroy test: %s: %s. Manually fix.', test_id, err)
-            shutil.rmtree(test_dir)
+            await queue_destroy(test_id, test_dir, 'destroying cloud resources for test %s', labels)
     else:
         if results['results']['status'] == "ERROR":
-            if 'preserve_errored_instances' in CONFIG and CONFIG['preserve_errored_instances']:
-                LOG.error('preserving errored instance for test: %s for debug', test_id)
-                os.makedirs(ERRORED_DIR, exist_ok=True)
-                shutil.move(test_dir, os.path.join(ERRORED_DIR, test_id))            
-            else:
-                LOG.error('destroying cloud resources for errored test %s', test_id)
-                (rc, out, err) = tf.destroy()
-                if rc > 0:
-                    LOG.error('could not destroy test: %s: %s. Manually fix.', test_id, err)
-                shutil.rmtree(test_dir)
+            await errored_test(test_id, test_dir, labels)
         else:
-            LOG.info('destroying cloud resources for completed test %s', test_id)
-            (rc, out, err) = tf.destroy()
-            if rc > 0:
-                LOG.error('could not destroy test: %s: %s. Manually fix.', test_id, err)
+            await event_loop.run_blocking(job_store.set_state, test_id, job_store.COMPLETED)
+            dest = None
             if 'keep_completed_state' in CONFIG and CONFIG['keep_completed_state']:
-                shutil.move(test_dir, os.path.join(COMPLETE_DIR, test_id))
-            else:
-                shutil.rmtree(test_dir)
+                dest = os.path.join(COMPLETE_DIR, test_id)
+            await queue_destroy(test_id, test_dir, 'destroying cloud resources for completed test %s', labels, dest)
 
 
-def initialize_test_dir(test_path):
-    test_dir = os.path.basename(test_path)
-    test_path_parts = test_path.split(os.path.sep)
-    zone = test_path_parts[(len(test_path_parts) - 4)]
-    image = test_path_parts[(len(test_path_parts) - 3)]
-    ttype = test_path_parts[(len(test_path_parts) - 2)]
-    dest = os.path.join(RUNNING_DIR, test_dir)
+async def guarded_run_test(test):
+    RUNNING_TESTS.add(test['test_id'])
+    try:
+        await run_test(test)
+    except Exception as ex:
+        LOG.exception('test %s failed in the runner: %s', test['test_id'], ex)
+        await event_loop.run_blocking(job_store.set_state, test['test_id'], job_store.ERRORED)
+    finally:
+        # completed, fast failed, errored or back on the queue for a retry,
+        # a phone home which arrived before polling started is not needed
+        RUNNING_TESTS.discard(test['test_id'])
+        PHONED_HOME.discard(test['test_id'])
+
+
+def initialize_test_dir(test):
+    test_path = os.path.join(QUEUE_DIR, test['zone'], test['image'],
+                             test['template_type'], test['test_id'])
+    dest = os.path.join(RUNNING_DIR, test['test_id'])
     shutil.move(test_path, dest)
-    return (zone, image, ttype, dest)
-
-
-def build_pool():
-    pool = []
-    zones_dir = os.listdir(QUEUE_DIR)
-    for zone in zones_dir:
-        images_dir = os.path.join(QUEUE_DIR, zone)
-        zone_images = os.listdir(images_dir)
-        for zi in zone_images:
-            tts_dir = os.path.join(images_dir, zi)
-            tts = os.listdir(tts_dir)
-            for tt in tts:
-                tests_dir = os.path.join(tts_dir, tt)
-                tests = os.listdir(tests_dir)
-                for test in tests:
-                    pool.append(os.path.join(tests_dir, test))
-    return pool
+    return (test['zone'], test['image'], test['template_type'], dest)
 
 
 def requeue_running():
-    for rt in os.listdir(RUNNING_DIR):
-        test_path = os.path.join(RUNNING_DIR, rt)
-        varfile_path = os.path.join(test_path, 'test_vars.json')
-        if os.path.exists(varfile_path):
-            varfile = open(varfile_path, 'r')
-            rvars = json.load(varfile)
-            zone = rvars['zone']
-            template_type = rvars['template_type']
-            image = rvars['tmos_image_name']
-            queue_path = os.path.join(QUEUE_DIR, zone, image, template_type)
-            os.makedirs(queue_path, exist_ok=True)
-            shutil.move(test_path, os.path.join(queue_path, rt))
+    for test in job_store.requeue_running():
+        test_path = os.path.join(RUNNING_DIR, test['test_id'])
+        if os.path.exists(os.path.join(test_path, 'test_vars.json')):
+            requeue_test_dir(test, test_path)
         else:
             LOG.error('invalid test %s found ... removing', test_path)
-            shutil.rmtree(test_path)
+            shutil.rmtree(test_path, ignore_errors=True)
+            job_store.set_state(test['test_id'], job_store.ABORTED)
+
+
+def test_finished(test, in_flight, task):
+    scheduler.release(test)
+    in_flight.release()
 
 
-def runner():
-    requeue_running()
-    test_pool = build_pool()
-    random.shuffle(test_pool)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=CONFIG['thread_pool_size']) as executor:
-        for test_path in test_pool:
-            executor.submit(run_test, test_path=test_path)
+def drain():
+    if not DRAINING.is_set():
+        LOG.info('drain requested, waiting for running tests to finish before exiting')
+        DRAINING.set()
+
+
+async def runner(import_queue=False, daemon=False):
+    global PHASE_LIMITS, STAGE_STATS, DESTROY_QUEUE, DRAINING
+    start = time.time()
+    DRAINING = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, drain)
+    if import_queue:
+        await event_loop.run_blocking(job_store.import_queue_tree, QUEUE_DIR, RUNNING_DIR)
+    await event_loop.run_blocking(requeue_running)
+    test_counts = await event_loop.run_blocking(job_store.counts)
+    LOG.info('job store test counts: %s', test_counts)
+    if (job_store.QUEUED in test_counts or daemon) and \
+       ('prewarm_plugin_cache' not in CONFIG or CONFIG['prewarm_plugin_cache']):
+        await event_loop.run_blocking(plugin_cache.prewarm)
+    limits = phase_concurrency()
+    LOG.info('phase concurrency limits: %s', limits)
+    PHASE_LIMITS = {}
+    STAGE_STATS = {}
+    for phase in PHASES:
+        PHASE_LIMITS[phase] = asyncio.Semaphore(limits[phase])
+        STAGE_STATS[phase] = {'active': 0, 'completed': 0, 'seconds': 0.0}
+    exporter = None
+    if METRICS_ENABLED:
+        exporter = await metrics.start()
+    # finished tests are destroyed by their own pool of workers
+    # while their slots go on to the next tests
+    destroy_queue_size = 0
+    if 'destroy_queue_size' in CONFIG:
+        destroy_queue_size = CONFIG['destroy_queue_size']
+    DESTROY_QUEUE = asyncio.Queue(maxsize=destroy_queue_size)
+    destroyers = [asyncio.ensure_future(destroy_worker()) for _ in range(limits['destroy'])]
+    await queue_pending_destroys()
+    stats_interval = 60
+    if 'pipeline_stats_interval' in CONFIG:
+        stats_interval = CONFIG['pipeline_stats_interval']
+    monitor = asyncio.ensure_future(pipeline_monitor(start, stats_interval))
+    scheduler.configure(CONFIG)
+    watch_interval = 30
+    if 'queue_watch_interval' in CONFIG:
+        watch_interval = CONFIG['queue_watch_interval']
+    if daemon:
+        LOG.info('running as a daemon, checking for new tests every %s seconds', watch_interval)
+    # tests are started as they can make progress, not all at once,
+    # a slot is held from init until the test is handed to destroy
+    in_flight = asyncio.Semaphore(max(limits['apply'], limits['poll']))
+    poller = asyncio.ensure_future(report_poller())
+    listener = None
+    if phone_home.configure(CONFIG):
+        listener = await phone_home.start(phone_home_received)
+    tasks = set()
+    while not DRAINING.is_set():
+        await in_flight.acquire()
+        test = None
+        if not DRAINING.is_set():
+            test = await scheduler.next_test(streaming=daemon, stop=DRAINING,
+                                             watch_interval=watch_interval)
+        if not test:
+            in_flight.release()
+            break
+        task = asyncio.ensure_future(guarded_run_test(test))
+        task.add_done_callback(functools.partial(test_finished, test, in_flight))
+        task.add_done_callback(tasks.discard)
+        tasks.add(task)
+    if tasks:
+        LOG.info('waiting for %d running tests to finish', len(tasks))
+        await asyncio.gather(*tasks)
+    poller.cancel()
+    if listener:
+        listener.close()
+        phone_home.log_counts(LOG)
+        LOG.info('%d tests completed by phone home, %d by polling',
+                 COMPLETED_BY['phone_home'], COMPLETED_BY['poll'])
+    if RETRIED:
+        LOG.info('retried %d tests after transient terraform errors: %s',
+                 sum(RETRIED.values()), RETRIED)
+    if FAST_FAILED:
+        LOG.info('fast failed %d tests after apply, reclaiming %.0f slot seconds: %s',
+                 sum(FAST_FAILED.values()), RECLAIMED['slot_seconds'], FAST_FAILED)
+    if DESTROY_QUEUE.qsize() > 0:
+        LOG.info('waiting for %d queued destroys to finish', DESTROY_QUEUE.qsize())
+    await DESTROY_QUEUE.join()
+    for destroyer in destroyers:
+        destroyer.cancel()
+    monitor.cancel()
+    log_pipeline_stats(time.time() - start)
+    metrics.log_slowest(LOG)
+    if exporter:
+        await metrics.stop(exporter)
+    report_client.log_latency_metrics(LOG)
+    plugin_cache.log_savings(LOG)
+
+
+def phase_concurrency():
+    limits = {
+        'init': CONFIG['thread_pool_size'],
+        'apply': CONFIG['thread_pool_size'],
+        'poll': CONFIG['thread_pool_size'],
+        'destroy': CONFIG['thread_pool_size']
+    }
+    if 'phase_concurrency' in CONFIG:
+        limits.update(CONFIG['phase_concurrency'])
+    return limits
 
 
 def initialize():
-    global MY_PID, CONFIG
+    global MY_PID, CONFIG, METRICS_ENABLED
     MY_PID = os.getpid()
     os.makedirs(QUEUE_DIR, exist_ok=True)
     os.makedirs(RUNNING_DIR, exist_ok=True)
@@ -241,14 +634,25 @@ def initialize():
     config = json.loads(config_json)
     # intialize missing config defaults
     CONFIG = config
+    report_client.configure(CONFIG)
+    plugin_cache.configure(CONFIG)
+    METRICS_ENABLED = metrics.configure(CONFIG)
+    return job_store.configure(CONFIG)
 
 
 if __name__ == "__main__":
     START_TIME = time.time()
     LOG.debug('process start time: %s', datetime.datetime.fromtimestamp(
         START_TIME).strftime("%A, %B %d, %Y %I:%M:%S"))
-    initialize()
-    runner()
+    PARSER = argparse.ArgumentParser(description='run queued tests')
+    PARSER.add_argument('--import-queue', action='store_true',
+                        help='register tests found under queued_tests and running_tests in the job store')
+    PARSER.add_argument('--daemon', action='store_true',
+                        help='keep running and start newly built tests until sent SIGTERM')
+    ARGS = PARSER.parse_args()
+    JOB_STORE_EMPTY = initialize()
+    asyncio.run(runner(import_queue=(ARGS.import_queue or JOB_STORE_EMPTY),
+                       daemon=ARGS.daemon))
     ERROR_MESSAGE = ''
     ERROR = False
 
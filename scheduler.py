@@ -0,0 +1,328 @@
+# coding=utf-8
+# pylint: disable=broad-except,unused-argument,line-too-long, unused-variable
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import sys
+import asyncio
+import logging
+import math
+import re
+import time
+
+import job_store
+import event_loop
+import metrics
+
+LOG = logging.getLogger('ibmcloud_test_harness_scheduler')
+LOG.setLevel(logging.DEBUG)
+FORMATTER = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+LOGSTREAM = logging.StreamHandler(sys.stdout)
+LOGSTREAM.setFormatter(FORMATTER)
+LOG.addHandler(LOGSTREAM)
+
+LIMIT_KINDS = ['zone', 'region', 'license_host']
+
+CONFIG = {}
+
+# running test counts per limit kind and key
+ACTIVE = {}
+# zone -> list of queued (image, template_type, license_host) cells
+CELLS = {}
+ZONE_ORDER = []
+NEXT_ZONE = 0
+NEXT_CELL = {}
+SLOT_FREED = None
+LAST_REFRESH = 0
+
+# AIMD zone concurrency. initial and min are tests in flight per zone, max
+# defaults to the zone_concurrency cap. A slow apply is one taking more than
+# latency_factor times the zone's average, after warmup applies.
+ADAPTIVE_DEFAULTS = {
+    'initial': 2,
+    'min': 1,
+    'max': None,
+    'increase': 1.0,
+    'decrease': 0.5,
+    'latency_factor': 2.0,
+    'warmup': 5,
+    'cooldown': 60
+}
+ADAPTIVE = {}
+# zone -> {'limit', 'threshold', 'latency', 'samples', 'decreased_at'}
+ZONE_CONTROL = {}
+
+# apply output which means IBM Cloud is throttling, even when the
+# provider retried its way to a successful apply
+RATE_LIMIT_PATTERN = re.compile(r'\b429\b|too many requests|rate limit', re.IGNORECASE)
+
+
+def configure(config):
+    # runners-config.json "scheduler" settings. Each of zone_concurrency,
+    # region_concurrency and license_host_concurrency is either a number
+    # applied to every zone, region or license host, or a map of keys to
+    # numbers with an optional "default". Missing limits are unlimited.
+    # adaptive_zone_concurrency turns on the AIMD controller, it may be
+    # {} to take the defaults.
+    global CONFIG, ACTIVE, SLOT_FREED, ADAPTIVE, ZONE_CONTROL
+    CONFIG = {}
+    if 'scheduler' in config:
+        CONFIG = config['scheduler']
+    if 'zone_license_hosts' in config:
+        CONFIG['zone_license_hosts'] = config['zone_license_hosts']
+    ADAPTIVE = {}
+    if 'adaptive_zone_concurrency' in CONFIG and CONFIG['adaptive_zone_concurrency'] is not None:
+        ADAPTIVE = dict(ADAPTIVE_DEFAULTS)
+        ADAPTIVE.update(CONFIG['adaptive_zone_concurrency'])
+    ZONE_CONTROL = {}
+    ACTIVE = {}
+    for kind in LIMIT_KINDS:
+        ACTIVE[kind] = {}
+    SLOT_FREED = asyncio.Event()
+
+
+def region_from_zone(zone):
+    parts = zone.split('-')
+    return "%s-%s" % (parts[0], parts[1])
+
+
+def limit_for(kind, key):
+    setting_name = "%s_concurrency" % kind
+    if setting_name not in CONFIG:
+        return None
+    setting = CONFIG[setting_name]
+    if isinstance(setting, dict):
+        if key in setting:
+            return setting[key]
+        if 'default' in setting:
+            return setting['default']
+        return None
+    return setting
+
+
+def test_keys(zone, license_host):
+    if not license_host and 'zone_license_hosts' in CONFIG and \
+       zone in CONFIG['zone_license_hosts']:
+        license_host = CONFIG['zone_license_hosts'][zone]['license_host']
+    return {
+        'zone': zone,
+        'region': region_from_zone(zone),
+        'license_host': license_host
+    }
+
+
+def zone_control(zone):
+    if zone not in ZONE_CONTROL:
+        ZONE_CONTROL[zone] = {
+            'limit': float(ADAPTIVE['initial']),
+            'threshold': None,
+            'latency': None,
+            'samples': 0,
+            'decreased_at': 0
+        }
+    return ZONE_CONTROL[zone]
+
+
+def adaptive_max(zone):
+    limit = limit_for('zone', zone)
+    if ADAPTIVE['max'] is not None and (limit is None or ADAPTIVE['max'] < limit):
+        limit = ADAPTIVE['max']
+    return limit
+
+
+def adaptive_limit(zone):
+    return int(math.floor(zone_control(zone)['limit']))
+
+
+def record_apply(zone, seconds, returncode, err=''):
+    # AIMD: below the threshold found at the last back off the limit grows
+    # by increase for every healthy apply, above it by increase per limit
+    # applies. A failed, throttled or slow apply cuts it by the decrease
+    # factor, at most once every cooldown seconds.
+    if not ADAPTIVE:
+        return
+    control = zone_control(zone)
+    congested = returncode > 0 or bool(RATE_LIMIT_PATTERN.search(err or ''))
+    if returncode == 0:
+        if control['samples'] >= ADAPTIVE['warmup'] and \
+           seconds > ADAPTIVE['latency_factor'] * control['latency']:
+            congested = True
+        elif control['latency'] is None:
+            control['latency'] = seconds
+        else:
+            control['latency'] = 0.8 * control['latency'] + 0.2 * seconds
+        control['samples'] = control['samples'] + 1
+    before = adaptive_limit(zone)
+    if congested:
+        now = time.time()
+        if now - control['decreased_at'] < ADAPTIVE['cooldown']:
+            return
+        control['decreased_at'] = now
+        control['limit'] = max(float(ADAPTIVE['min']), control['limit'] * ADAPTIVE['decrease'])
+        control['threshold'] = control['limit']
+        LOG.info('backing off zone %s to %d tests after a %s apply (%.1f seconds)', zone,
+                 adaptive_limit(zone), 'failed' if returncode > 0 else 'throttled or slow', seconds)
+    else:
+        if control['threshold'] is None or control['limit'] < control['threshold']:
+            control['limit'] = control['limit'] + ADAPTIVE['increase']
+        else:
+            control['limit'] = control['limit'] + ADAPTIVE['increase'] / control['limit']
+        maximum = adaptive_max(zone)
+        if maximum is not None:
+            control['limit'] = min(control['limit'], float(maximum))
+    if adaptive_limit(zone) != before:
+        metrics.set_gauge('zone_concurrency_limit', {'zone': zone}, adaptive_limit(zone))
+        if adaptive_limit(zone) > before:
+            SLOT_FREED.set()
+
+
+def adaptive_limits():
+    return dict((zone, adaptive_limit(zone)) for zone in sorted(ZONE_CONTROL))
+
+
+def has_capacity(keys):
+    for kind in LIMIT_KINDS:
+        if keys[kind] is None:
+            continue
+        limit = limit_for(kind, keys[kind])
+        if kind == 'zone' and ADAPTIVE:
+            limit = adaptive_limit(keys[kind])
+        if limit is not None and ACTIVE[kind].get(keys[kind], 0) >= limit:
+            return False
+    return True
+
+
+def acquire(keys):
+    for kind in LIMIT_KINDS:
+        if keys[kind] is not None:
+            ACTIVE[kind][keys[kind]] = ACTIVE[kind].get(keys[kind], 0) + 1
+
+
+def release(test):
+    keys = test_keys(test['zone'], test['license_host'])
+    for kind in LIMIT_KINDS:
+        if keys[kind] is not None:
+            ACTIVE[kind][keys[kind]] = ACTIVE[kind][keys[kind]] - 1
+    SLOT_FREED.set()
+
+
+async def refresh():
+    # rebuild the queued cell lists from the job store, one grouped query
+    global ZONE_ORDER, NEXT_ZONE
+    cells = {}
+    for cell in await event_loop.run_blocking(job_store.queued_cells):
+        cells.setdefault(cell['zone'], []).append(
+            (cell['image'], cell['template_type'], cell['license_host']))
+    for zone in cells:
+        cells[zone].sort()
+    CELLS.clear()
+    CELLS.update(cells)
+    ZONE_ORDER = sorted(CELLS.keys())
+    if ZONE_ORDER:
+        NEXT_ZONE = NEXT_ZONE % len(ZONE_ORDER)
+    else:
+        NEXT_ZONE = 0
+    return len(ZONE_ORDER)
+
+
+def remove_cell(zone, cell):
+    global NEXT_ZONE
+    CELLS[zone].remove(cell)
+    if not CELLS[zone]:
+        del CELLS[zone]
+        zone_index = ZONE_ORDER.index(zone)
+        ZONE_ORDER.remove(zone)
+        if zone_index < NEXT_ZONE:
+            NEXT_ZONE = NEXT_ZONE - 1
+
+
+async def claim_in_zone(zone):
+    # try each of the zone's cells once, starting after the last one used
+    cells = CELLS[zone]
+    attempts = len(cells)
+    while attempts > 0 and zone in CELLS:
+        attempts = attempts - 1
+        cell_index = NEXT_CELL.get(zone, 0) % len(cells)
+        cell = cells[cell_index]
+        NEXT_CELL[zone] = cell_index + 1
+        (image, template_type, license_host) = cell
+        keys = test_keys(zone, license_host)
+        if not has_capacity(keys):
+            continue
+        test = await event_loop.run_blocking(job_store.claim, zone, image, template_type)
+        if test:
+            acquire(test_keys(zone, test['license_host']))
+            return test
+        NEXT_CELL[zone] = cell_index
+        remove_cell(zone, cell)
+    return None
+
+
+async def wait_for_any(events, timeout=None):
+    waiters = [asyncio.ensure_future(event.wait()) for event in events]
+    (done, pending) = await asyncio.wait(waiters, timeout=timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+    for waiter in pending:
+        waiter.cancel()
+
+
+async def next_test(streaming=False, stop=None, watch_interval=30):
+    # round robin across zones, and across the cells within each zone,
+    # skipping any zone, region or license host already at its limit.
+    # Returns None once nothing is left in the queue or waiting to be
+    # retried, and no running test can still be sent back for a retry.
+    # When streaming, keeps re-reading the job store every watch_interval
+    # seconds for newly built tests until the stop event is set.
+    global NEXT_ZONE, LAST_REFRESH
+    if stop is None:
+        stop = asyncio.Event()
+    while not stop.is_set():
+        SLOT_FREED.clear()
+        if not ZONE_ORDER or \
+           (streaming and (time.time() - LAST_REFRESH) > watch_interval):
+            await refresh()
+            LAST_REFRESH = time.time()
+        if not ZONE_ORDER:
+            if not streaming:
+                retry_at = await event_loop.run_blocking(job_store.next_retry_at)
+                if retry_at is None and not sum(ACTIVE['zone'].values()):
+                    return None
+                timeout = None
+                if retry_at is not None:
+                    timeout = max(retry_at - time.time(), 0)
+                await wait_for_any([SLOT_FREED, stop], timeout=timeout)
+                continue
+            await wait_for_any([stop], timeout=watch_interval)
+            continue
+        for _ in range(len(ZONE_ORDER)):
+            if not ZONE_ORDER:
+                break
+            NEXT_ZONE = NEXT_ZONE % len(ZONE_ORDER)
+            zone = ZONE_ORDER[NEXT_ZONE]
+            NEXT_ZONE = NEXT_ZONE + 1
+            test = await claim_in_zone(zone)
+            if test:
+                return test
+        if ZONE_ORDER:
+            LOG.debug('all zones with queued tests are at their concurrency limits')
+            if streaming:
+                await wait_for_any([SLOT_FREED, stop], timeout=watch_interval)
+            else:
+                await wait_for_any([SLOT_FREED, stop])
+    return None
+
+
+def active_counts():
+    return dict((kind, dict(ACTIVE[kind])) for kind in LIMIT_KINDS)
@@ -1,11 +1,13 @@
-# lookup SSH public keys by name
+# lookup SSH public keys by name unless the id was pre-resolved
 data "ibm_is_ssh_key" "ssh_pub_key" {
-  name = "${var.ssh_key_name}"
+  count = var.ssh_key_id == "" ? 1 : 0
+  name  = "${var.ssh_key_name}"
 }
 
-# lookup compute profile by name
+# lookup compute profile by name unless the id was pre-resolved
 data "ibm_is_instance_profile" "instance_profile" {
-  name = "${var.instance_profile}"
+  count = var.instance_profile_id == "" ? 1 : 0
+  name  = "${var.instance_profile}"
 }
 
 # create a random password if we need it
@@ -17,7 +19,8 @@ resource "random_password" "password" {
 
 # lookup image name for a custom image in region if we need it
 data "ibm_is_image" "tmos_custom_image" {
-  name = "${var.tmos_image_name}"
+  count = var.tmos_image_id == "" ? 1 : 0
+  name  = "${var.tmos_image_name}"
 }
 
 locals {
@@ -65,8 +68,11 @@ locals {
 }
 
 locals {
-  # custom image takes priority over public image
-  image_id = data.ibm_is_image.tmos_custom_image.id == null ? lookup(local.public_image_map[var.tmos_image_name], var.region) : data.ibm_is_image.tmos_custom_image.id
+  # a pre-resolved image id takes priority, then custom image over public image
+  image_id = var.tmos_image_id != "" ? var.tmos_image_id : (data.ibm_is_image.tmos_custom_image[0].id == null ? lookup(local.public_image_map[var.tmos_image_name], var.region) : data.ibm_is_image.tmos_custom_image[0].id)
+  # pre-resolved ids skip the data source lookups
+  ssh_key_id          = var.ssh_key_id != "" ? var.ssh_key_id : data.ibm_is_ssh_key.ssh_pub_key[0].id
+  instance_profile_id = var.instance_profile_id != "" ? var.instance_profile_id : data.ibm_is_instance_profile.instance_profile[0].id
   # public image takes priority over custom image
   # image_id = lookup(lookup(local.public_image_map, var.tmos_image_name, {}), var.region, data.ibm_is_image.tmos_custom_image.id)
   template_file = lookup(local.license_map, var.license_type, local.license_map["none"])
@@ -99,8 +105,8 @@ data "template_file" "user_data" {
     phone_home_url          = local.phone_home_url
     template_source         = var.template_source
     template_version        = var.template_version
-    zone                    = data.ibm_is_subnet.f5_managment_subnet.zone
-    vpc                     = data.ibm_is_subnet.f5_managment_subnet.vpc
+    zone                    = local.management_zone
+    vpc                     = local.management_vpc
     app_id                  = var.app_id
   }
 }
@@ -109,10 +115,10 @@ data "template_file" "user_data" {
 resource "ibm_is_instance" "f5_ve_instance" {
   name    = var.instance_name
   image   = local.image_id
-  profile = data.ibm_is_instance_profile.instance_profile.id
+  profile = local.instance_profile_id
   primary_network_interface {
     name            = "management"
-    subnet          = data.ibm_is_subnet.f5_managment_subnet.id
+    subnet          = var.management_subnet_id
     security_groups = [ibm_is_security_group.f5_open_sg.id]
   }
   dynamic "network_interfaces" {
@@ -124,9 +130,9 @@ resource "ibm_is_instance" "f5_ve_instance" {
     }
 
   }
-  vpc        = data.ibm_is_subnet.f5_managment_subnet.vpc
-  zone       = data.ibm_is_subnet.f5_managment_subnet.zone
-  keys       = [data.ibm_is_ssh_key.ssh_pub_key.id]
+  vpc        = local.management_vpc
+  zone       = local.management_zone
+  keys       = [local.ssh_key_id]
   user_data  = data.template_file.user_data.rendered
   depends_on = [ibm_is_security_group_rule.f5_allow_outbound]
 }
@@ -165,7 +171,7 @@ output "instance_id" {
 }
 
 output "profile_id" {
-  value = data.ibm_is_instance_profile.instance_profile.id
+  value = local.instance_profile_id
 }
 
 output "f5_shell_access" {
@@ -17,8 +17,9 @@ provider "ibm" {
 }
 
 ##############################################################################
-# Read/validate Region
+# Read/validate Region, skipped when the builder pre-resolved the region's ids
 ##############################################################################
 data "ibm_is_region" "region" {
-  name = "${var.region}"
+  count = var.vpc_id == "" ? 1 : 0
+  name  = "${var.region}"
 }
@@ -1,8 +1,13 @@
+# lookup the management subnet unless its VPC was pre-resolved
 data "ibm_is_subnet" "f5_managment_subnet" {
+  count      = var.vpc_id == "" ? 1 : 0
   identifier = "${var.management_subnet_id}"
 }
 
 locals {
+  management_vpc            = var.vpc_id != "" ? var.vpc_id : data.ibm_is_subnet.f5_managment_subnet[0].vpc
+  management_zone           = var.vpc_id != "" ? var.management_zone : data.ibm_is_subnet.f5_managment_subnet[0].zone
+  management_resource_group = var.vpc_id != "" ? var.resource_group_id : data.ibm_is_subnet.f5_managment_subnet[0].resource_group
   secondary_subnets = compact(list(var.data_1_1_subnet_id, var.data_1_2_subnet_id, var.data_1_3_subnet_id, var.data_1_4_subnet_id))
 }
 
@@ -11,8 +16,8 @@ resource "random_uuid" "namer" {}
 // open up port security security group
 resource "ibm_is_security_group" "f5_open_sg" {
   name           = "sg-${random_uuid.namer.result}"
-  vpc            = data.ibm_is_subnet.f5_managment_subnet.vpc
-  resource_group = data.ibm_is_subnet.f5_managment_subnet.resource_group
+  vpc            = local.management_vpc
+  resource_group = local.management_resource_group
 }
 
 // allow all inbound
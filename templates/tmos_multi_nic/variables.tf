@@ -162,6 +162,40 @@ variable "phone_home_url" {
   description = "The URL to POST status when BIG-IP is finished onboarding"
 }
 
+##################################################################################
+# pre-resolved ids - Set by the test builder to skip the data source lookups
+##################################################################################
+variable "tmos_image_id" {
+  type        = string
+  default     = ""
+  description = "Optional pre-resolved image ID for tmos_image_name"
+}
+variable "ssh_key_id" {
+  type        = string
+  default     = ""
+  description = "Optional pre-resolved SSH key ID for ssh_key_name"
+}
+variable "instance_profile_id" {
+  type        = string
+  default     = ""
+  description = "Optional pre-resolved instance profile ID for instance_profile"
+}
+variable "vpc_id" {
+  type        = string
+  default     = ""
+  description = "Optional pre-resolved VPC ID of the management subnet"
+}
+variable "resource_group_id" {
+  type        = string
+  default     = ""
+  description = "Optional pre-resolved resource group ID of the management subnet, required with vpc_id"
+}
+variable "management_zone" {
+  type        = string
+  default     = ""
+  description = "Optional pre-resolved zone of the management subnet, required with vpc_id"
+}
+
 ##################################################################################
 # schematic template for phone_home_url_metadata
 ##################################################################################
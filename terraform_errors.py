@@ -0,0 +1,84 @@
+# coding=utf-8
+# pylint: disable=broad-except,unused-argument,line-too-long, unused-variable
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import re
+
+PERMANENT = 'permanent'
+
+# status codes only where the provider or an HTTP client reports them,
+# not digits inside a resource id in the error
+STATUS_CODE = r'(\bstatus ?code\W{0,3}|\bHTTP(/[\d.]+)? |\bstatus\W{0,3})%s\b'
+
+# terraform errors from the IBM provider worth another attempt, checked
+# in order. Anything else, such as an invalid template variable or a
+# missing image, is permanent.
+ERROR_CLASSES = [(error_class, [re.compile(pattern, re.IGNORECASE) for pattern in patterns]) for (error_class, patterns) in [
+    ('rate_limit', [STATUS_CODE % '429', r'too many requests', r'rate limit', r'throttl']),
+    ('quota', [r'quota', r'limit (has been |was )?(exceeded|reached)', r'exceeds? the .*limit',
+               r'maximum number of']),
+    ('capacity', [r'insufficient capacity', r'out of capacity', r'no (available )?capacity',
+                  r'not enough (resources|capacity)', r'capacity (is )?(not available|unavailable)']),
+    ('service', [STATUS_CODE % '50[0234]', r'internal server error', r'service unavailable', r'bad gateway',
+                 r'gateway time-?out']),
+    ('network', [r'\b(i/o|dial|read|write|connect|connection|request|handshake|client\.) ?timeout\b',
+                 r'\btimeout (while waiting|exceeded|awaiting)\b', r'\btimed out\b', r'deadline exceeded',
+                 r'connection (reset|refused)', r'unexpected EOF', r'TLS handshake', r'no such host',
+                 r'temporary failure in name resolution']),
+    # in use and pending only in the wording of a resource another
+    # operation holds, not "name already in use" or "pending approval"
+    ('busy', [r'error acquiring the state lock', r'(?<!already )\bin use by\b',
+              r'\b(still|currently) in use\b', r'\bdelet\w*\b.*\bin use\b',
+              r'\b(is|in) (a |the )?pending (state|status)\b',
+              r'\b(another|an existing) (operation|request) is (already )?in progress\b',
+              r'\bis busy\b'])
+]]
+
+# terraform 0.12 follows each error with the source it came from:
+#   on compute.tf line 112, in resource "ibm_is_instance" "f5_ve_instance":
+#  112: resource "ibm_is_instance" "f5_ve_instance" {
+SOURCE_CONTEXT = re.compile(r'^\s*(on \S+ line \d+.*:|\d+: .*)$')
+
+
+def error_text(err):
+    # the error without terraform's source context, whose resource
+    # and attribute names say nothing about the failure
+    return '\n'.join(line for line in (err or '').splitlines()
+                     if not SOURCE_CONTEXT.match(line))
+
+
+def classify(err):
+    text = error_text(err)
+    for (error_class, patterns) in ERROR_CLASSES:
+        for pattern in patterns:
+            if pattern.search(text):
+                return error_class
+    return PERMANENT
+
+
+def is_transient(err):
+    return classify(err) != PERMANENT
+
+
+def summary(err):
+    # the last "Error: ..." line terraform printed, or the last line of
+    # anything else, such as a message the harness built itself
+    lines = [line.strip() for line in error_text(err).splitlines() if line.strip()]
+    for line in reversed(lines):
+        if line.startswith('Error:'):
+            return line
+    if lines:
+        return lines[-1]
+    return ''
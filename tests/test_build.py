@@ -0,0 +1,175 @@
+# coding=utf-8
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import sys
+import json
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import build  # noqa: E402
+import data_sources  # noqa: E402
+import job_store  # noqa: E402
+
+ZONE = 'us-south-2'
+IMAGE = 'bigip-15-1-0-4-0-0-6-ltm-1slot-us-south'
+TEMPLATE = os.path.join(build.TEMPLATE_DIR, 'tmos_multi_nic.tar.gz')
+
+
+@pytest.fixture
+def builder(tmp_path, monkeypatch):
+    monkeypatch.setattr(build, 'TEMPLATE_CACHE_DIR', str(tmp_path / 'template_cache'))
+    monkeypatch.setattr(build, 'EXTRACTED_TEMPLATES', {})
+    monkeypatch.setattr(build, 'VAR_TEMPLATES', {})
+    monkeypatch.setattr(build, 'RENDERERS', {})
+    monkeypatch.setattr(build, 'CONFIG', {
+        'api_key': 'test-api-key',
+        'report_service_base_url': 'http://127.0.0.1',
+        'profile_selection': {'-1slot': 'cx2-4x8'},
+        'zone_security_groups': {ZONE: 'sg-id'}
+    })
+    zone_resources = {ZONE: dict((resource, {'value': "%s-%s" % (resource, ZONE)})
+                                 for resource in ['ssh_key_name', 'f5_management_id', 'f5_cluster_id',
+                                                  'f5_internal_id', 'f5_external_id'])}
+    monkeypatch.setattr(build, 'ZONE_RESOURCES', zone_resources)
+    return tmp_path
+
+
+def build_test_vars(tmp_path, license_type):
+    render = build.get_renderer(ZONE, IMAGE, 'tmos_multi_nic', license_type)
+    test_dir = build.create_test(str(tmp_path), TEMPLATE, render, 'test-1', 'AAAAA-BBBBB')
+    with open(os.path.join(test_dir, 'test_vars.json'), 'r') as vj:
+        return json.load(vj)
+
+
+@pytest.mark.parametrize('license_type', ['byol', 'regkeypool'])
+def test_test_vars_zone_is_cell_zone(builder, license_type):
+    test_vars = build_test_vars(builder, license_type)
+    assert test_vars['zone'] == ZONE
+    assert test_vars['management_zone'] == ''
+
+
+def test_management_zone_is_the_resolved_subnet_zone(builder, monkeypatch):
+    # the management subnet need not be in the cell's zone
+    subnet = {'subnet_vpc': 'vpc-id', 'subnet_resource_group': 'group-id', 'subnet_zone': 'us-south-1'}
+    monkeypatch.setattr(data_sources, 'lookup', lambda region, kind, name: subnet.get(kind, ''))
+    test_vars = build_test_vars(builder, 'byol')
+    assert test_vars['zone'] == ZONE
+    assert test_vars['management_zone'] == 'us-south-1'
+    assert test_vars['vpc_id'] == 'vpc-id'
+
+
+def test_partly_resolved_subnets_are_left_to_the_template(builder, monkeypatch):
+    # a cache written before subnet zones were resolved
+    subnet = {'subnet_vpc': 'vpc-id', 'subnet_resource_group': 'group-id'}
+    monkeypatch.setattr(data_sources, 'lookup', lambda region, kind, name: subnet.get(kind, ''))
+    test_vars = build_test_vars(builder, 'byol')
+    assert test_vars['management_zone'] == ''
+    assert test_vars['vpc_id'] == ''
+
+
+@pytest.fixture
+def licenses(builder, monkeypatch):
+    license_file = builder / 'licenses.txt'
+    license_file.write_text(''.join("AAAAA-BBBBB-CCCCC-DDDDD-%07d\n" % key for key in range(6)) + "\n  \nx\n")
+    build.CONFIG['license_file'] = str(license_file)
+    monkeypatch.setattr(build, 'LICENSE_INDEX', None)
+    return license_file
+
+
+def test_short_license_lines_are_not_keys(licenses):
+    assert build.licenses_available() == 6
+
+
+def test_licenses_are_journaled_only_once_used(licenses, monkeypatch):
+    (first, first_range) = build.checkout_licenses(2)
+    (second, second_range) = build.checkout_licenses(3)
+    assert not os.path.exists(build.license_journal())
+    build.journal_licenses(second_range)
+    # a build killed before the first batch was used hands it out again
+    monkeypatch.setattr(build, 'LICENSE_INDEX', None)
+    (reissued, reissued_range) = build.checkout_licenses(6)
+    assert reissued == first + ["AAAAA-BBBBB-CCCCC-DDDDD-%07d" % 5]
+    build.journal_licenses(reissued_range)
+    monkeypatch.setattr(build, 'LICENSE_INDEX', None)
+    assert build.licenses_available() == 0
+
+
+def test_stale_template_extracts_are_swept(builder):
+    cache_dir = build.TEMPLATE_CACHE_DIR
+    for entry in ['tmos_multi_nic-0123456789ab', 'tmos_multi_nic-0123456789ab.4242',
+                  'tmos_multi_nic_ha-0123456789ab']:
+        os.makedirs(os.path.join(cache_dir, entry))
+    extracted = build.extracted_template(TEMPLATE)
+    assert sorted(os.listdir(cache_dir)) == sorted([
+        os.path.basename(extracted), 'tmos_multi_nic-0123456789ab.4242', 'tmos_multi_nic_ha-0123456789ab'])
+
+
+@pytest.fixture
+def queue(licenses, monkeypatch):
+    monkeypatch.setattr(build, 'QUEUE_DIR', str(licenses.parent / 'queued_tests'))
+    monkeypatch.setattr(job_store, 'READ_ONLY', False)
+    monkeypatch.setattr(job_store, 'CONNECTIONS', threading.local())
+    job_store.configure({'job_store_file': str(licenses.parent / 'test_jobs.db')})
+    unit = build.new_unit(ZONE, IMAGE, 'byol')
+    for count in [2, 2]:
+        (cell_licenses, license_range) = build.checkout_licenses(count)
+        unit['tests'].append(('tmos_multi_nic', cell_licenses))
+        unit['license_ranges'].append(license_range)
+    return unit
+
+
+def queued_dirs():
+    return sorted(os.listdir(os.path.join(build.QUEUE_DIR, ZONE, IMAGE, 'tmos_multi_nic')))
+
+
+def test_built_cells_are_journaled_and_registered(queue):
+    created = build.build_unit(queue)
+    assert queued_dirs() == sorted(test[0] for test in created)
+    assert len(job_store.queued_cells()) == 1
+    assert job_store.queued_cells()[0]['tests'] == 4
+    assert build.load_consumed_ranges() == queue['license_ranges']
+
+
+def test_build_killed_mid_unit_keeps_finished_cells(queue, monkeypatch):
+    create_test = build.create_test
+    written = []
+
+    def killed_on_third_test(*args):
+        if len(written) == 3:
+            raise KeyboardInterrupt()
+        written.append(create_test(*args))
+    monkeypatch.setattr(build, 'create_test', killed_on_third_test)
+    with pytest.raises(KeyboardInterrupt):
+        build.build_unit(queue)
+    assert build.load_consumed_ranges() == queue['license_ranges'][0:1]
+    assert len([name for name in queued_dirs() if name.endswith(build.PARTIAL_SUFFIX)]) == 1
+    assert build.finish_partial_tests() == (0, 1)
+    assert len(queued_dirs()) == 2
+    assert job_store.queued_cells()[0]['tests'] == 2
+    # the keys of the unfinished cell are handed out again
+    monkeypatch.setattr(build, 'LICENSE_INDEX', None)
+    assert build.checkout_licenses(2)[0] == queue['tests'][1][1]
+
+
+def test_partial_tests_in_the_job_store_are_finished(queue):
+    test_dir = os.path.join(build.QUEUE_DIR, ZONE, IMAGE, 'tmos_multi_nic', 'test-1')
+    os.makedirs(test_dir + build.PARTIAL_SUFFIX)
+    job_store.add_tests([('test-1', ZONE, IMAGE, 'tmos_multi_nic', None)])
+    assert build.finish_partial_tests() == (1, 0)
+    assert queued_dirs() == ['test-1']
@@ -0,0 +1,132 @@
+# coding=utf-8
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import destroy_engine  # noqa: E402
+
+STUB_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'benchmarks', 'stubs')
+
+TRANSIENT_ERROR = 'Post "https://us-south.iaas.cloud.ibm.com/v1/instances": dial tcp: i/o timeout'
+
+
+@pytest.fixture
+def terraform(tmp_path, monkeypatch):
+    # the benchmark stub stands in for terraform, logging each call
+    monkeypatch.setenv('PATH', "%s%s%s" % (STUB_DIR, os.pathsep, os.environ.get('PATH', '')))
+    monkeypatch.setenv('BENCH_TF_CALLS', str(tmp_path / 'calls'))
+    for variable in ['BENCH_TF_DESTROY_SECONDS', 'BENCH_TF_DESTROY_FAIL_RATE',
+                     'BENCH_TF_DESTROY_FAILURES', 'BENCH_TF_DESTROY_ERROR']:
+        monkeypatch.delenv(variable, raising=False)
+    monkeypatch.setattr(destroy_engine, 'SETTINGS', dict(destroy_engine.SETTINGS))
+    destroy_engine.configure({'destroy_retries': 2, 'destroy_backoff': 0, 'destroy_max_backoff': 0})
+    return tmp_path
+
+
+def make_test_dir(tmp_path, test_id, zone='us-south-1'):
+    path = tmp_path / 'running_tests' / test_id
+    os.makedirs(str(path))
+    (path / 'test_vars.tfvars').write_text('zone = "%s"\n' % zone)
+    (path / 'test_vars.json').write_text(json.dumps({'zone': zone}))
+    return str(path)
+
+
+def calls(tmp_path):
+    # [(command, test_id, start, end)] in the order they finished
+    with open(str(tmp_path / 'calls'), 'r') as cf:
+        return [(command, os.path.basename(directory), float(start), float(end))
+                for (command, directory, start, end) in [line.split() for line in cf]]
+
+
+def commands(tmp_path, test_id):
+    return [call[0] for call in calls(tmp_path) if call[1] == test_id]
+
+
+def test_transient_destroy_failures_are_retried(terraform, monkeypatch):
+    monkeypatch.setenv('BENCH_TF_DESTROY_FAILURES', '2')
+    monkeypatch.setenv('BENCH_TF_DESTROY_ERROR', TRANSIENT_ERROR)
+    test_dir_1 = make_test_dir(terraform, 'test-1')
+    assert destroy_engine.destroy_test(test_dir_1) == ('test-1', destroy_engine.DESTROYED, None)
+    assert commands(terraform, 'test-1') == ['init', 'destroy', 'destroy', 'destroy']
+    assert not os.path.exists(test_dir_1)
+
+
+def test_retries_are_bounded(terraform, monkeypatch):
+    monkeypatch.setenv('BENCH_TF_DESTROY_FAILURES', '5')
+    monkeypatch.setenv('BENCH_TF_DESTROY_ERROR', TRANSIENT_ERROR)
+    test_dir_1 = make_test_dir(terraform, 'test-1')
+    (test_id, result, error) = destroy_engine.destroy_test(test_dir_1)
+    assert result == destroy_engine.FAILED
+    assert commands(terraform, 'test-1') == ['init', 'destroy', 'destroy', 'destroy']
+    assert os.path.exists(test_dir_1)
+
+
+def test_permanent_destroy_failures_are_not_retried(terraform, monkeypatch):
+    monkeypatch.setenv('BENCH_TF_DESTROY_FAILURES', '1')
+    test_dir_1 = make_test_dir(terraform, 'test-1')
+    assert destroy_engine.destroy_test(test_dir_1)[1] == destroy_engine.FAILED
+    assert commands(terraform, 'test-1') == ['init', 'destroy']
+
+
+def most_at_once(spans):
+    edges = sorted([(start, 1) for (start, end) in spans] + [(end, -1) for (start, end) in spans])
+    (running, most) = (0, 0)
+    for (at, change) in edges:
+        running = running + change
+        most = max(most, running)
+    return most
+
+
+def test_destroys_are_limited_per_zone(terraform, monkeypatch):
+    monkeypatch.setenv('BENCH_TF_DESTROY_SECONDS', '0.2')
+    destroy_engine.configure({'destroy_zone_concurrency': {'us-south-1': 1, 'default': 3}})
+    test_dirs = [make_test_dir(terraform, "south-%d" % index) for index in range(3)] + \
+        [make_test_dir(terraform, "east-%d" % index, zone='us-east-1') for index in range(3)]
+    summary = destroy_engine.destroy_all(test_dirs, workers=6)
+    assert len(summary[destroy_engine.DESTROYED]) == 6
+    destroys = [call for call in calls(terraform) if call[0] == 'destroy']
+    assert most_at_once([(start, end) for (command, test_id, start, end) in destroys
+                         if test_id.startswith('south-')]) == 1
+    assert most_at_once([(start, end) for (command, test_id, start, end) in destroys
+                         if test_id.startswith('east-')]) > 1
+
+
+def test_summary_lists_destroyed_failed_and_skipped_tests(terraform, monkeypatch):
+    monkeypatch.setenv('BENCH_TF_DESTROY_FAILURES', '1')
+    monkeypatch.setenv('BENCH_TF_DESTROY_ERROR', 'instance is locked\n\n  on main.tf line 12:')
+    destroy_engine.configure({'destroy_retries': 0})
+    test_dirs = [make_test_dir(terraform, 'test-1'), make_test_dir(terraform, 'test-2')]
+    os.makedirs(str(terraform / 'running_tests' / 'not-a-test'))
+    test_dirs.append(str(terraform / 'running_tests' / 'not-a-test'))
+    # test-2 already failed its first destroy
+    (terraform / 'running_tests' / 'test-2' / '.bench_tf_destroys').write_text('1\n')
+    summary = destroy_engine.destroy_all(test_dirs, workers=2, remove=False)
+    assert summary == {
+        destroy_engine.DESTROYED: ['test-2'],
+        destroy_engine.FAILED: {'test-1': 'Error: instance is locked'},
+        destroy_engine.SKIPPED: ['not-a-test']
+    }
+    assert os.path.exists(test_dirs[1])
+
+
+def test_nothing_to_destroy(terraform):
+    assert destroy_engine.destroy_all([]) == {
+        destroy_engine.DESTROYED: [], destroy_engine.FAILED: {}, destroy_engine.SKIPPED: []}
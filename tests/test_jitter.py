@@ -0,0 +1,44 @@
+# coding=utf-8
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import jitter  # noqa: E402
+
+
+@pytest.fixture
+def ceiling(monkeypatch):
+    # the upper bound of the wait instead of a random draw
+    monkeypatch.setattr(jitter.random, 'uniform', lambda low, high: high)
+
+
+@pytest.mark.parametrize('attempt,wait', [(0, 10), (1, 20), (3, 80), (5, 300), (40, 300)])
+def test_waits_double_up_to_the_cap(ceiling, attempt, wait):
+    assert jitter.full_jitter(attempt, 10, 300) == wait
+
+
+def test_waits_are_uncapped_without_a_cap(ceiling):
+    assert jitter.full_jitter(10, 0.5) == 512
+
+
+def test_waits_are_drawn_from_zero():
+    waits = [jitter.full_jitter(2, 1, 3) for _ in range(1000)]
+    assert min(waits) >= 0 and max(waits) <= 3
+    assert min(waits) < 0.5
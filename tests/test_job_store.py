@@ -0,0 +1,78 @@
+# coding=utf-8
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import sys
+import json
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import job_store  # noqa: E402
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_store, 'READ_ONLY', False)
+    monkeypatch.setattr(job_store, 'CONNECTIONS', threading.local())
+    return {'job_store_file': str(tmp_path / 'test_jobs.db')}
+
+
+def test_open_read_only_does_not_create_the_store(store):
+    assert not job_store.open_read_only(store)
+    assert not os.path.exists(store['job_store_file'])
+
+
+def test_configure_reports_an_empty_store_until_tests_are_added(store):
+    assert job_store.configure(store)
+    assert job_store.configure(store)
+    job_store.add_tests([('test-1', 'us-south-1', 'image', 'tmos_multi_nic', None)])
+    assert not job_store.configure(store)
+
+
+def test_read_only_store_lists_running_tests(store, monkeypatch):
+    job_store.configure(store)
+    job_store.add_tests([('test-1', 'us-south-1', 'image', 'tmos_multi_nic', None)],
+                        state=job_store.RUNNING)
+    monkeypatch.setattr(job_store, 'CONNECTIONS', threading.local())
+    assert job_store.open_read_only(store)
+    assert [test['test_id'] for test in job_store.tests_in_state(job_store.RUNNING)] == ['test-1']
+
+
+def write_test(test_dir, test_vars):
+    os.makedirs(test_dir)
+    with open(os.path.join(test_dir, 'test_vars.json'), 'w') as vj:
+        json.dump(test_vars, vj)
+
+
+def test_import_queue_tree_reads_license_hosts(store, tmp_path):
+    job_store.configure(store)
+    queue_dir = str(tmp_path / 'queued_tests')
+    running_dir = str(tmp_path / 'running_tests')
+    write_test(os.path.join(queue_dir, 'us-south-1', 'image', 'tmos_multi_nic', 'queued-1'),
+               {'zone': 'us-south-1', 'license_host': '10.0.0.1'})
+    write_test(os.path.join(queue_dir, 'us-south-1', 'image', 'tmos_multi_nic', 'queued-2'),
+               {'zone': 'us-south-1'})
+    write_test(os.path.join(running_dir, 'running-1'),
+               {'zone': 'us-south-2', 'tmos_image_name': 'image', 'template_type': 'tmos_multi_nic',
+                'license_host': '10.0.0.2'})
+    assert job_store.import_queue_tree(queue_dir, running_dir) == 3
+    assert job_store.get_test('queued-1')['license_host'] == '10.0.0.1'
+    assert job_store.get_test('queued-2')['license_host'] is None
+    assert job_store.get_test('running-1')['license_host'] == '10.0.0.2'
+    assert job_store.get_test('running-1')['zone'] == 'us-south-2'
+    assert set(cell['license_host'] for cell in job_store.queued_cells()) == set([None, '10.0.0.1'])
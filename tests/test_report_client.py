@@ -0,0 +1,101 @@
+# coding=utf-8
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import sys
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import report_client  # noqa: E402
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        return
+
+    def respond(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.server.requests.append((self.command, self.path))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    do_GET = respond
+    do_PUT = respond
+    do_POST = respond
+
+
+@pytest.fixture
+def service():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    server.requests = []
+    server.status = 200
+    server.delay = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    report_client.LATENCY.clear()
+    report_client.configure({
+        'report_service_base_url': "http://127.0.0.1:%d" % server.server_address[1],
+        'report_service_timeout': 0.5,
+        'report_service_retries': 2,
+        'report_service_backoff': 0
+    })
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('status', [500, 503])
+def test_stop_is_not_retried_after_a_server_error(service, status):
+    service.status = status
+    response = report_client.stop('test-1', {})
+    assert response.status_code == status
+    assert service.requests == [('POST', '/stop/test-1')]
+
+
+def test_start_is_not_retried_after_a_timeout(service):
+    service.delay = 1
+    assert report_client.start('test-1', {}) is None
+    assert service.requests == [('POST', '/start/test-1')]
+
+
+def test_stop_is_retried_when_rate_limited(service):
+    service.status = 429
+    assert report_client.stop('test-1', {}) is None
+    assert len(service.requests) == 3
+
+
+def test_update_is_retried_after_a_server_error(service):
+    service.status = 503
+    assert report_client.update('test-1', {}) is None
+    assert service.requests == [('PUT', '/report/test-1')] * 3
+
+
+def test_start_is_retried_when_the_connection_is_refused(service):
+    service.shutdown()
+    service.server_close()
+    assert report_client.start('test-1', {}) is None
+    assert report_client.LATENCY['start']['errors'] == 3
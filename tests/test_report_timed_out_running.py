@@ -0,0 +1,99 @@
+# coding=utf-8
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import report_timed_out_running  # noqa: E402
+
+
+def instance(name, status='running'):
+    return {
+        'mode': 'managed',
+        'type': 'ibm_is_instance',
+        'name': name,
+        'instances': [{'attributes': {
+            'id': "%s-id" % name,
+            'image': 'image-id',
+            'status': status,
+            # strings with escapes, brackets and braces a naive scan would trip on
+            'user_data': '#cloud-config\n"resources": [ {"type": "ibm_is_instance"} ]\\\né]}',
+        }}]
+    }
+
+
+STATE = {
+    'version': 4,
+    'outputs': {'note': {'value': 'a "quoted" ] value with \\ and }', 'type': 'string'}},
+    'resources': [
+        {'mode': 'managed', 'type': 'ibm_is_floating_ip', 'name': 'fip',
+         'instances': [{'attributes': {'address': '169.1.1.1'}}]},
+        instance('bigip'),
+        {'mode': 'data', 'type': 'ibm_is_image', 'name': 'image', 'instances': []},
+        instance('second', status='failed')
+    ]
+}
+
+
+def write_state(tmp_path, content, name='terraform.tfstate'):
+    state_file = tmp_path / name
+    state_file.write_text(content)
+    return str(state_file)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 13, 64, 65536])
+@pytest.mark.parametrize('indent', [None, 2])
+def test_instances_are_read_across_chunk_boundaries(tmp_path, chunk_size, indent):
+    state_file = write_state(tmp_path, json.dumps(STATE, indent=indent))
+    resources = list(report_timed_out_running.instance_resources(state_file, chunk_size))
+    assert resources == [instance('bigip'), instance('second', status='failed')]
+
+
+@pytest.mark.parametrize('content', ['', '{}', '{"version": 4, "resources": []}', '{"resources" : [\n]}'])
+def test_states_without_instances(tmp_path, content):
+    state_file = write_state(tmp_path, content)
+    assert list(report_timed_out_running.instance_resources(state_file, 4)) == []
+
+
+@pytest.mark.parametrize('content', [
+    '{"resources": [',
+    '{"resources": [{"type": "ibm_is_instance", "instances": [',
+    '{"resources": [{"type": "ibm_is_image"} {"type"',
+    '{"resources": ["not a resource", 42, {"name": "no type"}]}',
+    'not json at all'
+])
+def test_malformed_states_end_the_scan(tmp_path, content):
+    state_file = write_state(tmp_path, content)
+    assert list(report_timed_out_running.instance_resources(state_file, 4)) == []
+
+
+def test_truncated_state_keeps_the_instances_read(tmp_path):
+    content = json.dumps(STATE)
+    state_file = write_state(tmp_path, content[0:content.index('"second"')])
+    assert list(report_timed_out_running.instance_resources(state_file, 5)) == [instance('bigip')]
+
+
+def test_scan_test_reports_the_last_instance(tmp_path, monkeypatch):
+    monkeypatch.setattr(report_timed_out_running, 'RUNNING_DIR', str(tmp_path))
+    os.makedirs(str(tmp_path / 'test-1'))
+    write_state(tmp_path / 'test-1', json.dumps(STATE))
+    assert report_timed_out_running.scan_test('test-1') == (
+        'test-1', {'instance_id': 'second-id', 'image_id': 'image-id', 'status': 'failed'})
+    assert report_timed_out_running.scan_test('test-2') == ('test-2', None)
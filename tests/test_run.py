@@ -0,0 +1,55 @@
+# coding=utf-8
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import sys
+import asyncio
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import run  # noqa: E402
+
+
+@pytest.fixture
+def runner(monkeypatch):
+    monkeypatch.setattr(run, 'PHONED_HOME', set())
+    monkeypatch.setattr(run, 'RUNNING_TESTS', set())
+    monkeypatch.setattr(run, 'REPORT_WAITERS', {})
+    states = {}
+    monkeypatch.setattr(run.job_store, 'set_state', lambda test_id, state: states.update({test_id: state}))
+    return states
+
+
+def test_phone_homes_for_unknown_tests_are_not_kept(runner):
+    run.phone_home_received('test-1')
+    assert run.PHONED_HOME == set()
+
+
+@pytest.mark.parametrize('failure', [None, RuntimeError('apply went wrong')])
+def test_early_phone_homes_are_dropped_when_the_test_ends(runner, monkeypatch, failure):
+    async def run_test(test):
+        # phoned home before polling, then fast failed, errored or retried
+        run.phone_home_received(test['test_id'])
+        assert run.PHONED_HOME == set([test['test_id']])
+        if failure:
+            raise failure
+    monkeypatch.setattr(run, 'run_test', run_test)
+    asyncio.run(run.guarded_run_test({'test_id': 'test-1'}))
+    assert run.PHONED_HOME == set()
+    assert run.RUNNING_TESTS == set()
+    if failure:
+        assert runner == {'test-1': run.job_store.ERRORED}
@@ -0,0 +1,198 @@
+# coding=utf-8
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import sys
+import time
+import types
+import asyncio
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import job_store  # noqa: E402
+import scheduler  # noqa: E402
+
+IMAGE = 'bigip-15-1-0-4-0-0-6-ltm-1slot'
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_store, 'READ_ONLY', False)
+    monkeypatch.setattr(job_store, 'CONNECTIONS', threading.local())
+    job_store.configure({'job_store_file': str(tmp_path / 'test_jobs.db')})
+    for (name, value) in [('CELLS', {}), ('ZONE_ORDER', []), ('NEXT_ZONE', 0),
+                          ('NEXT_CELL', {}), ('LAST_REFRESH', 0)]:
+        monkeypatch.setattr(scheduler, name, value)
+
+
+def queue(zone, count, image=IMAGE, license_host=None):
+    job_store.add_tests([("%s-%s-%d" % (zone, image, index), zone, image, 'tmos_multi_nic', license_host)
+                         for index in range(count)])
+
+
+def claim_all(count):
+    async def claim():
+        return [await scheduler.next_test() for _ in range(count)]
+    return asyncio.run(claim())
+
+
+def blocked():
+    # True when next_test() has nothing it may claim
+    async def claim():
+        try:
+            await asyncio.wait_for(scheduler.next_test(), timeout=0.2)
+            return False
+        except asyncio.TimeoutError:
+            return True
+    return asyncio.run(claim())
+
+
+def test_zones_and_cells_are_claimed_round_robin(store):
+    scheduler.configure({})
+    queue('us-south-1', 2)
+    queue('us-south-1', 2, image='other-image')
+    queue('eu-de-1', 2)
+    tests = claim_all(6)
+    assert [test['zone'] for test in tests] == ['eu-de-1', 'us-south-1'] * 2 + ['us-south-1'] * 2
+    assert [test['image'] for test in tests if test['zone'] == 'us-south-1'] == \
+        [IMAGE, 'other-image', IMAGE, 'other-image']
+
+
+def test_the_queue_is_done_once_nothing_is_running(store):
+    scheduler.configure({})
+    queue('us-south-1', 1)
+    (test,) = claim_all(1)
+    scheduler.release(test)
+    assert claim_all(1) == [None]
+
+
+def test_zone_limit(store):
+    scheduler.configure({'scheduler': {'zone_concurrency': {'us-south-1': 1, 'default': 2}}})
+    queue('us-south-1', 3)
+    queue('eu-de-1', 3)
+    tests = claim_all(3)
+    assert sorted(test['zone'] for test in tests) == ['eu-de-1', 'eu-de-1', 'us-south-1']
+    assert blocked()
+    scheduler.release([test for test in tests if test['zone'] == 'us-south-1'][0])
+    assert claim_all(1)[0]['zone'] == 'us-south-1'
+    assert scheduler.active_counts()['zone'] == {'us-south-1': 1, 'eu-de-1': 2}
+
+
+def test_region_limit(store):
+    scheduler.configure({'scheduler': {'region_concurrency': {'us-south': 1}}})
+    queue('us-south-1', 2)
+    queue('us-south-2', 2)
+    queue('eu-de-1', 2)
+    tests = claim_all(3)
+    zones = sorted(test['zone'] for test in tests)
+    assert zones[0:2] == ['eu-de-1', 'eu-de-1']
+    assert zones[2] in ['us-south-1', 'us-south-2']
+    assert blocked()
+    assert scheduler.active_counts()['region'] == {'us-south': 1, 'eu-de': 2}
+
+
+def test_license_host_limit(store):
+    scheduler.configure({
+        'scheduler': {'license_host_concurrency': 2},
+        'zone_license_hosts': {'us-south-1': {'license_host': '10.0.0.1'}}
+    })
+    # queued tests carry their own license host, the zone's is the fallback
+    queue('us-south-1', 2)
+    queue('us-south-2', 2, license_host='10.0.0.1')
+    queue('eu-de-1', 1, license_host='10.0.0.2')
+    tests = claim_all(3)
+    assert sorted(test['zone'] for test in tests)[0] == 'eu-de-1'
+    assert blocked()
+    assert scheduler.active_counts()['license_host'] == {'10.0.0.1': 2, '10.0.0.2': 1}
+
+
+def test_retried_tests_wait_for_not_before(store):
+    scheduler.configure({})
+    queue('us-south-1', 1)
+    (test,) = claim_all(1)
+    scheduler.release(test)
+    job_store.retry_later(test['test_id'], time.time() + 0.3, 'Error: 429')
+    start = time.time()
+    (retried,) = claim_all(1)
+    assert retried['test_id'] == test['test_id']
+    assert time.time() - start >= 0.25
+
+
+@pytest.fixture
+def adaptive(monkeypatch):
+    clock = types.SimpleNamespace(now=1000.0)
+    clock.time = lambda: clock.now
+    monkeypatch.setattr(scheduler, 'time', clock)
+    scheduler.configure({'scheduler': {
+        'zone_concurrency': 6,
+        'adaptive_zone_concurrency': {'initial': 2, 'warmup': 2, 'cooldown': 60}
+    }})
+    return clock
+
+
+def limit():
+    return scheduler.ZONE_CONTROL['us-south-1']['limit']
+
+
+def test_limit_grows_by_one_per_apply_up_to_the_zone_limit(adaptive):
+    for expected in [3, 4, 5, 6, 6]:
+        scheduler.record_apply('us-south-1', 10, 0)
+        assert scheduler.adaptive_limit('us-south-1') == expected
+
+
+def test_failed_and_throttled_applies_back_off_once_per_cooldown(adaptive):
+    for _ in range(2):
+        scheduler.record_apply('us-south-1', 10, 0)
+    assert limit() == 4.0
+    scheduler.record_apply('us-south-1', 10, 1)
+    assert limit() == 2.0
+    # congestion inside the cooldown neither backs off nor grows the limit
+    scheduler.record_apply('us-south-1', 10, 0, 'Error: 429 Too Many Requests')
+    assert limit() == 2.0
+    scheduler.record_apply('us-south-1', 10, 0)
+    assert limit() == 2.5
+    adaptive.now = adaptive.now + 60
+    scheduler.record_apply('us-south-1', 10, 0, 'Error: 429 Too Many Requests')
+    assert limit() == 1.25
+    assert scheduler.adaptive_limit('us-south-1') == 1
+
+
+def test_limit_grows_additively_above_the_back_off_threshold(adaptive):
+    scheduler.record_apply('us-south-1', 10, 1)
+    assert limit() == 1.0
+    scheduler.record_apply('us-south-1', 10, 0)
+    assert limit() == 2.0
+    scheduler.record_apply('us-south-1', 10, 0)
+    assert limit() == 2.5
+
+
+def test_slow_applies_back_off_after_warmup(adaptive):
+    for _ in range(2):
+        scheduler.record_apply('us-south-1', 10, 0)
+    scheduler.record_apply('us-south-1', 25, 0)
+    assert limit() == 2.0
+
+
+def test_the_adaptive_limit_caps_zone_capacity(adaptive):
+    keys = scheduler.test_keys('us-south-1', None)
+    scheduler.acquire(keys)
+    assert scheduler.has_capacity(keys)
+    scheduler.acquire(keys)
+    assert not scheduler.has_capacity(keys)
+    scheduler.record_apply('us-south-1', 10, 0)
+    assert scheduler.has_capacity(keys)
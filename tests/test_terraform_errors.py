@@ -0,0 +1,76 @@
+# coding=utf-8
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import terraform_errors  # noqa: E402
+
+
+@pytest.mark.parametrize('err,error_class', [
+    ('Error: 429 Too Many Requests', 'rate_limit'),
+    ('Error: Error acquiring the state lock', 'busy'),
+    ('Error: Error deleting subnet: the subnet is in use by 1 instance', 'busy'),
+    ('Error: security group sg-1 is still in use', 'busy'),
+    ('Error: Error deleting Floating IP: resource is in use', 'busy'),
+    ('Error: the instance is in a pending state', 'busy'),
+    ('Error: another operation is in progress on the VPC', 'busy'),
+    ('Error: The name f0-1234 is already in use by another floating IP', terraform_errors.PERMANENT),
+    ('Error: Provided name is already in use', terraform_errors.PERMANENT),
+    ('Error: image visibility change pending approval', terraform_errors.PERMANENT),
+    ('Error: Error: the instance status is pending approval', terraform_errors.PERMANENT),
+    ('Error: invalid value for variable "zone"', terraform_errors.PERMANENT)
+])
+def test_classify(err, error_class):
+    assert terraform_errors.classify(err) == error_class
+
+
+SOURCE_CONTEXT = '''
+Error: %s
+
+  on compute.tf line 112, in resource "ibm_is_instance" "f5_ve_instance":
+ 112: resource "ibm_is_instance" "f5_ve_instance" {
+
+'''
+
+
+@pytest.mark.parametrize('err,error_class', [
+    (SOURCE_CONTEXT % 'Error creating instance: Internal Server Error', 'service'),
+    (SOURCE_CONTEXT % 'Error creating instance: {"StatusCode": 503}', 'service'),
+    (SOURCE_CONTEXT % 'Post https://us-south.iaas.cloud.ibm.com/v1/instances: net/http: TLS handshake timeout', 'network'),
+    (SOURCE_CONTEXT % 'Error: Image r006-5021-8a2c not found', terraform_errors.PERMANENT),
+    (SOURCE_CONTEXT % 'Unsupported argument "lock_timeout"', terraform_errors.PERMANENT),
+    (SOURCE_CONTEXT % 'Error: Subnet 0717-504-timeout-subnet is invalid', terraform_errors.PERMANENT),
+    (SOURCE_CONTEXT % 'Error: the volume resource-429 does not exist', terraform_errors.PERMANENT),
+    ('Error: Invalid value\n\n  on variables.tf line 503, in variable "timeout":\n 503: variable "timeout" {\n',
+     terraform_errors.PERMANENT)
+])
+def test_classify_ignores_source_context(err, error_class):
+    assert terraform_errors.classify(err) == error_class
+
+
+def test_summary_is_the_last_error_line():
+    err = "%s%s" % (SOURCE_CONTEXT % 'first failure', SOURCE_CONTEXT % 'Error creating instance: 429 Too Many Requests')
+    assert terraform_errors.summary(err) == 'Error: Error creating instance: 429 Too Many Requests'
+
+
+def test_summary_of_other_messages_is_their_last_line():
+    assert terraform_errors.summary('apply failure: no instance_id in terraform outputs\n') == \
+        'apply failure: no instance_id in terraform outputs'
+    assert terraform_errors.summary(None) == ''
@@ -0,0 +1,161 @@
+# coding=utf-8
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import sys
+import json
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import zero_out_bigiqs  # noqa: E402
+
+MEMBERS_URL = 'https://bigiq/pool/utility/licenses/pool-1/offerings/offering-1/members'
+
+
+class Response(object):
+
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception("HTTP %d" % self.status_code)
+
+
+class BigIQ(object):
+    # grants of one offering, served a page at a time
+
+    def __init__(self):
+        self.host = 'bigiq'
+        self.base_url = 'https://bigiq/pool'
+        self.grants = []
+        self.requests = []
+
+    def request(self, bigiq, method, url):
+        self.requests.append((method, url))
+        if method == 'GET':
+            skip = int(url.split('$skip=')[1])
+            top = int(url.split('$top=')[1].split('&')[0])
+            return Response(200, {'items': self.grants[skip:skip + top]})
+        member_id = url.split('/')[-1]
+        self.grants = [grant for grant in self.grants if grant['id'] != member_id]
+        return Response(200)
+
+    def grant(self, member_id, device_name, device_address='10.0.0.1'):
+        self.grants.append({'id': member_id, 'deviceName': device_name, 'deviceAddress': device_address})
+
+    def ids(self):
+        return sorted(grant['id'] for grant in self.grants)
+
+    def listed(self):
+        return len([request for request in self.requests if request[0] == 'GET'])
+
+
+@pytest.fixture
+def bigiq(tmp_path, monkeypatch):
+    session = BigIQ()
+    clock = types.SimpleNamespace(now=1000.0)
+    clock.time = lambda: clock.now
+    monkeypatch.setattr(zero_out_bigiqs, 'bigiq_request', session.request)
+    monkeypatch.setattr(zero_out_bigiqs, 'time', clock)
+    monkeypatch.setattr(zero_out_bigiqs, 'RUNNING_DIR', str(tmp_path / 'running_tests'))
+    monkeypatch.setattr(zero_out_bigiqs.job_store, 'exists', lambda: False)
+    monkeypatch.setattr(zero_out_bigiqs, 'SEEN_GRANTS', {})
+    monkeypatch.setattr(zero_out_bigiqs, 'TEST_ADDRESSES', {})
+    monkeypatch.setitem(zero_out_bigiqs.SETTINGS, 'page_size', 2)
+    monkeypatch.setitem(zero_out_bigiqs.SETTINGS, 'orphan_grace', 900)
+    monkeypatch.setitem(zero_out_bigiqs.SETTINGS, 'full_sweep_interval', 3600)
+    session.clock = clock
+    return session
+
+
+def running(*test_ids):
+    for test_id in test_ids:
+        os.makedirs(os.path.join(zero_out_bigiqs.RUNNING_DIR, test_id), exist_ok=True)
+
+
+def reconcile(bigiq):
+    return zero_out_bigiqs.reconcile_grants(
+        bigiq, 'pool-1', 'offering-1', zero_out_bigiqs.active_tests())
+
+
+def test_grants_named_for_an_inactive_test_are_released_at_once(bigiq):
+    running('test-1')
+    bigiq.grant('grant-1', 't-test-1.example')
+    bigiq.grant('grant-2', 't-test-2')
+    bigiq.grant('grant-3', 'bigip1')
+    assert reconcile(bigiq) == (1, 0)
+    assert bigiq.ids() == ['grant-1', 'grant-3']
+    assert ('DELETE', "%s/grant-2" % MEMBERS_URL) in bigiq.requests
+
+
+def test_orphaned_grants_are_kept_for_the_grace_period(bigiq):
+    bigiq.grant('grant-1', 'bigip1')
+    assert reconcile(bigiq) == (0, 0)
+    bigiq.clock.now = bigiq.clock.now + 899
+    assert reconcile(bigiq) == (0, 0)
+    bigiq.clock.now = bigiq.clock.now + 1
+    assert reconcile(bigiq) == (1, 0)
+    assert bigiq.ids() == []
+
+
+def test_grants_matching_a_test_address_are_kept(bigiq):
+    running('test-1')
+    with open(os.path.join(zero_out_bigiqs.RUNNING_DIR, 'test-1', 'terraform.tfstate'), 'w') as sf:
+        json.dump({'resources': [{'type': 'ibm_is_floating_ip', 'instances': [
+            {'attributes': {'address': '169.1.1.1'}}]}]}, sf)
+    bigiq.grant('grant-1', 'bigip1', '169.1.1.1')
+    bigiq.clock.now = bigiq.clock.now + 900
+    reconcile(bigiq)
+    bigiq.clock.now = bigiq.clock.now + 900
+    assert reconcile(bigiq) == (0, 0)
+    assert bigiq.ids() == ['grant-1']
+
+
+def test_cycles_between_sweeps_only_revisit_known_grants(bigiq):
+    running('test-1', 'test-2')
+    bigiq.grant('grant-1', 't-test-1')
+    bigiq.grant('grant-2', 't-test-2')
+    bigiq.grant('grant-3', 'bigip1')
+    reconcile(bigiq)
+    listed = bigiq.listed()
+    assert listed == 2
+    # a grant made after the sweep is not seen until the next one
+    bigiq.grant('grant-4', 't-test-4')
+    os.rmdir(os.path.join(zero_out_bigiqs.RUNNING_DIR, 'test-2'))
+    bigiq.clock.now = bigiq.clock.now + 900
+    assert reconcile(bigiq) == (2, 0)
+    assert bigiq.listed() == listed
+    assert bigiq.ids() == ['grant-1', 'grant-4']
+    bigiq.clock.now = bigiq.clock.now + 2700
+    assert reconcile(bigiq) == (1, 0)
+    assert bigiq.listed() == listed + 2
+    assert bigiq.ids() == ['grant-1']
+
+
+def test_a_missing_offering_forgets_its_grants(bigiq, monkeypatch):
+    bigiq.grant('grant-1', 'bigip1')
+    reconcile(bigiq)
+    monkeypatch.setattr(zero_out_bigiqs, 'get_members', lambda session, url: None)
+    bigiq.clock.now = bigiq.clock.now + 3600
+    assert reconcile(bigiq) is None
+    assert zero_out_bigiqs.SEEN_GRANTS == {}
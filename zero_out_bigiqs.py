@@ -20,10 +20,15 @@
 import logging
 import datetime
 import requests
+import requests.adapters
 import os
 import sys
 import json
 import time
+import concurrent.futures
+import functools
+import threading
+import job_store
 
 
 LOG = logging.getLogger('ibmcloud_test_harness_zero_bigiq')
@@ -44,37 +49,122 @@ ERRORED_DIR = "%s/errored_tests" % SCRIPT_DIR
 CONFIG_FILE = "%s/builder-config.json" % SCRIPT_DIR
 CONFIG = {}
 
+SETTINGS = {
+    'timeout': 30,
+    'requests_per_second': 10,
+    'delete_concurrency': 5,
+    'page_size': 100,
+    'token_refresh_margin': 60,
+    'id_cache_ttl': 86400,
+    'orphan_grace': 900,
+    'keep_clean_interval': 300,
+    'full_sweep_interval': 3600
+}
+
+# (host, pool, sku keywords) -> pool regKey and offering id
+ID_CACHE_FILE = "%s/bigiq_id_cache.json" % SCRIPT_DIR
+ID_CACHE = {}
+ID_CACHE_LOCK = threading.Lock()
+
+# offering key -> {'swept_at', 'grants': {member id: {'first_seen',
+# 'test_id', 'member'}}} of the grants known after the last reconcile
+# cycle, and test id -> management addresses from its tfstate
+SEEN_GRANTS = {}
+TEST_ADDRESSES = {}
+
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+
 MY_PID = None
 
 
 def get_bigiq_session(host, username, password, timeout):
-    if requests.__version__ < '2.9.1':
-        requests.packages.urllib3.disable_warnings()  # pylint: disable=no-member
-    bigiq = requests.Session()
-    bigiq.verify = False
-    bigiq.headers.update({'Content-Type': 'application/json'})
-    bigiq.timeout = timeout
+    # one session per BIG-IQ host, shared by every zone licensing
+    # from it and kept across KEEP_CLEAN cycles
+    with SESSIONS_LOCK:
+        if host not in SESSIONS:
+            if requests.__version__ < '2.9.1':
+                requests.packages.urllib3.disable_warnings()  # pylint: disable=no-member
+            bigiq = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_maxsize=int(SETTINGS['delete_concurrency']))
+            bigiq.mount('https://', adapter)
+            bigiq.verify = False
+            bigiq.headers.update({'Content-Type': 'application/json'})
+            bigiq.timeout = timeout
+            bigiq.host = host
+            bigiq.credentials = (username, password)
+            bigiq.token_expires = 0
+            bigiq.token_refresh_at = 0
+            bigiq.auth_lock = threading.Lock()
+            bigiq.rate_lock = threading.Lock()
+            bigiq.next_request = 0
+            bigiq.base_url = 'https://%s/mgmt/cm/device/licensing/pool' % host
+            SESSIONS[host] = bigiq
+        bigiq = SESSIONS[host]
+    refresh_token(bigiq)
+    return bigiq
+
+
+def login(bigiq):
+    (username, password) = bigiq.credentials
     token_auth_body = {
         'username': username,
         'password': password,
         'loginProviderName': 'local'
     }
-    login_url = "https://%s/mgmt/shared/authn/login" % host
+    login_url = "https://%s/mgmt/shared/authn/login" % bigiq.host
     response = bigiq.post(login_url,
                           json=token_auth_body,
                           verify=False,
+                          timeout=bigiq.timeout,
                           auth=requests.auth.HTTPBasicAuth(username, password))
+    response.raise_for_status()
     response_json = response.json()
-    bigiq.headers.update(
-        {'X-F5-Auth-Token': response_json['token']['token']})
-    bigiq.base_url = 'https://%s/mgmt/cm/device/licensing/pool' % host
-    return bigiq
+    token = response_json['token']
+    bigiq.headers.update({'X-F5-Auth-Token': token['token']})
+    if 'expirationMicros' in token:
+        bigiq.token_expires = token['expirationMicros'] / 1000000.0
+    else:
+        bigiq.token_expires = time.time() + int(token.get('timeout', 1200))
+    # refresh ahead of expiry, but never for most of a short lived token
+    bigiq.token_refresh_at = bigiq.token_expires - min(
+        SETTINGS['token_refresh_margin'], (bigiq.token_expires - time.time()) / 2)
+    LOG.debug('authenticated to BIG-IQ %s', bigiq.host)
+
+
+def refresh_token(bigiq, force=False):
+    with bigiq.auth_lock:
+        if force or time.time() > bigiq.token_refresh_at:
+            login(bigiq)
+
+
+def throttle(bigiq):
+    # space requests to one host requests_per_second apart
+    with bigiq.rate_lock:
+        now = time.time()
+        wait = bigiq.next_request - now
+        bigiq.next_request = max(now, bigiq.next_request) + \
+            1.0 / float(SETTINGS['requests_per_second'])
+    if wait > 0:
+        time.sleep(wait)
+
+
+def bigiq_request(bigiq, method, url):
+    refresh_token(bigiq)
+    throttle(bigiq)
+    response = bigiq.request(method, url, verify=False, timeout=bigiq.timeout)
+    if response.status_code == 401:
+        refresh_token(bigiq, force=True)
+        throttle(bigiq)
+        response = bigiq.request(method, url, verify=False, timeout=bigiq.timeout)
+    return response
 
 
 def get_pool_id(bigiq_session, pool_name):
     pools_url = '%s/utility/licenses?$select=regKey,kind,name,unitsOfMeasure' % \
         bigiq_session.base_url
-    response = bigiq_session.get(pools_url)
+    response = bigiq_request(bigiq_session, 'GET', pools_url)
     response.raise_for_status()
     response_json = response.json()
     pools = response_json['items']
@@ -88,7 +178,7 @@ def get_offerings(bigiq_session, pool_id, search1, search2):
     pools_url = '%s/utility/licenses' % bigiq_session.base_url
     offerings_url = '%s/%s/offerings?$select=id,kind,name' % (
         pools_url, pool_id)
-    response = bigiq_session.get(offerings_url)
+    response = bigiq_request(bigiq_session, 'GET', offerings_url)
     response.raise_for_status()
     response_json = response.json()
     offerings = response_json['items']
@@ -102,45 +192,314 @@ def get_offerings(bigiq_session, pool_id, search1, search2):
     return None
 
 
+def get_members(bigiq_session, members_url):
+    # read the grants a page at a time, None if the offering is gone
+    members = []
+    page_size = int(SETTINGS['page_size'])
+    while True:
+        page_url = '%s?$top=%d&$skip=%d' % (members_url, page_size, len(members))
+        response = bigiq_request(bigiq_session, 'GET', page_url)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        response_json = response.json()
+        items = []
+        if 'items' in response_json:
+            items = response_json['items']
+        members.extend(items)
+        if len(items) < page_size:
+            return members
+
+
+def delete_grant(bigiq_session, members_url, member):
+    LOG.info('deleting license grant %s', member['id'])
+    member_url = '%s/%s' % (members_url, member['id'])
+    try:
+        response = bigiq_request(bigiq_session, 'DELETE', member_url)
+        if response.status_code != 404:
+            response.raise_for_status()
+        return True
+    except Exception as ex:
+        LOG.error('could not delete license grant %s on %s: %s',
+                  member['id'], bigiq_session.host, ex)
+        return False
+
+
+def release(bigiq_session, members_url, members):
+    # True or False for each member, in order
+    with concurrent.futures.ThreadPoolExecutor(max_workers=int(SETTINGS['delete_concurrency'])) as executor:
+        return list(executor.map(
+            lambda member: delete_grant(bigiq_session, members_url, member), members))
+
+
+def delete_grants(bigiq_session, members_url, members):
+    results = release(bigiq_session, members_url, members)
+    return (results.count(True), results.count(False))
+
+
 def delete_all_grants(bigiq_session, pool_id, offering_id):
     pools_url = '%s/utility/licenses' % bigiq_session.base_url
     offerings_url = '%s/%s/offerings' % (pools_url, pool_id)
     members_url = '%s/%s/members' % (offerings_url, offering_id)
-    response = bigiq_session.get(members_url)
-    if response.status_code != 404:
-        response.raise_for_status()
-        response_json = response.json()
-        members = response_json['items']
-        for member in members:
-            LOG.info('deleting license grant %s', member['id'])
-            member_url = '%s/%s' % (members_url, member['id'])
-            response = bigiq_session.delete(member_url)
-            response.raise_for_status()
+    members = get_members(bigiq_session, members_url)
+    if members is None:
+        return None
+    return delete_grants(bigiq_session, members_url, members)
+
+
+def id_cache_key(host, bigiq_config):
+    return '|'.join([host, bigiq_config['license_pool'],
+                     bigiq_config['license_sku_keyword_1'],
+                     bigiq_config['license_sku_keyword_2'] or ''])
+
+
+def load_id_cache():
+    global ID_CACHE
+    if os.path.exists(ID_CACHE_FILE):
+        try:
+            with open(ID_CACHE_FILE, 'r') as icf:
+                ID_CACHE = json.load(icf)
+        except ValueError:
+            LOG.error('ignoring unreadable BIG-IQ id cache %s', ID_CACHE_FILE)
+            ID_CACHE = {}
+
+
+def save_id_cache():
+    with ID_CACHE_LOCK:
+        cache_json = json.dumps(ID_CACHE, sort_keys=True, indent=4, separators=(',', ': '))
+    tmp_file = "%s.%d.%d" % (ID_CACHE_FILE, os.getpid(), threading.get_ident())
+    with open(tmp_file, 'w') as icf:
+        icf.write(cache_json)
+    os.replace(tmp_file, ID_CACHE_FILE)
+
+
+def invalidate_ids(key):
+    with ID_CACHE_LOCK:
+        ID_CACHE.pop(key, None)
+    save_id_cache()
+
+
+def resolve_ids(bigiq, bigiq_config):
+    # (pool regKey, offering id) for a zone's pool and sku keywords,
+    # looked up only when the cached ids are missing or expired
+    key = id_cache_key(bigiq.host, bigiq_config)
+    with ID_CACHE_LOCK:
+        cached = ID_CACHE.get(key)
+    if cached and time.time() - cached['resolved_at'] < SETTINGS['id_cache_ttl']:
+        return (cached['pool_id'], cached['offering_id'])
+    pool_id = get_pool_id(bigiq, bigiq_config['license_pool'])
+    if not pool_id:
+        return (None, None)
+    offering_id = get_offerings(
+        bigiq, pool_id, bigiq_config['license_sku_keyword_1'], bigiq_config['license_sku_keyword_2'])
+    if not offering_id:
+        return (pool_id, None)
+    with ID_CACHE_LOCK:
+        ID_CACHE[key] = {
+            'pool_id': pool_id,
+            'offering_id': offering_id,
+            'resolved_at': time.time()
+        }
+    save_id_cache()
+    return (pool_id, offering_id)
+
+
+def test_addresses(test_id):
+    # management addresses of a running test, read once from its state
+    if test_id in TEST_ADDRESSES:
+        return TEST_ADDRESSES[test_id]
+    addresses = []
+    state_file = os.path.join(RUNNING_DIR, test_id, 'terraform.tfstate')
+    if os.path.exists(state_file):
+        try:
+            with open(state_file, 'r') as sf:
+                state = json.load(sf)
+        except ValueError:
+            return addresses
+        for resource in state.get('resources', []):
+            for instance in resource.get('instances', []):
+                attributes = instance.get('attributes', {})
+                if resource['type'] == 'ibm_is_instance':
+                    for interface in attributes.get('primary_network_interface', []):
+                        if interface.get('primary_ipv4_address'):
+                            addresses.append(interface['primary_ipv4_address'])
+                if resource['type'] == 'ibm_is_floating_ip' and attributes.get('address'):
+                    addresses.append(attributes['address'])
+        if addresses:
+            TEST_ADDRESSES[test_id] = addresses
+    return addresses
+
 
+def active_tests():
+    # tests which may hold a grant: running in the job store, or still
+    # in running_tests, which includes tests waiting to be destroyed
+    test_ids = set()
+    if job_store.exists():
+        try:
+            test_ids.update([test['test_id'] for test in job_store.tests_in_state(job_store.RUNNING)])
+        except Exception as ex:
+            LOG.error('could not read running tests from the job store, using %s: %s', RUNNING_DIR, ex)
+    if os.path.exists(RUNNING_DIR):
+        test_ids.update(os.listdir(RUNNING_DIR))
+    for test_id in list(TEST_ADDRESSES.keys()):
+        if test_id not in test_ids:
+            del TEST_ADDRESSES[test_id]
+    by_name = {}
+    by_address = {}
+    for test_id in test_ids:
+        by_name["t-%s" % test_id] = test_id
+        for address in test_addresses(test_id):
+            by_address[address] = test_id
+    return (test_ids, by_name, by_address)
 
-def clean():
+
+def grant_test_id(member, by_name, by_address):
+    device_name = str(member.get('deviceName') or '').split('.')[0]
+    if device_name in by_name:
+        return by_name[device_name]
+    if member.get('deviceAddress') in by_address:
+        return by_address[member['deviceAddress']]
+    return None
+
+
+def reconcile_grants(bigiq_session, pool_id, offering_id, active):
+    # release only grants no active test holds. Grants named for a test
+    # which is no longer active go at once, grants which match no test
+    # are kept for bigiq_orphan_grace seconds after they were first seen.
+    # The grants are listed every bigiq_full_sweep_interval seconds, the
+    # cycles between only revisit the grants known from the last sweep.
+    (test_ids, by_name, by_address) = active
+    pools_url = '%s/utility/licenses' % bigiq_session.base_url
+    offerings_url = '%s/%s/offerings' % (pools_url, pool_id)
+    members_url = '%s/%s/members' % (offerings_url, offering_id)
+    key = "%s|%s|%s" % (bigiq_session.host, pool_id, offering_id)
+    now = time.time()
+    known = SEEN_GRANTS.get(key)
+    previous = {}
+    if known:
+        previous = known['grants']
+    swept_at = now
+    if known and now - known['swept_at'] < SETTINGS['full_sweep_interval']:
+        swept_at = known['swept_at']
+        members = [grant['member'] for grant in previous.values()]
+    else:
+        members = get_members(bigiq_session, members_url)
+        if members is None:
+            SEEN_GRANTS.pop(key, None)
+            return None
+    seen = {}
+    orphans = []
+    for member in members:
+        last = previous.get(member['id'])
+        if last and last['test_id'] in test_ids:
+            seen[member['id']] = last
+            continue
+        test_id = grant_test_id(member, by_name, by_address)
+        first_seen = now
+        if last:
+            first_seen = last['first_seen']
+        seen[member['id']] = {
+            'first_seen': first_seen,
+            'test_id': test_id,
+            'member': dict((field, member.get(field)) for field in ['id', 'deviceName', 'deviceAddress'])
+        }
+        if not test_id and (str(member.get('deviceName') or '').startswith('t-') or
+                            now - first_seen >= SETTINGS['orphan_grace']):
+            orphans.append(member)
+    results = release(bigiq_session, members_url, orphans)
+    for (member, released) in zip(orphans, results):
+        if released:
+            del seen[member['id']]
+    SEEN_GRANTS[key] = {'swept_at': swept_at, 'grants': seen}
+    LOG.info('%s offering %s: %s %d grants, %d new, %d held by active tests, %d orphaned released',
+             bigiq_session.host, offering_id, 'listed' if swept_at == now else 'revisited',
+             len(members), len([m for m in members if m['id'] not in previous]),
+             len([g for g in seen.values() if g['test_id']]), results.count(True))
+    return (results.count(True), results.count(False))
+
+
+def clean_host(host, bigiq_configs, release_grants):
+    deleted = 0
+    failed = 0
+    try:
+        bigiq_config = bigiq_configs[0]
+        bigiq = get_bigiq_session(
+            host, bigiq_config['license_username'], bigiq_config['license_password'],
+            SETTINGS['timeout'])
+        for bigiq_config in bigiq_configs:
+            (pool_id, offering_id) = resolve_ids(bigiq, bigiq_config)
+            if not offering_id:
+                continue
+            result = release_grants(bigiq, pool_id, offering_id)
+            if result is None:
+                # the pool or offering is gone, resolve the ids again
+                invalidate_ids(id_cache_key(host, bigiq_config))
+                (pool_id, offering_id) = resolve_ids(bigiq, bigiq_config)
+                if not offering_id:
+                    continue
+                result = release_grants(bigiq, pool_id, offering_id)
+            if result:
+                deleted = deleted + result[0]
+                failed = failed + result[1]
+    except Exception as ex:
+        LOG.error('exception releasing grants on %s: %s', host, ex)
+        failed = failed + 1
+    return (deleted, failed)
+
+
+def license_hosts():
+    # zone_license_hosts grouped by BIG-IQ host, one entry for
+    # each distinct pool and offering the zones license from
+    hosts = {}
     if 'zone_license_hosts' in CONFIG:
         zones = CONFIG['zone_license_hosts']
-        for zone in zones.keys():
-            bigiq_config = CONFIG['zone_license_hosts'][zone]
-            bigiq = get_bigiq_session(
-                bigiq_config['license_host'], bigiq_config['license_username'], bigiq_config['license_password'], 30)
-            pool_id = get_pool_id(bigiq, bigiq_config['license_pool'])
-            if pool_id:
-                offering_id = get_offerings(
-                    bigiq, pool_id, bigiq_config['license_sku_keyword_1'], bigiq_config['license_sku_keyword_2'])
-                if offering_id:
-                    delete_all_grants(bigiq, pool_id, offering_id)
+        for zone in sorted(zones.keys()):
+            bigiq_config = zones[zone]
+            configs = hosts.setdefault(bigiq_config['license_host'], [])
+            key = (bigiq_config['license_pool'], bigiq_config['license_sku_keyword_1'],
+                   bigiq_config['license_sku_keyword_2'])
+            if key not in [(c['license_pool'], c['license_sku_keyword_1'], c['license_sku_keyword_2']) for c in configs]:
+                configs.append(bigiq_config)
+    return hosts
+
+
+def clean(reconcile=False):
+    start = time.time()
+    hosts = license_hosts()
+    if not hosts:
+        return
+    release_grants = delete_all_grants
+    if reconcile:
+        active = active_tests()
+        release_grants = functools.partial(reconcile_grants, active=active)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+        results = list(executor.map(lambda host: clean_host(host, hosts[host], release_grants), hosts))
+    LOG.info('released %d license grants on %d BIG-IQs, %d failures, in %.1f seconds',
+             sum(r[0] for r in results), len(hosts), sum(r[1] for r in results),
+             time.time() - start)
 
 
 def initialize():
-    global MY_PID, CONFIG
+    global MY_PID, CONFIG, ID_CACHE_FILE
     MY_PID = os.getpid()
     with open(CONFIG_FILE, 'r') as cf:
         config_json = cf.read()
     config = json.loads(config_json)
     # intialize missing config defaults
     CONFIG = config
+    for setting in ['timeout', 'requests_per_second', 'delete_concurrency', 'page_size', 'id_cache_ttl',
+                    'orphan_grace', 'keep_clean_interval', 'full_sweep_interval']:
+        key = "bigiq_%s" % setting
+        if key in CONFIG:
+            SETTINGS[setting] = CONFIG[key]
+    if 'bigiq_id_cache_file' in CONFIG and CONFIG['bigiq_id_cache_file']:
+        ID_CACHE_FILE = CONFIG['bigiq_id_cache_file']
+        if not ID_CACHE_FILE.startswith('/'):
+            ID_CACHE_FILE = "%s/%s" % (SCRIPT_DIR, ID_CACHE_FILE)
+    load_id_cache()
+    # only read the store run.py and build.py keep. Creating it here
+    # would stop them importing the tests already on disk.
+    job_store.open_read_only(CONFIG)
 
 
 if __name__ == "__main__":
@@ -154,8 +513,8 @@ if __name__ == "__main__":
     if KEEP_CLEAN == '1' or KEEP_CLEAN.lower() == 'true':
         while True:
             try:
-                clean()
-                time.sleep(300)
+                clean(reconcile=True)
+                time.sleep(SETTINGS['keep_clean_interval'])
             except Exception as ex:
                 LOG.error('exception releasing grants: %s', ex)
     else: